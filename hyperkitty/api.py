@@ -34,7 +34,11 @@ from kittystore.storm.model import Email, Thread
 class ListSerializer(serializers.Serializer):
     name = serializers.CharField()
     display_name = serializers.CharField()
-    description = serializers.CharField()
+    description = serializers.SerializerMethodField("get_description")
+
+    def get_description(self, mlist):
+        # not stored by the older versions of KittyStore
+        return getattr(mlist, "description", None)
 
 class EmailSerializer(serializers.Serializer):
     list_name = serializers.EmailField()
@@ -98,7 +102,7 @@ class ThreadResource(APIView):
     def get(self, request, mlist_fqdn, threadid):
         store = get_store(request)
         thread = store.get_thread(mlist_fqdn, threadid)
-        if not thread:
+        if thread is None:
             return Response(status=404)
         else:
             return Response(ThreadSerializer(thread).data)
@@ -25,18 +25,54 @@ Class implementation of Mailman's IArchiver interface
 
 import os
 import sys
+import time
+import atexit
+import logging
+import threading
 from urlparse import urljoin
 
 from zope.interface import implements
 from mailman.interfaces.archiver import IArchiver
 from mailman.config import config
 from mailman.config.config import external_configuration
+from mailman.email.message import Message
 from django.core.urlresolvers import reverse
 from kittystore import get_store
 from kittystore.utils import get_message_id_hash
 
+from hyperkitty.lib.spool import (ArchiveSpool, SpoolConsumer, is_stored,
+        get_spool_dir)
+from hyperkitty.lib.pipeline import get_pipeline, run_pipeline
+
+
+logger = logging.getLogger(__name__)
+
+# Minimum age in seconds of the spooled messages replayed on start
+REPLAY_MIN_AGE = 60
+
 
 class Archiver(object):
+    """
+    Archive the messages in KittyStore.
+
+    Messages can be committed by batches (group commit): the pending batch is
+    committed when it contains ``ARCHIVER_BATCH_SIZE`` messages, or with the
+    first message archived after its oldest one is older than
+    ``ARCHIVER_BATCH_TIMEOUT`` milliseconds. The batch is also committed when
+    the process exits. The store can only be used from the archiving thread,
+    so a lone message waits for the next one. Until it is committed, each
+    message is kept in an on-disk spool and it will be archived again if the
+    process dies. A message which can't be archived is moved to the spool's
+    "failed" subdirectory after a few attempts. The messages which were
+    already stored (archived again after a crash) skip the pipeline.
+
+    With ``ARCHIVER_ASYNC``, the messages are only written to the spool, and
+    the ``consume_spool`` management command archives them in the store.
+
+    Once committed, the messages go through the archiver pipeline (see
+    :mod:`hyperkitty.lib.pipeline`). The deferred stages are left to the
+    ``consume_spool`` worker.
+    """
 
     implements(IArchiver)
 
@@ -45,7 +81,21 @@ class Archiver(object):
     def __init__(self):
         self.store = None
         self.store_url = None
+        self.spool = None
+        self.deferred_queue = None
+        self.batch_size = 1
+        self.batch_timeout = 0
+        self.spool_only = False
+        self._uncommitted = []
+        self._archived = []
+        self._batch_start = None
+        self._consumer = None
+        self._replay_keys = []
+        self._replay_min_age = REPLAY_MIN_AGE
+        self._next_replay = None
+        self._lock = threading.RLock()
         self._load_conf()
+        atexit.register(self.flush)
 
     def _load_conf(self):
         """
@@ -70,6 +120,24 @@ class Archiver(object):
             raise ImportError("Could not import Django's settings from %s"
                               % settings_path)
         self.store_url = settings.KITTYSTORE_URL
+        self.batch_size = getattr(settings, "ARCHIVER_BATCH_SIZE", 1)
+        self.batch_timeout = getattr(settings, "ARCHIVER_BATCH_TIMEOUT", 1000)
+        self.spool_only = getattr(settings, "ARCHIVER_ASYNC", False)
+        has_deferred = get_pipeline().has_deferred
+        if ((self.spool_only or has_deferred) and
+                getattr(settings, "ARCHIVER_SPOOL_DIR", None) is None):
+            # The consume_spool command can't find Mailman's var directory
+            raise ValueError("The ARCHIVER_SPOOL_DIR setting is required by "
+                             "the asynchronous mode and the deferred stages")
+        spool_dir = get_spool_dir()
+        if self.batch_size > 1 or self.spool_only:
+            self.spool = ArchiveSpool(spool_dir)
+            # Give the other live processes the time to commit their batches
+            self._replay_min_age = max(REPLAY_MIN_AGE,
+                                       10 * self.batch_timeout / 1000.0)
+        if not self.spool_only and has_deferred:
+            self.deferred_queue = ArchiveSpool(
+                    os.path.join(spool_dir, "deferred"))
         #if path_added:
         #    sys.path.remove(settings_path)
 
@@ -107,9 +175,114 @@ class Archiver(object):
         :returns: The url string or None if the message's archive url cannot
             be calculated.
         """
-        if self.store is None:
-            self.store = get_store(self.store_url)
-        msg.message_id_hash = self.store.add_to_list(mlist, msg)
-        self.store.commit()
-        # TODO: Update karma
+        if self.spool_only:
+            if not msg.get("Message-Id"):
+                # Same error as KittyStore in synchronous mode
+                raise ValueError("No 'Message-Id' header in email", msg)
+            self.spool.put(mlist, msg)
+            msg_id = msg['Message-Id'].strip().strip("<>")
+            return get_message_id_hash(msg_id)
+        with self._lock:
+            if self.store is None:
+                self._connect()
+            if self.spool is None:
+                stored = is_stored(self.store, mlist, msg)
+                msg.message_id_hash = self.store.add_to_list(mlist, msg)
+                self.store.commit()
+                if not stored:
+                    self._post_archive(
+                            [ (mlist.fqdn_listname, msg.message_id_hash) ])
+            else:
+                self._replay_pending()
+                self._add_to_batch(mlist, msg)
         return msg.message_id_hash
+
+    def _add_to_batch(self, mlist, msg):
+        # The message must be spooled before KittyStore scrubs it
+        key = self.spool.put(mlist, msg)
+        try:
+            stored = is_stored(self.store, mlist, msg)
+            msg.message_id_hash = self.store.add_to_list(mlist, msg)
+        except:
+            # The rollback also drops the rest of the batch, add it again
+            self.store.rollback()
+            self.spool.remove(key)
+            self._replay(self._uncommitted)
+            raise
+        self._uncommitted.append(key)
+        if not stored:
+            self._archived.append(
+                    (mlist.fqdn_listname, msg.message_id_hash) )
+        if self._batch_start is None:
+            self._batch_start = time.time()
+        if (len(self._uncommitted) >= self.batch_size or
+                (time.time() - self._batch_start) * 1000 >= self.batch_timeout):
+            self.flush()
+
+    def flush(self):
+        """Commit the pending batch and remove it from the spool."""
+        with self._lock:
+            if self.store is None or not self._uncommitted:
+                return
+            self.store.commit()
+            for key in self._uncommitted:
+                self.spool.remove(key)
+            archived = self._archived
+            self._uncommitted = []
+            self._archived = []
+            self._batch_start = None
+            self._post_archive(archived)
+
+    def _post_archive(self, archived):
+        """Update the derived data for the committed messages."""
+        run_pipeline(self.store, archived, deferred=False)
+        if self.deferred_queue is not None:
+            for list_name, message_id_hash in archived:
+                self.deferred_queue.put_reference(list_name, message_id_hash)
+
+    def _connect(self):
+        self.store = get_store(self.store_url)
+        if self.spool is not None:
+            # The attempts must be counted across replays for the messages
+            # which can't be archived to be set aside
+            self._consumer = SpoolConsumer(self.spool, self.store,
+                    message_class=Message, post_archive=self._post_archive)
+            self._replay_pending()
+
+    def _replay_pending(self):
+        """
+        Replay the messages of a failed replay, and periodically the ones
+        left over by dead processes. The recent messages may belong to the
+        pending batch of another live process and are skipped.
+        """
+        if self._replay_keys:
+            keys = self._replay_keys
+        elif self._next_replay is None or time.time() >= self._next_replay:
+            keys = self.spool.keys(min_age=self._replay_min_age)
+            self._next_replay = time.time() + self._replay_min_age
+        else:
+            return
+        # A failed replay would also roll the pending batch back
+        self.flush()
+        self._replay(keys)
+
+    def _replay(self, keys):
+        """
+        Add the spooled messages to the store again and commit them, by
+        batches. On failure, they are left in the spool and replayed again
+        before the next message is archived.
+        """
+        self._uncommitted = []
+        self._archived = []
+        self._batch_start = None
+        # Skip the keys archived by another process or set aside
+        spooled = set(self.spool.keys())
+        keys = [ key for key in keys if key in spooled ]
+        for index in range(0, len(keys), self.batch_size):
+            batch = keys[index:index+self.batch_size]
+            if self._consumer.consume(batch) < len(batch):
+                self._replay_keys = keys[index:]
+                logger.warning("Could not replay %d spooled messages, they "
+                               "will be retried" % len(self._replay_keys))
+                return
+        self._replay_keys = []
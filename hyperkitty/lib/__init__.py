@@ -24,6 +24,7 @@ from hashlib import md5
 import datetime
 
 from django.conf import settings
+from django.db import transaction, IntegrityError
 
 
 
@@ -37,29 +38,6 @@ def gravatar_url(email):
     return 'http://www.gravatar.com/avatar/%s?%s' % (identifier, query_string)
 
 
-def get_months(store, list_name):
-    """ Return a dictionnary of years, months for which there are
-    potentially archives available for a given list (based on the
-    oldest post on the list).
-
-    :arg list_name, name of the mailing list in which this email
-    should be searched.
-    """
-    date_first = store.get_start_date(list_name)
-    if not date_first:
-        return {}
-    archives = {}
-    now = datetime.datetime.now()
-    year = date_first.year
-    month = date_first.month
-    while year < now.year:
-        archives[year] = range(1, 13)[(month -1):]
-        year = year + 1
-        month = 1
-    archives[now.year] = range(1, 13)[:now.month]
-    return archives
-
-
 def get_store(request):
     return request.environ["kittystore.store"]
 
@@ -92,3 +70,30 @@ def get_display_dates(year, month, day):
 def daterange(start_date, end_date):
     for n in range(int((end_date - start_date).days)):
         yield start_date + datetime.timedelta(n)
+
+
+def get_period(date):
+    """Return the first day of the month a date belongs to."""
+    return datetime.date(date.year, date.month, 1)
+
+
+def update_or_create(model, lookup, updates, defaults):
+    """Update the row of a model matching ``lookup``, or create it.
+
+    :param lookup: The field values identifying the row.
+    :param updates: The values to update, which may be F() expressions.
+    :param defaults: The values of the other fields if the row is created.
+    """
+    if model.objects.filter(**lookup).update(**updates):
+        return
+    values = dict(lookup)
+    values.update(defaults)
+    sid = transaction.savepoint()
+    try:
+        model.objects.create(**values)
+    except IntegrityError:
+        # created by another process in the meantime
+        transaction.savepoint_rollback(sid)
+        model.objects.filter(**lookup).update(**updates)
+    else:
+        transaction.savepoint_commit(sid)
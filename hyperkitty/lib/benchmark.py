@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Run the views against a generated archive, to measure their latency and the
+number of queries they make.
+
+The archive is held in a :class:`hyperkitty.lib.fakestore.FakeStore`, which
+counts the calls to the store and the accesses to the thread and email
+attributes KittyStore loads with a query. It can also be held in an SQLite
+KittyStore, to run the actual SQL queries of :mod:`hyperkitty.lib.queries`:
+the SQL statements are then counted instead. The requests go through the
+Django test client, as a logged-in user who voted on some messages and added
+some threads to their favorites.
+"""
+
+import time
+import datetime
+from collections import namedtuple, defaultdict
+
+import kittystore
+from storm.tracer import install_tracer, remove_tracer
+from django.db import connection
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+
+from hyperkitty.models import Rating, Favorite, Tag, UserProfile
+from hyperkitty.lib.corpus import CorpusGenerator, to_message
+from hyperkitty.lib.fakestore import FakeStore
+from hyperkitty.lib.months import MonthsStage
+from hyperkitty.lib.spool import MailingList
+
+
+LIST_NAME = u"bench@example.com"
+USERNAME = "bench"
+PASSWORD = "bench"
+# Average number of messages per thread in the generated archives
+MESSAGES_PER_THREAD = 2.5
+DAYS = 365
+
+# The benchmarked views. The budgets are the maximum numbers of database
+# queries, of store calls (including the lazy loads) and of SQL statements in
+# an SQLite store per request. They are the exact counts of the current views,
+# itemized above each view, so a view going over its budget makes a query it
+# did not make before. The session and the account of the logged-in user are
+# two database queries on every view, they are not repeated below. The SQLite
+# store makes fewer statements than store calls where Storm already holds the
+# loaded object.
+BenchmarkedView = namedtuple("BenchmarkedView",
+        ["name", "url_name", "queries", "store_calls", "statements"])
+VIEWS = [
+    # queries: votes, favorites and tags of the page, months
+    # store: list, page of threads, thread count, summaries, participant
+    #   count, email ids and starting emails of the page
+    BenchmarkedView("archives", "archives_with_month", 6, 7, 7),
+    # queries: karma, tags, tag stats
+    # store: list, summaries, messages of the last month
+    BenchmarkedView("overview", "list_overview", 5, 3, 3),
+    # queries: vote on the starting email, votes on the replies, favorite,
+    #   tags, saving the read threads in the session (check and update)
+    # store: thread, thread dates and neighbors' summaries of the thread
+    #   index, starting email and its attachments, email count of the layout
+    #   cache key, layout, replies and their attachments, participants, last
+    #   email, list
+    BenchmarkedView("thread", "thread", 8, 12, 11),
+    # queries: vote
+    # store: message, attachments, list
+    BenchmarkedView("message", "message_index", 3, 3, 3),
+    # queries: votes, favorites and tags of the page
+    # store: list, search, sorted thread ids, participant count, existing
+    #   threads of the page, summaries, email ids and starting emails
+    BenchmarkedView("search", "search_keyword", 5, 8, 8),
+    # queries: tagged threads, votes, favorites and tags of the page
+    # store: list, sorted thread ids, participant count, existing threads of
+    #   the page, summaries, email ids and starting emails
+    BenchmarkedView("tag", "search_tag", 6, 7, 7),
+    # queries: profile, votes, favorites
+    # store: voted messages, favorite threads and their starting emails
+    BenchmarkedView("profile", "user_profile", 5, 3, 3),
+    # store: lists
+    BenchmarkedView("api_list", "api_list", 2, 1, 1),
+    # store: thread, starting email and subject, email ids, participants
+    BenchmarkedView("api_thread", "api_thread", 2, 5, 3),
+    # store: message
+    BenchmarkedView("api_email", "api_email", 2, 1, 1),
+    # store: search
+    BenchmarkedView("api_search", "api_search", 2, 1, 1),
+]
+
+ViewResult = namedtuple("ViewResult", ["view", "status", "latencies",
+                                       "queries", "store_calls", "error"])
+
+
+class StatementCounter(object):
+    """Storm tracer counting the SQL statements, like the FakeStore counts
+    its calls."""
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+
+    def connection_raw_execute(self, connection, raw_cursor, statement,
+                               params):
+        self.calls["statements"] += 1
+
+
+class BenchmarkArchive(object):
+    """
+    A generated archive and the database objects of the benchmark user.
+
+    :param size: The number of messages in the archive.
+    :param seed: The random seed of the generator.
+    :param sqlite: Hold the archive in an in-memory SQLite KittyStore instead
+        of a FakeStore.
+    """
+
+    def __init__(self, size, seed=42, sqlite=False):
+        self.mlist = MailingList(LIST_NAME, u"Bench", u"[Bench] ")
+        # end the archive today, so that the overview is not empty
+        start = datetime.datetime.now() - datetime.timedelta(days=DAYS)
+        threads_per_day = max(1, size / MESSAGES_PER_THREAD / DAYS)
+        corpus = CorpusGenerator(size, seed=seed, start=start,
+                                 threads_per_day=threads_per_day)
+        self.sqlite = sqlite
+        if sqlite:
+            self.store = kittystore.get_store("sqlite:", debug=False)
+            for num, message in enumerate(corpus):
+                self.store.add_to_list(self.mlist, to_message(message))
+                if num % 100 == 99:
+                    self.store.commit()
+            self.store.commit()
+        else:
+            self.store = FakeStore()
+            self.store.add_corpus(self.mlist, corpus)
+        self.threads = self.store.get_threads(LIST_NAME, start,
+                datetime.datetime.now() + datetime.timedelta(days=DAYS))
+        MonthsStage().rebuild(self.store, LIST_NAME)
+        self.user = User.objects.create_user(USERNAME, "bench@example.com",
+                                             PASSWORD)
+        UserProfile.objects.get_or_create(user=self.user)
+        for thread in self.threads[:20]:
+            Rating.objects.create(list_address=LIST_NAME,
+                    messageid=thread.starting_email.message_id_hash,
+                    user=self.user, vote=1)
+            Favorite.objects.create(list_address=LIST_NAME,
+                    threadid=thread.thread_id, user=self.user)
+            Tag.objects.create(list_address=LIST_NAME,
+                    threadid=thread.thread_id, tag="bench")
+
+    def count_calls(self):
+        """Start counting the store calls, or the SQL statements in an SQLite
+        store.
+
+        :returns: A dict of counters, stop counting with :meth:`close`.
+        """
+        if not self.sqlite:
+            self.store.calls.clear()
+            return self.store.calls
+        self._counter = StatementCounter()
+        install_tracer(self._counter)
+        return self._counter.calls
+
+    def close(self):
+        if self.sqlite:
+            remove_tracer(getattr(self, "_counter", None))
+        self.store.close()
+
+    def client(self):
+        """Return a test client logged in as the benchmark user."""
+        client = Client()
+        client.login(username=USERNAME, password=PASSWORD)
+        return client
+
+    def urls(self):
+        """Return the URL of each benchmarked view."""
+        thread = max(self.threads, key=len)
+        email = thread.starting_email
+        kwargs = {
+            "archives_with_month": {"year": email.date.year,
+                                    "month": email.date.month},
+            "thread": {"threadid": thread.thread_id},
+            "message_index": {"message_id_hash": email.message_id_hash},
+            "search_keyword": {"target": "Subject",
+                               "keyword": thread.subject.split()[0]},
+            "search_tag": {"tag": "bench"},
+            "user_profile": {},
+            "api_list": {},
+            "api_thread": {"threadid": thread.thread_id},
+            "api_email": {"messageid": email.message_id},
+            "api_search": {"field": "Subject",
+                           "keyword": thread.subject.split()[0]},
+        }
+        urls = {}
+        for view in VIEWS:
+            view_kwargs = kwargs.get(view.url_name, {})
+            if view.url_name not in ("user_profile", "api_list"):
+                view_kwargs["mlist_fqdn"] = LIST_NAME
+            urls[view.name] = reverse(view.url_name, kwargs=view_kwargs)
+        return urls
+
+
+def percentile(values, percent):
+    """Return the given percentile of a list of values."""
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def run_view(client, store, calls, view, url, requests=20):
+    """Request a view several times.
+
+    The first request, which fills the caches, is not timed, but its queries
+    are counted.
+
+    :param calls: The counters of the store calls, see
+        :meth:`BenchmarkArchive.count_calls`.
+    :returns: A :class:`ViewResult`, with the maximum numbers of queries and
+        store calls per request.
+    """
+    latencies = []
+    max_queries = max_calls = 0
+    status = error = None
+    old_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+        for num in range(requests + 1):
+            calls_before = sum(calls.values())
+            start = time.time()
+            # the queries log is reset at the start of each request
+            try:
+                response = client.get(url, **{"kittystore.store": store})
+            except Exception, e:
+                status = 500
+                error = "%s: %s" % (e.__class__.__name__, e)
+                break
+            if num > 0:
+                latencies.append(time.time() - start)
+            status = response.status_code
+            max_queries = max(max_queries, len(connection.queries))
+            max_calls = max(max_calls,
+                            sum(calls.values()) - calls_before)
+    finally:
+        connection.use_debug_cursor = old_debug_cursor
+    return ViewResult(view, status, latencies, max_queries, max_calls, error)
+
+
+def store_budget(view, sqlite=False):
+    """Return the budget of store calls of a view, or of SQL statements with
+    an SQLite store."""
+    return view.statements if sqlite else view.store_calls
+
+
+def over_budget(result, sqlite=False):
+    """Return True if a view made more queries or store calls than its
+    budget, or did not answer."""
+    return (result.status != 200
+            or result.queries > result.view.queries
+            or result.store_calls > store_budget(result.view, sqlite))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+In-process caches, for the data which is expensive to compute and never
+changes, such as the rendered message bodies.
+"""
+
+import threading
+from collections import OrderedDict
+
+from django.core.cache import get_cache
+
+
+# The longest relative timeout memcached accepts
+MAX_TIMEOUT = 60 * 60 * 24 * 30
+
+
+class LRUCache(object):
+    """
+    A cache holding at most ``maxsize`` items, dropping the least recently
+    used ones first. It can be shared between threads.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value # move to the end
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredCache(object):
+    """
+    An in-process LRU cache, backed by an optional Django cache shared
+    between the processes.
+
+    :param maxsize: The size of the in-process cache.
+    :param backend: The name of the shared cache in the ``CACHES`` setting,
+        or None to only cache in the process.
+    :param timeout: The timeout of the values in the shared cache. The
+        values are supposed to never change, the default is as long as
+        possible.
+    """
+
+    def __init__(self, maxsize=1000, backend=None, timeout=MAX_TIMEOUT):
+        self.local = LRUCache(maxsize)
+        self.timeout = timeout
+        if backend is not None:
+            self.shared = get_cache(backend)
+        else:
+            self.shared = None
+
+    def get(self, key, default=None):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        if value is None:
+            return default
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value, self.timeout)
+
+    def clear(self):
+        """Clear the in-process cache (the shared cache is left alone)."""
+        self.local.clear()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Recent threads of a mailing-list grouped by category, a category being a tag
+set on the thread.
+
+The grouping is cached per list and updated incrementally when a tag is
+added or when a message is archived in a tagged thread. Since the archiver
+runs in Mailman's process, a cache backend shared between processes (such as
+memcached) is needed for the incremental updates to be visible in the web
+interface.
+"""
+
+import datetime
+from collections import namedtuple
+
+from django.core.cache import cache
+
+from hyperkitty.models import Tag
+from hyperkitty.lib.pipeline import Stage
+from hyperkitty.lib.metrics import record_cache_lookup
+from hyperkitty.lib.queries import CHUNK_SIZE
+
+
+# Threads active in this period are listed in their categories
+RECENT_PERIOD = datetime.timedelta(days=31)
+THREADS_PER_CATEGORY = 5
+CACHE_TIMEOUT = 60 * 60 * 24
+
+CategoryThread = namedtuple("CategoryThread",
+                            ["thread_id", "subject", "date_active"])
+
+
+def _cache_key(list_name):
+    return "hyperkitty:categories:%s" % list_name
+
+
+def _is_recent(date_active):
+    return date_active >= datetime.datetime.utcnow() - RECENT_PERIOD
+
+
+def compute_categories(list_name, threads):
+    """Group the recent threads by tag, with a query on their tags.
+
+    :param list_name: The fully qualified list name.
+    :param threads: The recent threads of the list.
+    :returns: A dict mapping the tags to the dicts of the threads they are
+        set on, indexed by thread id.
+    """
+    recent = dict( (t.thread_id, CategoryThread(t.thread_id, t.subject,
+                                                t.date_active))
+                   for t in threads )
+    categories = {}
+    # The tags and the threads may not be in the same database, only load
+    # the tags of the recent threads
+    thread_ids = recent.keys()
+    for index in range(0, len(thread_ids), CHUNK_SIZE):
+        for tag, thread_id in Tag.objects.filter(list_address=list_name,
+                    threadid__in=thread_ids[index:index+CHUNK_SIZE]
+                ).values_list("tag", "threadid"):
+            categories.setdefault(tag, {})[thread_id] = recent[thread_id]
+    return categories
+
+
+def get_threads_per_category(list_name, threads):
+    """
+    Return the most recently active threads of each category, from the cache
+    or computed from the given recent threads of the list.
+    """
+    categories = cache.get(_cache_key(list_name))
+    record_cache_lookup("categories", categories is not None)
+    if categories is None:
+        categories = compute_categories(list_name, threads)
+        cache.set(_cache_key(list_name), categories, CACHE_TIMEOUT)
+    threads_per_category = {}
+    for tag, category_threads in categories.items():
+        category_threads = [ t for t in category_threads.values()
+                             if _is_recent(t.date_active) ]
+        if not category_threads:
+            continue
+        category_threads.sort(key=lambda t: t.date_active, reverse=True)
+        threads_per_category[tag] = category_threads[:THREADS_PER_CATEGORY]
+    return threads_per_category
+
+
+def update_categories(list_name, thread, tags):
+    """Add or refresh a thread in the cached categories.
+
+    :param list_name: The fully qualified list name.
+    :param thread: The thread, as returned by the store.
+    :param tags: The tags set on the thread.
+    """
+    categories = cache.get(_cache_key(list_name))
+    if categories is None:
+        return # will be computed on the next read
+    if not _is_recent(thread.date_active):
+        return
+    category_thread = CategoryThread(thread.thread_id, thread.subject,
+                                     thread.date_active)
+    for tag in tags:
+        categories.setdefault(tag, {})[thread.thread_id] = category_thread
+    cache.set(_cache_key(list_name), categories, CACHE_TIMEOUT)
+
+
+class CategoriesStage(Stage):
+    """
+    Archiver pipeline stage refreshing the tagged threads which received new
+    messages.
+    """
+
+    def process_batch(self, store, list_name, emails):
+        if cache.get(_cache_key(list_name)) is None:
+            return
+        thread_ids = set(email.thread_id for email in emails)
+        tags = {}
+        for tag, thread_id in Tag.objects.filter(list_address=list_name,
+                    threadid__in=thread_ids).values_list("tag", "threadid"):
+            tags.setdefault(thread_id, []).append(tag)
+        for thread_id, thread_tags in tags.items():
+            thread = store.get_thread(list_name, thread_id)
+            if thread is not None:
+                update_categories(list_name, thread, thread_tags)
+
+    def rebuild(self, store, list_name):
+        cache.delete(_cache_key(list_name))
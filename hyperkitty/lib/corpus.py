@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Generator of synthetic mailing-list archives, for benchmarks and load tests
+
+The messages are generated in date order, as a stream, so that archives of
+several millions of messages can be fed to a store without keeping them in
+memory. The generation is seeded: the same parameters always produce the
+same archive.
+
+The threads sizes follow a heavy-tailed distribution (most threads get no
+reply, a few get hundreds), the replies tend to answer the latest message of
+the thread, the replies quote their parent message, and a few messages carry
+attachments.
+"""
+
+import heapq
+import random
+import datetime
+from collections import namedtuple
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+from email.utils import formataddr, formatdate
+from calendar import timegm
+
+
+CorpusMessage = namedtuple("CorpusMessage", ["message_id", "in_reply_to",
+        "sender_name", "sender_email", "subject", "content", "date",
+        "timezone", "attachments"])
+
+CorpusAttachment = namedtuple("CorpusAttachment",
+        ["name", "content_type", "encoding", "content"])
+
+WORDS = (u"the a of to and in is it for that this on with be as not have "
+         u"package update build release kernel python fix review meeting "
+         u"proposal guidelines bug spec mirror branch rawhide patch upstream "
+         u"maintainer dependency compose test install repository policy "
+         u"feature change schedule vote ticket server").split()
+
+# Maximum number of messages in a thread
+MAX_THREAD_SIZE = 500
+# Shape of the threads size distribution, lower means longer threads
+THREAD_SIZE_SHAPE = 1.6
+# Probability that a reply answers the latest message of the thread
+REPLY_TO_LATEST = 0.6
+ATTACHMENT_RATE = 0.03
+BINARY = "".join(chr(i) for i in range(256)) * 80
+TIMEZONES = (-480, -420, -300, -240, 0, 60, 120, 330, 480, 540)
+
+
+class CorpusGenerator(object):
+    """
+    Generate the messages of a mailing-list archive.
+
+    :param size: The number of messages to generate.
+    :param seed: The random seed.
+    :param start: The date of the first thread.
+    :param senders: The number of distinct senders.
+    :param threads_per_day: The number of new threads per day.
+    """
+
+    def __init__(self, size, seed=42, start=datetime.datetime(2010, 1, 1),
+                 senders=500, threads_per_day=20):
+        self.size = size
+        self.seed = seed
+        self.start = start
+        self.senders = senders
+        self.threads_per_day = threads_per_day
+        self._rng = random.Random(seed)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        self._rng.seed(self.seed)
+        # the replies are generated with their thread and emitted in date
+        # order: only the threads still active are kept in memory
+        pending = []
+        thread_date = self.start
+        generated = 0
+        thread_num = 0
+        while generated < self.size:
+            thread_date += datetime.timedelta(
+                    days=self._rng.expovariate(self.threads_per_day))
+            while pending and pending[0][0] <= thread_date:
+                yield heapq.heappop(pending)[2]
+            thread_size = min(self._thread_size(), self.size - generated)
+            for order, message in enumerate(self._thread(
+                        thread_num, thread_date, thread_size)):
+                heapq.heappush(pending, (message.date, (thread_num, order),
+                                         message))
+            generated += thread_size
+            thread_num += 1
+        while pending:
+            yield heapq.heappop(pending)[2]
+
+    def _thread_size(self):
+        return min(int(self._rng.paretovariate(THREAD_SIZE_SHAPE)),
+                   MAX_THREAD_SIZE)
+
+    def _sender(self):
+        # a few senders write most of the messages
+        num = min(int(self._rng.paretovariate(1.0)) - 1, self.senders - 1)
+        return u"Sender %d" % num, u"sender%d@example.com" % num
+
+    def _sentence(self, length):
+        return u" ".join(self._rng.choice(WORDS) for i in range(length))
+
+    def _content(self, parent=None):
+        lines = []
+        if parent is not None:
+            lines.append(u"On %s, %s wrote:" % (
+                         parent.date.strftime("%Y-%m-%d"), parent.sender_name))
+            quoted = [ l for l in parent.content.split(u"\n")
+                       if l and not l.startswith(u"-- ") ]
+            first = self._rng.randint(0, max(len(quoted) - 1, 0))
+            for line in quoted[first:first+self._rng.randint(1, 8)]:
+                lines.append(u"> " + line)
+            lines.append(u"")
+        for paragraph in range(self._rng.randint(1, 4)):
+            lines.extend(self._sentence(self._rng.randint(5, 15))
+                         for i in range(self._rng.randint(1, 5)))
+            if self._rng.random() < 0.2:
+                lines.append(u"See http://example.com/%s for details"
+                             % self._rng.choice(WORDS))
+            lines.append(u"")
+        return u"\n".join(lines)
+
+    def _attachments(self):
+        if self._rng.random() >= ATTACHMENT_RATE:
+            return []
+        if self._rng.random() < 0.7:
+            content = "\n".join("+ %s" % self._sentence(8).encode("ascii")
+                                for i in range(self._rng.randint(5, 200)))
+            return [CorpusAttachment(u"fix.patch", u"text/x-diff", None,
+                                     content)]
+        offset = self._rng.randint(0, 255)
+        content = BINARY[offset:offset+self._rng.randint(100, 20000)]
+        return [CorpusAttachment(u"screenshot.png", u"image/png", None,
+                                 content)]
+
+    def _thread(self, thread_num, date, size):
+        subject = self._sentence(self._rng.randint(2, 10)).capitalize()
+        messages = []
+        for num in range(size):
+            if messages:
+                if self._rng.random() < REPLY_TO_LATEST:
+                    parent = messages[-1]
+                else:
+                    parent = self._rng.choice(messages)
+                date = max(date, parent.date) + datetime.timedelta(
+                        minutes=self._rng.expovariate(1 / 240.0))
+                in_reply_to = parent.message_id
+                msg_subject = u"Re: " + subject
+            else:
+                parent = in_reply_to = None
+                msg_subject = subject
+            sender_name, sender_email = self._sender()
+            messages.append(CorpusMessage(
+                    u"%d.%d.%d@corpus.example.com" % (self.seed, thread_num,
+                                                      num),
+                    in_reply_to, sender_name, sender_email, msg_subject,
+                    self._content(parent), date.replace(microsecond=0),
+                    self._rng.choice(TIMEZONES), self._attachments()))
+        return messages
+
+
+def to_message(corpus_message):
+    """Convert a generated message to an email.message.Message object, to
+    archive it in a KittyStore or to write it to a mailbox."""
+    body = MIMEText(corpus_message.content.encode("utf-8"), _charset="utf-8")
+    if corpus_message.attachments:
+        message = MIMEMultipart()
+        message.attach(body)
+        for attachment in corpus_message.attachments:
+            maintype, subtype = attachment.content_type.split("/", 1)
+            if maintype == "text":
+                part = MIMEText(attachment.content, subtype)
+            else:
+                part = MIMEApplication(attachment.content, subtype)
+                part.replace_header("Content-Type", attachment.content_type)
+            part.add_header("Content-Disposition", "attachment",
+                            filename=attachment.name)
+            message.attach(part)
+    else:
+        message = body
+    message["Message-ID"] = "<%s>" % corpus_message.message_id
+    if corpus_message.in_reply_to is not None:
+        message["In-Reply-To"] = "<%s>" % corpus_message.in_reply_to
+    message["From"] = formataddr((corpus_message.sender_name,
+                                  corpus_message.sender_email))
+    message["Subject"] = corpus_message.subject.encode("utf-8")
+    message["Date"] = formatdate(timegm(corpus_message.date.timetuple()))
+    return message
@@ -0,0 +1,609 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+In-memory implementation of the KittyStore API, for benchmarks and tests
+
+It implements the store methods used by the views, and the batch queries of
+:mod:`hyperkitty.lib.queries` and :mod:`hyperkitty.lib.threads`, without any
+database. The number of calls to each method is counted in the ``calls``
+attribute, along with the accesses to the attributes of the emails and
+threads which KittyStore loads with a query.
+"""
+
+import bisect
+import datetime
+from collections import defaultdict
+from functools import wraps
+from email.utils import formataddr
+
+from kittystore.utils import get_message_id_hash, get_ref, parseaddr, \
+        header_to_unicode, parsedate
+from kittystore.scrub import Scrubber
+
+from hyperkitty.lib.threads import LayoutEntry
+from hyperkitty.lib.queries import ThreadSummary, AttachmentInfo
+
+
+class ResultList(list):
+    """A list with the ``count()`` method of Storm's result sets."""
+
+    def count(self):
+        return len(self)
+
+    def first(self):
+        return self[0] if self else None
+
+
+class FakeList(object):
+
+    description = None
+
+    def __init__(self, name, display_name=None, subject_prefix=None):
+        self.name = unicode(name)
+        self.display_name = display_name
+        self.subject_prefix = subject_prefix
+
+
+class FakeAttachment(object):
+
+    def __init__(self, list_name, message_id, counter, name, content_type,
+                 encoding, content):
+        self.list_name = list_name
+        self.message_id = message_id
+        self.counter = counter
+        self.name = name
+        self.content_type = content_type
+        self.encoding = encoding
+        self.content = content
+        self.size = len(content)
+
+
+class LazyLoaded(object):
+    """
+    Base class of the objects whose attributes KittyStore loads lazily, with
+    a query on each access. The accesses are counted in the store's
+    ``calls``, for the views doing such a query per thread or per email to be
+    noticed.
+    """
+
+    def __init__(self, calls=None):
+        self._calls = calls
+
+    def _loaded(self, attribute):
+        if self._calls is not None:
+            self._calls["%s.%s" % (self.__class__.__name__, attribute)] += 1
+
+
+class FakeEmail(LazyLoaded):
+
+    path = None
+
+    def __init__(self, list_name, message_id, calls=None):
+        LazyLoaded.__init__(self, calls)
+        self.list_name = unicode(list_name)
+        self.message_id = unicode(message_id)
+        self.message_id_hash = unicode(get_message_id_hash(self.message_id))
+        self.sender_name = self.sender_email = None
+        self.subject = self.content = None
+        self.date = None
+        self.timezone = 0
+        self.in_reply_to = None
+        self.thread_id = None
+        self._thread = None
+        self.archived_date = datetime.datetime.now()
+        self.thread_depth = 0
+        self.thread_order = 0
+        self._attachments = ResultList()
+
+    @property
+    def thread(self):
+        self._loaded("thread")
+        return self._thread
+
+    @property
+    def attachments(self):
+        self._loaded("attachments")
+        return self._attachments
+
+    @property
+    def full(self):
+        """A minimal version of the original message."""
+        self._loaded("full")
+        return ("Message-ID: <%s>\nFrom: %s\nSubject: %s\n\n%s" % (
+                self.message_id,
+                formataddr((self.sender_name, self.sender_email)),
+                self.subject, self.content)).encode("utf-8")
+
+
+class FakeThread(LazyLoaded):
+
+    def __init__(self, list_name, thread_id, date_active=None, calls=None):
+        LazyLoaded.__init__(self, calls)
+        self.list_name = unicode(list_name)
+        self.thread_id = unicode(thread_id)
+        self.date_active = date_active
+        self._emails = []
+        self._ordered = True
+
+    def _add(self, email):
+        self._emails.append(email)
+        self._emails.sort(key=lambda e: e.date)
+        self._ordered = False
+
+    @property
+    def emails(self):
+        self._loaded("emails")
+        return ResultList(self._emails)
+
+    @property
+    def emails_by_reply(self):
+        self._loaded("emails_by_reply")
+        return ResultList(self._by_reply())
+
+    def _by_reply(self):
+        if not self._ordered:
+            self._compute_order_and_depth()
+        return sorted(self._emails, key=lambda e: e.thread_order)
+
+    def _compute_order_and_depth(self):
+        # same algorithm as kittystore.analysis, without networkx
+        children = defaultdict(list)
+        for email in self._emails:
+            if email.in_reply_to is not None:
+                children[email.in_reply_to].append(email)
+        order = 0
+        stack = [ (self._starting_email(), 0) ]
+        while stack:
+            email, depth = stack.pop()
+            email.thread_order = order
+            email.thread_depth = depth
+            order += 1
+            stack.extend( (child, depth + 1) for child
+                          in reversed(children[email.message_id]) )
+        self._ordered = True
+
+    def _starting_email(self):
+        for email in self._emails:
+            if email.in_reply_to is None:
+                return email
+        return self._emails[0] if self._emails else None
+
+    @property
+    def starting_email(self):
+        self._loaded("starting_email")
+        return self._starting_email()
+
+    @property
+    def last_email(self):
+        self._loaded("last_email")
+        return self._emails[-1] if self._emails else None
+
+    @property
+    def subject(self):
+        self._loaded("subject")
+        return self._starting_email().subject
+
+    @property
+    def participants(self):
+        self._loaded("participants")
+        participants = []
+        for email in self._emails:
+            sender = (email.sender_name, email.sender_email)
+            if sender not in participants:
+                participants.append(sender)
+        return participants
+
+    @property
+    def email_ids(self):
+        self._loaded("email_ids")
+        return [ email.message_id for email in self._emails ]
+
+    @property
+    def email_id_hashes(self):
+        self._loaded("email_id_hashes")
+        return [ email.message_id_hash for email in self._emails ]
+
+    def __len__(self):
+        self._loaded("__len__")
+        return len(self._emails)
+
+
+def counted(method):
+    """Count the calls to a store method."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.calls[method.__name__] += 1
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class FakeStore(object):
+    """
+    An in-memory KittyStore.
+
+    Fill it with :meth:`add_to_list`, like a real store, or much faster with
+    the messages of a :class:`hyperkitty.lib.corpus.CorpusGenerator` and
+    :meth:`add_corpus`.
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self._lists = {}
+        self._emails = {} # (list name, message id) -> email
+        self._hashes = {} # (list name, message id hash) -> email
+        self._threads = {} # (list name, thread id) -> thread
+        self._dated = defaultdict(list) # list name -> [(date, message id)]
+        self._activity = None # list name -> (dates active, threads)
+
+    # Filling
+
+    def _add(self, list_name, message_id, in_reply_to, sender_name,
+             sender_email, subject, content, date, timezone, attachments):
+        list_name = unicode(list_name)
+        if (list_name, message_id) in self._emails:
+            return self._emails[(list_name, message_id)].message_id_hash
+        email = FakeEmail(list_name, message_id, self.calls)
+        parent = self._emails.get((list_name, in_reply_to))
+        if parent is None:
+            thread_id = email.message_id_hash
+        else:
+            thread_id = parent.thread_id
+        email.in_reply_to = in_reply_to
+        email.thread_id = thread_id
+        email.sender_name = sender_name
+        email.sender_email = sender_email
+        email.subject = subject
+        email.content = content
+        email.date = date
+        email.timezone = timezone
+        for attachment in attachments:
+            email._attachments.append(FakeAttachment(list_name, message_id,
+                                                    *attachment))
+        thread = self._threads.get((list_name, thread_id))
+        if thread is None:
+            thread = FakeThread(list_name, thread_id, calls=self.calls)
+            self._threads[(list_name, thread_id)] = thread
+        thread.date_active = max(date, thread.date_active or date)
+        thread._add(email)
+        email._thread = thread
+        self._emails[(list_name, message_id)] = email
+        self._hashes[(list_name, email.message_id_hash)] = email
+        bisect.insort(self._dated[list_name], (date, message_id))
+        self._activity = None
+        return email.message_id_hash
+
+    def add_list(self, name, display_name=None, subject_prefix=None):
+        mlist = self._lists.get(name)
+        if mlist is None:
+            mlist = self._lists[name] = FakeList(name)
+        mlist.display_name = display_name
+        mlist.subject_prefix = subject_prefix
+        return mlist
+
+    def add_to_list(self, mlist, message):
+        """Add a message to a list, see KittyStore's method."""
+        self.add_list(mlist.fqdn_listname, mlist.display_name,
+                      mlist.subject_prefix)
+        if not message.has_key("Message-Id"):
+            raise ValueError("No 'Message-Id' header in email", message)
+        message_id = unicode(message["Message-Id"].strip(" <>"))
+        sender_name, sender_email = parseaddr(message["From"])
+        date = parsedate(message.get("Date")) or datetime.datetime.now()
+        timezone = 0
+        if date.tzinfo is not None:
+            offset = date.utcoffset()
+            timezone = (offset.days * 24 * 60 * 60 + offset.seconds) / 60
+            date = (date - offset).replace(tzinfo=None)
+        content, attachments = Scrubber(mlist.fqdn_listname, message).scrub()
+        return self._add(mlist.fqdn_listname, message_id, get_ref(message),
+                         header_to_unicode(sender_name).strip(),
+                         unicode(sender_email).strip(),
+                         header_to_unicode(message.get("Subject")), content,
+                         date, timezone, attachments)
+
+    def add_corpus(self, mlist, messages):
+        """Add generated messages to a list.
+
+        :param mlist: The IMailingList object.
+        :param messages: An iterable of
+            :class:`hyperkitty.lib.corpus.CorpusMessage`.
+        :returns: The number of added messages.
+        """
+        self.add_list(mlist.fqdn_listname, mlist.display_name,
+                      mlist.subject_prefix)
+        count = 0
+        for message in messages:
+            # KittyStore numbers the attachments by their MIME part: the
+            # multipart container and the text body come first.
+            attachments = [ (counter, ) + tuple(attachment) for counter,
+                            attachment in enumerate(message.attachments, 2) ]
+            self._add(mlist.fqdn_listname, *message[:-1],
+                      attachments=attachments)
+            count += 1
+        return count
+
+    # KittyStore API
+
+    @counted
+    def get_list(self, list_name):
+        return self._lists.get(list_name)
+
+    @counted
+    def get_lists(self):
+        return [ self._lists[name] for name in sorted(self._lists) ]
+
+    @counted
+    def get_list_names(self):
+        return sorted(self._lists)
+
+    @counted
+    def get_list_size(self, list_name):
+        return len(self._dated[list_name])
+
+    @counted
+    def get_message_by_hash_from_list(self, list_name, message_id_hash):
+        return self._hashes.get((list_name, message_id_hash))
+
+    @counted
+    def get_message_by_id_from_list(self, list_name, message_id):
+        return self._emails.get((list_name, message_id))
+
+    @counted
+    def is_message_in_list(self, list_name, message_id):
+        return (list_name, message_id) in self._emails
+
+    @counted
+    def get_message_by_number(self, list_name, num):
+        try:
+            return self._emails[(list_name, self._dated[list_name][num][1])]
+        except IndexError:
+            return None
+
+    def _between(self, list_name, start, end):
+        dated = self._dated[list_name]
+        return dated[bisect.bisect_left(dated, (start, )):
+                     bisect.bisect_left(dated, (end, ))]
+
+    @counted
+    def get_messages(self, list_name, start, end):
+        return [ self._emails[(list_name, message_id)] for date, message_id
+                 in reversed(self._between(list_name, start, end)) ]
+
+    @counted
+    def get_thread(self, list_name, thread_id):
+        return self._threads.get((list_name, thread_id))
+
+    @counted
+    def get_threads(self, list_name, start, end):
+        threads = set( self._emails[(list_name, message_id)]._thread
+                       for date, message_id in self._between(list_name,
+                                                             start, end) )
+        # a thread is listed in the period of its last activity
+        threads = [ t for t in threads if start <= t.date_active < end ]
+        return sorted(threads, key=lambda t: t.date_active, reverse=True)
+
+    @counted
+    def get_start_date(self, list_name):
+        dated = self._dated[list_name]
+        return dated[0][0] if dated else None
+
+    @counted
+    def get_thread_neighbors(self, list_name, thread_id):
+        if self._activity is None:
+            self._activity = {}
+            by_list = defaultdict(list)
+            for (name, _thread_id), thread in self._threads.iteritems():
+                by_list[name].append(thread)
+            for name, threads in by_list.iteritems():
+                threads.sort(key=lambda t: t.date_active)
+                self._activity[name] = (
+                        [ t.date_active for t in threads ], threads)
+        dates, threads = self._activity.get(list_name, ([], []))
+        thread = self._threads[(list_name, thread_id)]
+        before = bisect.bisect_left(dates, thread.date_active)
+        after = bisect.bisect_right(dates, thread.date_active)
+        prev_thread = threads[before - 1] if before > 0 else None
+        next_thread = threads[after] if after < len(threads) else None
+        return (prev_thread, next_thread)
+
+    @counted
+    def get_attachment_by_counter(self, list_name, message_id, counter):
+        email = self._emails.get((list_name, message_id))
+        if email is None:
+            return None
+        for attachment in email._attachments:
+            if attachment.counter == counter:
+                return attachment
+
+    def _search(self, list_name, keyword, fields):
+        keyword = keyword.lower()
+        emails = [ email for (name, _msgid), email in self._emails.iteritems()
+                   if name == list_name and
+                   any(keyword in (getattr(email, field) or u"").lower()
+                       for field in fields) ]
+        return ResultList(sorted(emails, key=lambda e: e.date, reverse=True))
+
+    @counted
+    def search_list_for_content(self, list_name, keyword):
+        return self._search(list_name, keyword, ["content"])
+
+    @counted
+    def search_list_for_content_subject(self, list_name, keyword):
+        return self._search(list_name, keyword, ["content", "subject"])
+
+    @counted
+    def search_list_for_sender(self, list_name, keyword):
+        return self._search(list_name, keyword,
+                            ["sender_name", "sender_email"])
+
+    @counted
+    def search_list_for_subject(self, list_name, keyword):
+        return self._search(list_name, keyword, ["subject"])
+
+    # Batch queries, see hyperkitty.lib.queries
+
+    def _threads_by_ids(self, list_name, thread_ids):
+        threads = [ self._threads[(list_name, thread_id)]
+                    for thread_id in thread_ids
+                    if (list_name, thread_id) in self._threads ]
+        return sorted(threads, key=lambda t: t.date_active, reverse=True)
+
+    @counted
+    def get_threads_by_ids(self, list_name, thread_ids):
+        return self._threads_by_ids(list_name, thread_ids)
+
+    @counted
+    def get_existing_thread_ids(self, list_name, thread_ids):
+        return [ thread_id for thread_id in thread_ids
+                 if (list_name, thread_id) in self._threads ]
+
+    @counted
+    def sort_thread_ids(self, list_name, thread_ids):
+        return [ t.thread_id for t in
+                 self._threads_by_ids(list_name, thread_ids) ]
+
+    @counted
+    def get_thread_dates(self, list_name, since=None):
+        return [ (t.date_active, t.thread_id)
+                 for (name, _thread_id), t in self._threads.iteritems()
+                 if name == list_name
+                    and (since is None or t.date_active >= since) ]
+
+    @counted
+    def get_threads_page(self, list_name, start, end, before=None,
+                         after=None, limit=10):
+        keys = sorted( ((t.date_active, t.thread_id), t)
+                       for (name, _thread_id), t in self._threads.iteritems()
+                       if name == list_name
+                          and start <= t.date_active < end )
+        if after is None:
+            threads = [ t for key, t in reversed(keys)
+                        if before is None or key < before ][:limit+1]
+        else:
+            threads = [ t for key, t in keys if key > after ][:limit+1]
+            threads.reverse()
+        return threads
+
+    @counted
+    def count_threads(self, list_name, start, end):
+        return len([ t for (name, _thread_id), t in self._threads.iteritems()
+                     if name == list_name and start <= t.date_active < end ])
+
+    @counted
+    def get_thread_at(self, list_name, start, end, offset):
+        keys = sorted( ((t.date_active, t.thread_id), t)
+                       for (name, _thread_id), t in self._threads.iteritems()
+                       if name == list_name
+                          and start <= t.date_active < end )
+        keys.reverse()
+        return keys[offset][1] if 0 <= offset < len(keys) else None
+
+    @counted
+    def get_thread_summaries(self, list_name, thread_ids=None, start=None,
+                             end=None):
+        if thread_ids is None:
+            threads = [ t for (name, _thread_id), t in self._threads.iteritems()
+                        if name == list_name ]
+        else:
+            threads = [ self._threads[(list_name, thread_id)]
+                        for thread_id in set(thread_ids)
+                        if (list_name, thread_id) in self._threads ]
+        summaries = [ ThreadSummary(t.thread_id, t._starting_email().subject,
+                          t.date_active, len(t._emails),
+                          len(set(e.sender_email for e in t._emails)))
+                      for t in threads
+                      if (start is None or t.date_active >= start)
+                         and (end is None or t.date_active < end) ]
+        summaries.sort(key=lambda t: (t.date_active, t.thread_id),
+                       reverse=True)
+        return summaries
+
+    @counted
+    def get_email_id_hashes(self, list_name, thread_ids):
+        hashes = {}
+        for thread_id in thread_ids:
+            thread = self._threads.get((list_name, thread_id))
+            hashes[thread_id] = [ e.message_id_hash for e in thread._emails
+                                ] if thread is not None else []
+        return hashes
+
+    @counted
+    def count_thread_participants(self, list_name, thread_ids):
+        senders = set()
+        for thread_id in thread_ids:
+            thread = self._threads.get((list_name, thread_id))
+            if thread is not None:
+                senders.update(e.sender_email for e in thread._emails)
+        return len(senders)
+
+    @counted
+    def count_participants(self, list_name, start, end):
+        return len(set( e.sender_email
+                        for (name, _thread_id), t in self._threads.iteritems()
+                        if name == list_name
+                           and start <= t.date_active < end
+                        for e in t._emails ))
+
+    @counted
+    def count_messages(self, list_name, start, end):
+        return len([ date for date, _message_id in self._dated[list_name]
+                     if start <= date < end ])
+
+    @counted
+    def get_messages_by_hashes(self, list_name, message_id_hashes):
+        return dict( (h, self._hashes[(list_name, h)])
+                     for h in message_id_hashes
+                     if (list_name, h) in self._hashes )
+
+    @counted
+    def get_attachments_by_ids(self, list_name, message_ids):
+        attachments = {}
+        for message_id in message_ids:
+            email = self._emails.get((list_name, message_id))
+            attachments[message_id] = [ AttachmentInfo(message_id, a.counter,
+                    a.name, a.content_type, a.size)
+                for a in (email._attachments if email is not None else []) ]
+        return attachments
+
+    @counted
+    def get_thread_layout(self, list_name, thread_id, sort_mode="thread"):
+        thread = self._threads[(list_name, thread_id)]
+        if sort_mode == "date":
+            return [ LayoutEntry(e.message_id_hash, 0)
+                     for e in thread._emails ]
+        return [ LayoutEntry(e.message_id_hash, e.thread_depth - 1)
+                 for e in thread._by_reply() ]
+
+    # Transactions
+
+    def flush(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Per-request timings of the store calls, the database queries and the template
+rendering, collected by :class:`hyperkitty.middleware.TimingMiddleware`.
+
+The store calls are timed by a proxy around the store, and the SQL statements
+that KittyStore sends to its own database by a Storm tracer, like the slow
+query log does. The Django queries are timed by a wrapper around the cursors
+of the connection, while the timings are recorded only: unlike the debug
+cursor, it does not keep the queries.
+
+The timings are recorded in a thread-local :class:`RequestTimings` object
+while a request is processed.
+"""
+
+import time
+import threading
+from collections import namedtuple
+
+from django.template.base import Template
+from django.db.backends import BaseDatabaseWrapper
+from storm.tracer import install_tracer
+
+from hyperkitty.lib.metrics import STORE_CALLS
+
+
+Event = namedtuple("Event", ["kind", "name", "start", "duration", "depth"])
+
+_local = threading.local()
+_store_db_tracer = None
+_store_db_lock = threading.Lock()
+
+
+class RequestTimings(object):
+    """The timed events of a request, in the order they ended."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.events = []
+        self.depth = 0
+
+    def add(self, kind, name, start, duration, depth=0):
+        """Record an event.
+
+        :param kind: "store", "storedb", "db" or "template".
+        :param name: The store method, the SQL statement or the template
+            name.
+        :param start: The start time, as returned by time.time(), or None if
+            it is unknown.
+        :param duration: The duration in seconds.
+        :param depth: The nesting level, for the included templates.
+        """
+        if start is not None:
+            start -= self.start
+        self.events.append(Event(kind, name, start, duration, depth))
+
+    def totals(self):
+        """Return the number of events and their total duration by kind.
+        The included templates are not counted twice. The "storedb"
+        statements are part of the "store" calls.
+
+        :returns: A dict mapping the kinds to (count, duration) couples.
+        """
+        totals = {}
+        for event in self.events:
+            if event.depth > 0:
+                continue
+            count, duration = totals.get(event.kind, (0, 0))
+            totals[event.kind] = (count + 1, duration + event.duration)
+        return totals
+
+    def by_name(self, kind):
+        """Return the number of events and their total duration by name.
+
+        :returns: A dict mapping the names to (count, duration) couples.
+        """
+        result = {}
+        for event in self.events:
+            if event.kind != kind:
+                continue
+            count, duration = result.get(event.name, (0, 0))
+            result[event.name] = (count + 1, duration + event.duration)
+        return result
+
+
+def start_recording():
+    """Start recording the timings of the current thread."""
+    _local.timings = RequestTimings()
+    return _local.timings
+
+
+def stop_recording():
+    """Stop recording and return the timings of the current thread, or None
+    if they were not recorded."""
+    timings = getattr(_local, "timings", None)
+    _local.timings = None
+    return timings
+
+
+def get_timings():
+    """Return the timings being recorded in the current thread, or None."""
+    return getattr(_local, "timings", None)
+
+
+class InstrumentedStore(object):
+    """A proxy to a KittyStore object, which times and counts the method
+    calls."""
+
+    def __init__(self, store):
+        self._store = store
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if not callable(attr):
+            return attr
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                STORE_CALLS.inc(method=name)
+                timings = get_timings()
+                if timings is not None:
+                    timings.add("store", name, start, time.time() - start)
+        return timed
+
+
+def instrument_templates():
+    """Time the rendering of the templates. It can be called several times."""
+    if getattr(Template.render, "instrumented", False):
+        return
+    original_render = Template.render
+    def render(self, context):
+        timings = get_timings()
+        if timings is None:
+            return original_render(self, context)
+        start = time.time()
+        timings.depth += 1
+        try:
+            return original_render(self, context)
+        finally:
+            timings.depth -= 1
+            timings.add("template", self.name or "<string>", start,
+                        time.time() - start, timings.depth)
+    render.instrumented = True
+    Template.render = render
+
+
+class TimedCursor(object):
+    """A wrapper around a Django cursor, which times the queries in the
+    timings of the current thread."""
+
+    def __init__(self, cursor, timings):
+        self.cursor = cursor
+        self.timings = timings
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def _timed(self, method, sql, params):
+        start = time.time()
+        try:
+            return method(sql, params)
+        finally:
+            self.timings.add("db", sql, start, time.time() - start)
+
+    def execute(self, sql, params=()):
+        return self._timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list)
+
+
+def instrument_db():
+    """Time the Django queries. It can be called several times."""
+    if getattr(BaseDatabaseWrapper.cursor, "instrumented", False):
+        return
+    original_cursor = BaseDatabaseWrapper.cursor
+    def cursor(self):
+        timings = get_timings()
+        if timings is None:
+            return original_cursor(self)
+        return TimedCursor(original_cursor(self), timings)
+    cursor.instrumented = True
+    BaseDatabaseWrapper.cursor = cursor
+
+
+class StoreDBTracer(object):
+    """Storm tracer timing the SQL statements of the store in the timings of
+    the current thread."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def connection_raw_execute(self, connection, raw_cursor, statement,
+                               params):
+        self._local.start = time.time()
+
+    def connection_raw_execute_success(self, connection, raw_cursor,
+                                       statement, params):
+        self._done(statement)
+
+    def connection_raw_execute_error(self, connection, raw_cursor,
+                                     statement, params, error):
+        self._done(statement)
+
+    def _done(self, statement):
+        start = getattr(self._local, "start", None)
+        if start is None:
+            return
+        self._local.start = None
+        timings = get_timings()
+        if timings is not None:
+            timings.add("storedb", statement, start, time.time() - start)
+
+
+def instrument_store_db():
+    """Time the SQL statements of the store. The tracer is global to the
+    process, it is only installed once."""
+    global _store_db_tracer
+    with _store_db_lock:
+        if _store_db_tracer is None:
+            _store_db_tracer = StoreDBTracer()
+            install_tracer(_store_db_tracer)
+    return _store_db_tracer
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Karma engine: the score of a sender is derived from the messages they posted
+and the votes on those messages. The scores are stored by list and by month
+in the :class:`~hyperkitty.models.SenderKarma` table, which is updated
+incrementally when a message is archived or a vote is cast.
+"""
+
+import datetime
+from collections import namedtuple, defaultdict
+
+from django.db.models import F, Sum
+
+from hyperkitty.models import SenderKarma, UserProfile, Rating
+from hyperkitty.lib import get_period, update_or_create
+from hyperkitty.lib.pipeline import Stage
+from hyperkitty.lib.queries import get_messages_by_hashes
+
+
+POST_POINTS = 1
+LIKE_POINTS = 2
+DISLIKE_POINTS = -1
+
+Author = namedtuple("Author", ["name", "email", "kudos"])
+
+
+def update_karma(list_name, sender_email, sender_name, date,
+                 posts=0, likes=0, dislikes=0):
+    """Add points to a sender, for the period the given date belongs to."""
+    score = posts * POST_POINTS + likes * LIKE_POINTS \
+            + dislikes * DISLIKE_POINTS
+    update_or_create(SenderKarma,
+            {"list_address": list_name, "period": get_period(date),
+             "sender_email": sender_email},
+            {"posts": F("posts") + posts, "likes": F("likes") + likes,
+             "dislikes": F("dislikes") + dislikes,
+             "score": F("score") + score},
+            {"sender_name": sender_name or "", "posts": posts,
+             "likes": likes, "dislikes": dislikes, "score": score})
+    if score:
+        UserProfile.objects.filter(user__email=sender_email).update(
+                karma=F("karma") + score)
+
+
+def record_vote(list_name, message, old_vote, new_vote):
+    """Update the karma of the sender of a message when a vote is cast,
+    changed or cancelled.
+
+    :param old_vote: The previous vote (1, -1, or 0 for no vote).
+    :param new_vote: The new vote (1, -1, or 0 if cancelled).
+    """
+    likes = int(new_vote == 1) - int(old_vote == 1)
+    dislikes = int(new_vote == -1) - int(old_vote == -1)
+    if not likes and not dislikes:
+        return
+    update_karma(list_name, message.sender_email, message.sender_name,
+                 message.date, likes=likes, dislikes=dislikes)
+
+
+def get_top_authors(list_name, date=None, limit=5):
+    """Return the leaderboard of a list for the period of the given date
+    (defaults to the current month)."""
+    if date is None:
+        date = datetime.datetime.utcnow()
+    karmas = SenderKarma.objects.filter(list_address=list_name,
+                period=get_period(date), score__gt=0
+             ).order_by("-score")[:limit]
+    return [ Author(k.sender_name or k.sender_email, k.sender_email, k.score)
+             for k in karmas ]
+
+
+class KarmaStage(Stage):
+    """Archiver pipeline stage giving points for the posted messages."""
+
+    def process_batch(self, store, list_name, emails):
+        posts = defaultdict(int)
+        names = {}
+        for email in emails:
+            key = (email.sender_email, get_period(email.date))
+            posts[key] += 1
+            names[key] = email.sender_name
+        for (sender_email, period), count in posts.items():
+            update_karma(list_name, sender_email,
+                         names[(sender_email, period)], period, posts=count)
+
+    def rebuild(self, store, list_name):
+        karmas = {}
+        def get_karma(email):
+            key = (email.sender_email, get_period(email.date))
+            if key not in karmas:
+                karmas[key] = SenderKarma(list_address=list_name,
+                        sender_email=email.sender_email,
+                        sender_name=email.sender_name or "", period=key[1])
+            return karmas[key]
+        start_date = store.get_start_date(list_name)
+        if start_date is not None:
+            end_date = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+            for email in store.get_messages(list_name, start_date, end_date):
+                get_karma(email).posts += 1
+        votes = list(Rating.objects.filter(list_address=list_name))
+        emails = get_messages_by_hashes(store, list_name,
+                                        set(vote.messageid for vote in votes))
+        for vote in votes:
+            email = emails.get(vote.messageid)
+            if email is None:
+                continue
+            if vote.vote == 1:
+                get_karma(email).likes += 1
+            elif vote.vote == -1:
+                get_karma(email).dislikes += 1
+        for karma in karmas.values():
+            karma.score = karma.posts * POST_POINTS \
+                    + karma.likes * LIKE_POINTS \
+                    + karma.dislikes * DISLIKE_POINTS
+        SenderKarma.objects.filter(list_address=list_name).delete()
+        SenderKarma.objects.bulk_create(karmas.values())
+        # The profile karma is the sum of the karma on all the lists
+        senders = set(sender_email for sender_email, _period in karmas)
+        for profile in UserProfile.objects.filter(user__email__in=senders
+                                                 ).select_related("user"):
+            total = SenderKarma.objects.filter(
+                        sender_email=profile.user.email
+                    ).aggregate(total=Sum("score"))["total"] or 0
+            profile.karma = 1 + total
+            profile.save()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Concurrent load test of the WSGI application, in-process.
+
+Each worker process wraps Django's WSGI application in
+:class:`hyperkitty.lib.store.KittyStoreWSGIMiddleware`, like a production
+deployment, and requests it from several threads at once. The workers
+report their latencies, the number of store and database connections they
+opened, and their memory usage.
+"""
+
+import time
+import random
+import resource
+import threading
+import datetime
+from collections import namedtuple
+from wsgiref.util import setup_testing_defaults
+
+from django.core.urlresolvers import reverse
+from django.db.backends.signals import connection_created
+
+from hyperkitty.lib.store import KittyStoreWSGIMiddleware, get_store_count
+
+
+WorkerResult = namedtuple("WorkerResult", ["latencies", "errors",
+        "store_connections", "db_connections", "max_rss"])
+
+
+def get_urls(store, threads_per_list=20):
+    """Return the URLs of the most recently active pages of the archives.
+
+    :param store: The KittyStore object.
+    :param threads_per_list: The number of threads to request in each list.
+    """
+    urls = []
+    end = datetime.datetime.now() + datetime.timedelta(days=1)
+    for list_name in store.get_list_names():
+        urls.append(reverse("list_overview",
+                            kwargs={"mlist_fqdn": list_name}))
+        urls.append(reverse("archives_latest",
+                            kwargs={"mlist_fqdn": list_name}))
+        start = store.get_start_date(list_name)
+        if start is None:
+            continue
+        for thread in store.get_threads(list_name, start,
+                                        end)[:threads_per_list]:
+            urls.append(reverse("thread", kwargs={"mlist_fqdn": list_name,
+                                "threadid": thread.thread_id}))
+            urls.append(reverse("message_index", kwargs={
+                    "mlist_fqdn": list_name,
+                    "message_id_hash": thread.starting_email.message_id_hash}))
+    return urls
+
+
+def request(app, path, server_name="localhost"):
+    """Request a page from a WSGI application.
+
+    :returns: The HTTP status code.
+    """
+    environ = {"PATH_INFO": path, "SERVER_NAME": server_name,
+               "HTTP_HOST": server_name}
+    setup_testing_defaults(environ)
+    status = []
+    def start_response(status_line, headers, exc_info=None):
+        status.append(status_line)
+    result = app(environ, start_response)
+    try:
+        for chunk in result:
+            pass
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return int(status[0].split()[0])
+
+
+def run_worker(urls, threads, duration, seed=0, server_name="localhost"):
+    """Request random URLs from several threads for a given time.
+
+    :param urls: The URLs to choose from.
+    :param threads: The number of concurrent threads.
+    :param duration: The duration of the test, in seconds.
+    :returns: A :class:`WorkerResult`.
+    """
+    from django.core.wsgi import get_wsgi_application
+    app = KittyStoreWSGIMiddleware(get_wsgi_application())
+    db_connections = [0]
+    lock = threading.Lock()
+    def on_connection(sender, **kwargs):
+        with lock:
+            db_connections[0] += 1
+    connection_created.connect(on_connection, weak=False)
+    stores_before = get_store_count()
+    latencies = []
+    errors = [0]
+    deadline = time.time() + duration
+    def run(thread_num):
+        rng = random.Random("%s-%s" % (seed, thread_num))
+        thread_latencies = []
+        thread_errors = 0
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                status = request(app, rng.choice(urls), server_name)
+            except Exception:
+                status = 500
+            thread_latencies.append(time.time() - start)
+            if status >= 400:
+                thread_errors += 1
+        with lock:
+            latencies.extend(thread_latencies)
+            errors[0] += thread_errors
+    workers = [ threading.Thread(target=run, args=(num, ))
+                for num in range(threads) ]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        connection_created.disconnect(on_connection)
+    # ru_maxrss is in kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return WorkerResult(latencies, errors[0],
+                        get_store_count() - stores_before,
+                        db_connections[0], max_rss)
+
+
+def run_worker_process(args):
+    """Entry point of the worker processes, see :func:`run_worker`."""
+    return run_worker(*args)
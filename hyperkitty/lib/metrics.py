@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+In-process metrics, served in the Prometheus text format by the metrics view.
+
+The metrics are plain counters protected by a lock, so they can be updated
+from several threads at a low cost. Each process has its own metrics: the
+scraper must query each worker, or the application must be run with a single
+multi-threaded process.
+"""
+
+import os
+import threading
+
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return unicode(value).replace("\\", r"\\").replace("\n", r"\n"
+                        ).replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=()):
+    labels = [ '%s="%s"' % (name, _escape(value)) for name, value
+               in zip(names, values) + list(extra) ]
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(labels)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """Base class for the metrics, with one value per set of labels."""
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("Expected the labels %s" % ", ".join(self.labels))
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        """Return the samples of the metric, as (name, labels, value)
+        tuples."""
+        with self._lock:
+            values = self._values.items()
+        return [ (self.name, _format_labels(self.labels, key), value)
+                 for key, value in sorted(values) ]
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def expose(self):
+        """Return the metric in the Prometheus text format."""
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s %s" % (self.name, self.type)]
+        for name, labels, value in self.samples():
+            lines.append("%s%s %s" % (name, labels, _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = "gauge"
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(float(b) for b in buckets) + (float("inf"), )
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket, and the sum
+                counts = self._values[key] = [0] * len(self.buckets) + [0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [ (key, list(counts)) for key, counts
+                       in self._values.items() ]
+        samples = []
+        for key, counts in sorted(values):
+            cumulated = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulated += count
+                samples.append( (self.name + "_bucket",
+                        _format_labels(self.labels, key,
+                                       [("le", _format_value(bound))]),
+                        cumulated) )
+            labels = _format_labels(self.labels, key)
+            samples.append( (self.name + "_sum", labels, counts[-1]) )
+            samples.append( (self.name + "_count", labels, cumulated) )
+        return samples
+
+
+REQUEST_DURATION = Histogram("hyperkitty_request_duration_seconds",
+        "Time spent processing the requests, by URL name.", ["view"])
+STORE_CALLS = Counter("hyperkitty_store_calls_total",
+        "Calls to the KittyStore methods.", ["method"])
+CACHE_REQUESTS = Counter("hyperkitty_cache_requests_total",
+        "Cache lookups, by cache and result (hit or miss).",
+        ["cache", "result"])
+
+
+def record_cache_lookup(cache_name, hit):
+    """Count a cache hit or a cache miss."""
+    CACHE_REQUESTS.inc(cache=cache_name, result="hit" if hit else "miss")
+
+
+# Collected when the metrics are served
+STORES = Gauge("hyperkitty_stores",
+        "KittyStore connections opened by the store middlewares.")
+SPOOL_MESSAGES = Gauge("hyperkitty_spool_messages",
+        "Messages waiting in the archiver's spools.", ["spool"])
+SPOOL_OLDEST = Gauge("hyperkitty_spool_oldest_seconds",
+        "Age of the oldest message waiting in the archiver's spools.",
+        ["spool"])
+SPOOL_FAILED = Gauge("hyperkitty_spool_failed_messages",
+        "Messages which could not be archived.", ["spool"])
+ARCHIVED_MESSAGES = Counter("hyperkitty_archived_messages_total",
+        "Messages archived from the spool.")
+
+METRICS = [REQUEST_DURATION, STORE_CALLS, CACHE_REQUESTS, STORES,
+           SPOOL_MESSAGES, SPOOL_OLDEST, SPOOL_FAILED, ARCHIVED_MESSAGES]
+
+
+def collect():
+    """Update the metrics which are read from outside of the process."""
+    from hyperkitty.lib.store import get_store_count
+    from hyperkitty.lib.spool import ArchiveSpool, get_spool_dir
+    STORES.set(get_store_count())
+    spool_dir = get_spool_dir()
+    if spool_dir is None:
+        return
+    for name, path in [("archive", spool_dir),
+                       ("deferred", os.path.join(spool_dir, "deferred"))]:
+        if not os.path.isdir(path):
+            continue
+        stats = ArchiveSpool(path).stats()
+        SPOOL_MESSAGES.set(stats["backlog"], spool=name)
+        SPOOL_OLDEST.set(stats["oldest"], spool=name)
+        SPOOL_FAILED.set(stats["failed"], spool=name)
+        if name == "archive":
+            ARCHIVED_MESSAGES.set(stats["archived"])
+
+
+def expose():
+    """Return all the metrics in the Prometheus text format."""
+    collect()
+    return "\n".join(metric.expose() for metric in METRICS) + "\n"
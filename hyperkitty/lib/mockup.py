@@ -40,6 +40,15 @@ class Email(object):
         self.author = ''
         self.avatar = None
 
+    # Same attributes as the threads of hyperkitty.lib.categories
+    @property
+    def thread_id(self):
+        return self.email_id
+
+    @property
+    def subject(self):
+        return self.title
+
 class Author(object):
     """ Author class containing the information needed to get the top
     author of the month!
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+
+"""
+Months with archived messages, for the navigation in the archives of a list.
+
+The number of messages by month is stored in the
+:class:`~hyperkitty.models.ArchiveMonth` table, which the archiver updates
+when messages are archived: the months of the new messages are counted again
+in the store, so a batch which is processed twice does not change the counts.
+The months of each list are cached in the
+process for a short while: the archiver runs in another process, so a new
+month shows up in the web interface within ``CACHE_TIMEOUT`` seconds.
+"""
+
+import time
+import datetime
+from collections import namedtuple
+
+from hyperkitty.models import ArchiveMonth
+from hyperkitty.lib import get_period, update_or_create
+from hyperkitty.lib.cache import LRUCache
+from hyperkitty.lib.metrics import record_cache_lookup
+from hyperkitty.lib.pipeline import Stage
+from hyperkitty.lib.queries import count_messages
+
+
+CACHE_TIMEOUT = 60
+
+Month = namedtuple("Month", ["year", "month", "count"])
+
+_cache = LRUCache(1000)
+
+
+def get_months(list_name):
+    """Return the months with archived messages in a list, grouped by year.
+
+    :param list_name: The fully qualified list name.
+    :returns: A list of couples formed of the year and the list of its
+        :class:`Month` objects, the most recent first.
+    """
+    cached = _cache.get(list_name)
+    if cached is not None and cached[0] < time.time():
+        cached = None # expired
+    record_cache_lookup("months", cached is not None)
+    if cached is not None:
+        return cached[1]
+    months = []
+    for month, count in ArchiveMonth.objects.filter(list_address=list_name,
+                count__gt=0).order_by("-month").values_list("month", "count"):
+        if not months or months[-1][0] != month.year:
+            months.append( (month.year, []) )
+        months[-1][1].append(Month(month.year, month.month, count))
+    _cache.set(list_name, (time.time() + CACHE_TIMEOUT, months))
+    return months
+
+
+def get_period_bounds(month):
+    """Return the start (included) and the end (excluded) of a month, as
+    datetimes."""
+    start = datetime.datetime.combine(month, datetime.time())
+    if month.month == 12:
+        end = start.replace(year=month.year + 1, month=1)
+    else:
+        end = start.replace(month=month.month + 1)
+    return start, end
+
+
+def update_months(store, list_name, months):
+    """Count again the messages of a list in the given months.
+
+    :param store: The KittyStore object.
+    :param list_name: The fully qualified list name.
+    :param months: The first days of the months to update.
+    """
+    for month in months:
+        start, end = get_period_bounds(month)
+        count = count_messages(store, list_name, start, end)
+        update_or_create(ArchiveMonth,
+                         {"list_address": list_name, "month": month},
+                         {"count": count}, {"count": count})
+    _cache.set(list_name, None)
+
+
+class MonthsStage(Stage):
+    """Archiver pipeline stage counting the messages by month."""
+
+    def process_batch(self, store, list_name, emails):
+        update_months(store, list_name,
+                      set( get_period(email.date) for email in emails ))
+
+    def rebuild(self, store, list_name):
+        ArchiveMonth.objects.filter(list_address=list_name).delete()
+        counts = {}
+        start_date = store.get_start_date(list_name)
+        if start_date is not None:
+            end_date = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+            for email in store.get_messages(list_name, start_date, end_date):
+                month = get_period(email.date)
+                counts[month] = counts.get(month, 0) + 1
+        ArchiveMonth.objects.bulk_create([
+                ArchiveMonth(list_address=list_name, month=month, count=count)
+                for month, count in counts.items() ])
+        _cache.set(list_name, None)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Pipeline of stages keeping the derived data (statistics, caches, karma...)
+up-to-date when messages are archived.
+
+The stages are listed by their dotted path in the ``ARCHIVER_PIPELINE``
+setting, and are called with each batch of newly archived messages, after
+they have been committed. Stages which are too slow to be run by the archiver
+itself can be marked as deferred: they are then run by the ``consume_spool``
+worker.
+"""
+
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from hyperkitty.lib.queries import get_messages_by_hashes
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PIPELINE = (
+    "hyperkitty.lib.karma.KarmaStage",
+    "hyperkitty.lib.months.MonthsStage",
+    "hyperkitty.lib.categories.CategoriesStage",
+    "hyperkitty.lib.threadindex.ThreadIndexStage",
+)
+
+
+class Stage(object):
+    """Base class for the post-archive stages."""
+
+    # Deferred stages are run by the consume_spool worker
+    deferred = False
+
+    def process(self, store, list_name, email):
+        """Update the derived data for a newly archived message.
+
+        :param store: The KittyStore object.
+        :param list_name: The fully qualified name of the mailing-list.
+        :param email: The archived message, as returned by the store.
+        """
+        raise NotImplementedError
+
+    def process_batch(self, store, list_name, emails):
+        """Update the derived data for a batch of messages of the same list.
+        Override this method if the stage can be more efficient than
+        processing the messages one at a time.
+        """
+        for email in emails:
+            self.process(store, list_name, email)
+
+    def rebuild(self, store, list_name):
+        """Recompute the derived data for a whole mailing-list."""
+        pass
+
+
+def _load_stage(path):
+    module_name, _dot, class_name = path.rpartition(".")
+    try:
+        stage_class = getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured("Error loading the archiver pipeline "
+                                   "stage %s: %s" % (path, e))
+    return stage_class()
+
+
+class Pipeline(object):
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    @property
+    def has_deferred(self):
+        return any(stage.deferred for stage in self.stages)
+
+    def run(self, store, list_name, emails, deferred=None):
+        """Run the stages on a batch of newly archived messages.
+
+        :param store: The KittyStore object.
+        :param list_name: The fully qualified name of the mailing-list.
+        :param emails: The archived messages, as returned by the store.
+        :param deferred: Only run the deferred stages if True, or only the
+            inline stages if False. By default, all the stages are run.
+        """
+        for stage in self.stages:
+            if deferred is not None and stage.deferred != deferred:
+                continue
+            try:
+                stage.process_batch(store, list_name, emails)
+            except Exception, e:
+                # The messages are archived anyway, don't stop here
+                logger.exception("Error in the archiver pipeline stage %s: %s"
+                                 % (stage.__class__.__name__, e))
+
+    def rebuild(self, store, list_name):
+        """Recompute all the derived data for a mailing-list."""
+        for stage in self.stages:
+            stage.rebuild(store, list_name)
+
+
+_pipeline = None
+
+def get_pipeline():
+    """Return the pipeline configured in the settings."""
+    global _pipeline
+    if _pipeline is None:
+        paths = getattr(settings, "ARCHIVER_PIPELINE", DEFAULT_PIPELINE)
+        _pipeline = Pipeline([ _load_stage(path) for path in paths ])
+    return _pipeline
+
+
+def run_pipeline(store, archived, deferred=None):
+    """Run the pipeline on newly archived messages.
+
+    :param store: The KittyStore object.
+    :param archived: A list of couples formed of the fully qualified list name
+        and the Message-ID hash of the archived messages.
+    :param deferred: See :meth:`Pipeline.run`.
+    """
+    by_list = {}
+    for list_name, message_id_hash in archived:
+        by_list.setdefault(list_name, []).append(message_id_hash)
+    for list_name, hashes in by_list.items():
+        emails = get_messages_by_hashes(store, list_name, hashes)
+        emails = [ emails[h] for h in hashes if h in emails ]
+        get_pipeline().run(store, list_name, emails, deferred)
+
+
+def run_deferred(queue, store, batch_size=100):
+    """Run the deferred stages on the messages referenced in the queue.
+
+    :param queue: The :class:`~hyperkitty.lib.spool.ArchiveSpool` where the
+        archiver writes the references to the archived messages.
+    :param store: The KittyStore object.
+    :returns: The number of processed messages.
+    """
+    keys = queue.keys()[:batch_size]
+    archived = [ queue.get_reference(key) for key in keys ]
+    run_pipeline(store, archived, deferred=True)
+    for key in keys:
+        queue.remove(key)
+    return len(keys)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Sampling profiler, producing stacks in the "collapsed" format read by the
+flamegraph tools (one line per stack, the frames separated by semicolons,
+followed by the number of samples).
+
+A thread takes the samples at a regular interval from the stacks of the
+other threads, so the profiled code is not slowed down by tracing hooks.
+"""
+
+import os
+import sys
+import threading
+
+from django.core import signing
+
+
+# Stop recording new stacks above this number, to bound the memory usage
+MAX_STACKS = 10000
+TOKEN_SALT = "hyperkitty.profile"
+
+_frame_names = {}
+
+
+def _frame_name(code):
+    name = _frame_names.get(code)
+    if name is None:
+        filename = code.co_filename
+        for path in sorted(sys.path, key=len, reverse=True):
+            if path and filename.startswith(path + os.sep):
+                filename = filename[len(path)+1:]
+                break
+        name = _frame_names[code] = "%s:%s" % (filename, code.co_name)
+    return name
+
+
+def collapse(frame):
+    """Return the stack of a frame, outermost call first, in the collapsed
+    format."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class Sampler(object):
+    """
+    Sample the stacks of a thread, or of all the threads, until stopped.
+
+    :param interval: The time between two samples, in seconds.
+    :param thread_id: The identifier of the thread to sample, or None to
+        sample all the other threads.
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.stacks = {}
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name="hyperkitty-sampler")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.current_thread().ident
+        while not self._stopped.is_set():
+            frames = sys._current_frames()
+            if self.thread_id is not None:
+                frames = { self.thread_id: frames.get(self.thread_id) }
+            for thread_id, frame in frames.items():
+                if frame is None or thread_id == own_id:
+                    continue
+                self._record(collapse(frame))
+            self._stopped.wait(self.interval)
+
+    def _record(self, stack):
+        with self._lock:
+            self.samples += 1
+            if stack in self.stacks or len(self.stacks) < MAX_STACKS:
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def collapsed(self):
+        """Return the sampled stacks in the collapsed format."""
+        with self._lock:
+            stacks = sorted(self.stacks.items())
+        return "".join("%s %d\n" % (stack, count) for stack, count in stacks)
+
+
+def make_token(path):
+    """Return a token allowing anyone to profile a page."""
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign(path)
+
+
+def check_token(token, path, max_age):
+    """Return True if the token was made for the page less than ``max_age``
+    seconds ago."""
+    try:
+        return signing.TimestampSigner(salt=TOKEN_SALT).unsign(
+                token, max_age=max_age) == path
+    except signing.BadSignature:
+        return False
@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Batch queries on the KittyStore database, for the data the store API only
+returns one thread at a time.
+
+When the store implements a method with the same name, it is used instead of
+querying the database directly.
+"""
+
+import datetime
+from collections import namedtuple
+
+from storm.expr import And, Or, Desc, Count, Join, LeftJoin
+from storm.info import ClassAlias
+from kittystore.storm.model import Email, Thread, Attachment
+
+
+# Stay below the maximum number of SQL variables in SQLite
+CHUNK_SIZE = 500
+KEY_DATE_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+class ThreadSummary(namedtuple("ThreadSummary", ["thread_id", "subject",
+        "date_active", "length", "participants", "starting_email", "likes",
+        "dislikes", "likestatus", "myvote", "favorite", "tags"])):
+    """
+    The data shown in the thread lists, without the messages of the thread.
+    The number of messages (``length``) and of distinct senders
+    (``participants``) are computed by the database.
+
+    The starting email and the votes, favorites and tags are only set in the
+    paginated lists, with :meth:`_replace`.
+    """
+    __slots__ = ()
+
+ThreadSummary.__new__.__defaults__ = (None, 0, 0, "neutral", 0, False, ())
+
+# A thread of which only the id is loaded
+ThreadRef = namedtuple("ThreadRef", ["thread_id"])
+
+# An attachment, without its content
+AttachmentInfo = namedtuple("AttachmentInfo", ["message_id", "counter",
+        "name", "content_type", "size"])
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = [ unicode(value) for value in values ]
+    for index in range(0, len(values), size):
+        yield values[index:index+size]
+
+
+def get_threads_by_ids(store, list_name, thread_ids):
+    """Return the threads with the given ids, most recently active first.
+
+    :param store: The KittyStore object.
+    :param list_name: The fully qualified list name.
+    :param thread_ids: The ids of the threads to fetch.
+    :returns: The list of threads.
+    """
+    if hasattr(store, "get_threads_by_ids"):
+        return store.get_threads_by_ids(list_name, thread_ids)
+    threads = []
+    for chunk in _chunks(thread_ids):
+        threads.extend(store.db.find(Thread, And(
+                Thread.list_name == unicode(list_name),
+                Thread.thread_id.is_in(chunk),
+            )))
+    threads.sort(key=lambda t: t.date_active, reverse=True)
+    return threads
+
+
+def get_existing_thread_ids(store, list_name, thread_ids):
+    """Return the ids of the threads which exist, in the given order. Only
+    the ids are loaded."""
+    if hasattr(store, "get_existing_thread_ids"):
+        return store.get_existing_thread_ids(list_name, thread_ids)
+    existing = set()
+    for chunk in _chunks(thread_ids):
+        existing.update(store.db.find(Thread, And(
+                Thread.list_name == unicode(list_name),
+                Thread.thread_id.is_in(chunk),
+            )).values(Thread.thread_id))
+    return [ thread_id for thread_id in thread_ids
+             if unicode(thread_id) in existing ]
+
+
+def sort_thread_ids(store, list_name, thread_ids):
+    """Sort thread ids by activity date, most recent first, without loading
+    the threads. Unknown ids are dropped."""
+    if hasattr(store, "sort_thread_ids"):
+        return store.sort_thread_ids(list_name, thread_ids)
+    dated = []
+    for chunk in _chunks(thread_ids):
+        dated.extend(store.db.find((Thread.date_active, Thread.thread_id), And(
+                Thread.list_name == unicode(list_name),
+                Thread.thread_id.is_in(chunk),
+            )))
+    dated.sort(reverse=True)
+    return [ thread_id for _date, thread_id in dated ]
+
+
+def get_thread_dates(store, list_name, since=None):
+    """Return the activity dates of the threads of a list, without loading
+    the threads.
+
+    :param since: Only return the threads active at or after this date.
+    :returns: A list of (date_active, thread_id) couples, in no particular
+        order.
+    """
+    if hasattr(store, "get_thread_dates"):
+        return store.get_thread_dates(list_name, since)
+    clauses = [ Thread.list_name == unicode(list_name) ]
+    if since is not None:
+        clauses.append(Thread.date_active >= since)
+    return list(store.db.find((Thread.date_active, Thread.thread_id),
+                              And(*clauses)))
+
+
+def get_threads_page(store, list_name, start, end, before=None, after=None,
+                     limit=10):
+    """Return a page of the threads active in a period, in keyset order:
+    by activity date then by thread id, most recent first.
+
+    :param start: The start of the period (included).
+    :param end: The end of the period (excluded).
+    :param before: The (date_active, thread_id) key of the thread the page
+        starts after, in this order.
+    :param after: The key of the thread the page ends before, to go back to
+        the more recent threads.
+    :param limit: The number of threads on a page.
+    :returns: The threads, most recent first, followed by one more thread
+        if there are more threads after the page, in the direction of the
+        query (if ``after`` is given, the additional thread is the first
+        one).
+    """
+    if hasattr(store, "get_threads_page"):
+        return store.get_threads_page(list_name, start, end, before, after,
+                                      limit)
+    clauses = [ Thread.list_name == unicode(list_name),
+                Thread.date_active >= start, Thread.date_active < end ]
+    if after is None:
+        if before is not None:
+            clauses.append(Or(Thread.date_active < before[0], And(
+                    Thread.date_active == before[0],
+                    Thread.thread_id < unicode(before[1]))))
+        order = (Desc(Thread.date_active), Desc(Thread.thread_id))
+    else:
+        clauses.append(Or(Thread.date_active > after[0], And(
+                Thread.date_active == after[0],
+                Thread.thread_id > unicode(after[1]))))
+        order = (Thread.date_active, Thread.thread_id)
+    threads = list(store.db.find(Thread, And(*clauses)
+                                ).order_by(*order)[:limit+1])
+    if after is not None:
+        threads.reverse()
+    return threads
+
+
+def count_threads(store, list_name, start, end):
+    """Return the number of threads active in a period, counted by the
+    database.
+
+    :param start: The start of the period (included).
+    :param end: The end of the period (excluded).
+    """
+    if hasattr(store, "count_threads"):
+        return store.count_threads(list_name, start, end)
+    return store.db.find(Thread, And(
+            Thread.list_name == unicode(list_name),
+            Thread.date_active >= start,
+            Thread.date_active < end,
+        )).count()
+
+
+def get_thread_at(store, list_name, start, end, offset):
+    """Return the thread at an offset in the keyset order of a period (most
+    recent first), or None if the period has fewer threads. Only used to
+    find the page of the old paginated URLs, the offset is not indexed.
+    """
+    if hasattr(store, "get_thread_at"):
+        return store.get_thread_at(list_name, start, end, offset)
+    threads = list(store.db.find(Thread, And(
+            Thread.list_name == unicode(list_name),
+            Thread.date_active >= start,
+            Thread.date_active < end,
+        )).order_by(Desc(Thread.date_active), Desc(Thread.thread_id)
+        )[offset:offset+1])
+    return threads[0] if threads else None
+
+
+def get_thread_summaries(store, list_name, thread_ids=None, start=None,
+                         end=None):
+    """Return the summaries of threads, most recently active first, with a
+    single query for up to CHUNK_SIZE threads.
+
+    :param thread_ids: The ids of the threads, or None for all the threads
+        of the list.
+    :param start: Only return the threads active at or after this date.
+    :param end: Only return the threads active before this date.
+    :returns: A list of :class:`ThreadSummary` objects.
+    """
+    if hasattr(store, "get_thread_summaries"):
+        return store.get_thread_summaries(list_name, thread_ids, start, end)
+    # The thread id is the Message-ID hash of the email starting the thread
+    StartingEmail = ClassAlias(Email)
+    tables = (Thread,
+              Join(Email, And(Email.list_name == Thread.list_name,
+                              Email.thread_id == Thread.thread_id)),
+              LeftJoin(StartingEmail, And(
+                    StartingEmail.list_name == Thread.list_name,
+                    StartingEmail.message_id_hash == Thread.thread_id)))
+    clauses = [ Thread.list_name == unicode(list_name) ]
+    if start is not None:
+        clauses.append(Thread.date_active >= start)
+    if end is not None:
+        clauses.append(Thread.date_active < end)
+    if thread_ids is None:
+        conditions = [ And(*clauses) ]
+    else:
+        conditions = [ And(Thread.thread_id.is_in(chunk), *clauses)
+                       for chunk in _chunks(thread_ids) ]
+    summaries = []
+    for condition in conditions:
+        summaries.extend(ThreadSummary(*row) for row in
+            store.db.using(*tables).find(
+                (Thread.thread_id, StartingEmail.subject, Thread.date_active,
+                 Count(Email.message_id),
+                 Count(Email.sender_email, distinct=True)),
+                condition).group_by(Thread.thread_id, StartingEmail.subject,
+                                    Thread.date_active))
+    summaries.sort(key=lambda t: (t.date_active, t.thread_id), reverse=True)
+    return summaries
+
+
+def get_email_id_hashes(store, list_name, thread_ids):
+    """Return the Message-ID hashes of the emails in the given threads.
+
+    :returns: A dict mapping the thread ids to the lists of hashes.
+    """
+    if hasattr(store, "get_email_id_hashes"):
+        return store.get_email_id_hashes(list_name, thread_ids)
+    hashes = dict( (thread_id, []) for thread_id in thread_ids )
+    for chunk in _chunks(thread_ids):
+        for thread_id, message_id_hash in store.db.find(
+                (Email.thread_id, Email.message_id_hash), And(
+                    Email.list_name == unicode(list_name),
+                    Email.thread_id.is_in(chunk),
+                )):
+            hashes.setdefault(thread_id, []).append(message_id_hash)
+    return hashes
+
+
+def count_thread_participants(store, list_name, thread_ids):
+    """Return the number of distinct senders in the given threads."""
+    if hasattr(store, "count_thread_participants"):
+        return store.count_thread_participants(list_name, thread_ids)
+    chunks = list(_chunks(thread_ids))
+    if len(chunks) == 1:
+        return store.db.find(Email, And(
+                Email.list_name == unicode(list_name),
+                Email.thread_id.is_in(chunks[0]),
+            )).count(Email.sender_email, distinct=True)
+    # The senders may appear in several chunks
+    senders = set()
+    for chunk in chunks:
+        senders.update(store.db.find(Email.sender_email, And(
+                Email.list_name == unicode(list_name),
+                Email.thread_id.is_in(chunk),
+            )).config(distinct=True))
+    return len(senders)
+
+
+def count_participants(store, list_name, start, end):
+    """Return the number of distinct senders in the threads active in a
+    period, counted by the database.
+
+    :param start: The start of the period (included).
+    :param end: The end of the period (excluded).
+    """
+    if hasattr(store, "count_participants"):
+        return store.count_participants(list_name, start, end)
+    return store.db.using(Thread, Join(Email, And(
+                Email.list_name == Thread.list_name,
+                Email.thread_id == Thread.thread_id))
+        ).find(Email, And(
+            Thread.list_name == unicode(list_name),
+            Thread.date_active >= start,
+            Thread.date_active < end,
+        )).count(Email.sender_email, distinct=True)
+
+
+def count_messages(store, list_name, start, end):
+    """Return the number of messages sent in a period, counted by the
+    database.
+
+    :param start: The start of the period (included).
+    :param end: The end of the period (excluded).
+    """
+    if hasattr(store, "count_messages"):
+        return store.count_messages(list_name, start, end)
+    return store.db.find(Email, And(
+            Email.list_name == unicode(list_name),
+            Email.date >= start,
+            Email.date < end,
+        )).count()
+
+
+def get_messages_by_hashes(store, list_name, message_id_hashes):
+    """Load several messages of a list at once.
+
+    :returns: A dict mapping the Message-ID hashes to the messages.
+    """
+    if hasattr(store, "get_messages_by_hashes"):
+        return store.get_messages_by_hashes(list_name, message_id_hashes)
+    messages = {}
+    for chunk in _chunks(message_id_hashes):
+        for message in store.db.find(Email, And(
+                    Email.list_name == unicode(list_name),
+                    Email.message_id_hash.is_in(chunk),
+                )):
+            messages[message.message_id_hash] = message
+    return messages
+
+
+def get_attachments_by_ids(store, list_name, message_ids):
+    """Load the attachments of several messages at once, without their
+    content.
+
+    :returns: A dict mapping the Message-IDs to the lists of
+        :class:`AttachmentInfo`, in order.
+    """
+    if hasattr(store, "get_attachments_by_ids"):
+        return store.get_attachments_by_ids(list_name, message_ids)
+    attachments = dict( (message_id, []) for message_id in message_ids )
+    for chunk in _chunks(message_ids):
+        for row in store.db.find((Attachment.message_id, Attachment.counter,
+                    Attachment.name, Attachment.content_type, Attachment.size),
+                And(Attachment.list_name == unicode(list_name),
+                    Attachment.message_id.is_in(chunk),
+                )).order_by(Attachment.counter):
+            attachments.setdefault(row[0], []).append(AttachmentInfo(*row))
+    return attachments
+
+
+def set_messages_attachments(store, list_name, messages):
+    """Set the ``attachment_list`` attribute of several messages, instead of
+    querying the attachments of each message in the templates."""
+    attachments = get_attachments_by_ids(store, list_name,
+            [ message.message_id for message in messages ])
+    for message in messages:
+        message.attachment_list = attachments.get(message.message_id, [])
+
+
+class ThreadSequence(object):
+    """
+    A sequence of threads identified by their ids, which only checks the
+    threads in the slices it is asked for. Suitable for Django's Paginator.
+    The items are :class:`ThreadRef` objects: the thread lists load the
+    data they show with :func:`get_thread_summaries`.
+    """
+
+    def __init__(self, store, list_name, thread_ids):
+        self.store = store
+        self.list_name = list_name
+        self.thread_ids = list(thread_ids)
+
+    def __len__(self):
+        return len(self.thread_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ ThreadRef(thread_id) for thread_id in
+                     get_existing_thread_ids(self.store, self.list_name,
+                                             self.thread_ids[index]) ]
+        return ThreadRef(self.thread_ids[index])
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+def make_key(thread):
+    """Return the pagination key of a thread, for the URLs."""
+    return "%s_%s" % (thread.date_active.strftime(KEY_DATE_FORMAT),
+                      thread.thread_id)
+
+
+def parse_key(key):
+    """Parse a key made by :func:`make_key`.
+
+    :returns: A (date_active, thread_id) couple, or None if the key is
+        invalid.
+    """
+    if not key:
+        return None
+    date_active, _sep, thread_id = key.partition("_")
+    try:
+        date_active = datetime.datetime.strptime(date_active, KEY_DATE_FORMAT)
+    except ValueError:
+        return None
+    if not thread_id:
+        return None
+    return (date_active, thread_id)
+
+
+class KeysetPage(object):
+    """
+    A page of the threads of a period, fetched by :func:`get_threads_page`.
+    It replaces the pages of Django's Paginator in the templates: the links
+    to the other pages use the keys of the first and last threads of the
+    page, so that the deep pages are as cheap as the first one.
+
+    :param count: The number of threads in the period.
+    """
+
+    def __init__(self, store, list_name, start, end, before=None,
+                 after=None, count=None, per_page=10):
+        # an invalid key leads to the first page
+        before, after = parse_key(before), parse_key(after)
+        threads = get_threads_page(store, list_name, start, end,
+                                   before, after, per_page)
+        more = len(threads) > per_page
+        if after is None:
+            self.threads = threads[:per_page]
+            self.has_previous = before is not None
+            self.has_next = more
+        else:
+            self.threads = threads[-per_page:]
+            self.has_previous = more
+            self.has_next = True
+        self.count = count
+
+    @property
+    def previous_key(self):
+        return make_key(self.threads[0]) if self.threads else None
+
+    @property
+    def next_key(self):
+        return make_key(self.threads[-1]) if self.threads else None
+
+    def __len__(self):
+        return len(self.threads)
+
+    def __iter__(self):
+        return iter(self.threads)
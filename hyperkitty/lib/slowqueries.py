@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+
+"""
+Slow query log for the store.
+
+A Storm tracer times the SQL statements sent by KittyStore, and appends those
+slower than ``SLOW_QUERY_THRESHOLD`` seconds to the ``SLOW_QUERY_LOG`` file,
+one JSON object per line, with their bind parameters and the view (or the
+path) which was being served. The ``slow_queries`` management command reads
+the log and groups the statements by shape: the literals and the bind
+parameters are removed, so the same query with different values is counted
+once.
+"""
+
+import re
+import time
+import threading
+
+from django.conf import settings
+import django.utils.simplejson as json
+from storm.expr import Variable
+from storm.tracer import install_tracer
+
+
+# The representation of the parameters is truncated to this length, the
+# message contents would bloat the log.
+MAX_PARAM_LENGTH = 100
+
+_local = threading.local()
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def set_origin(origin):
+    """Set the view or the path which the statements of the current thread
+    are run for, or None outside of a request."""
+    _local.origin = origin
+
+
+def get_origin():
+    return getattr(_local, "origin", None)
+
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAM_RE = re.compile(r"\?|%s")
+_PARAM_LIST_RE = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)",
+                            re.IGNORECASE)
+_SPACES_RE = re.compile(r"\s+")
+
+def normalize(statement):
+    """Return the shape of a statement: the literals and the bind parameters
+    are replaced by ``?``, and the lists of the ``IN`` clauses by ``IN (...)``,
+    whatever their length."""
+    statement = _STRING_RE.sub("?", statement)
+    statement = _NUMBER_RE.sub("?", statement)
+    statement = _PARAM_RE.sub("?", statement)
+    statement = _PARAM_LIST_RE.sub("IN (...)", statement)
+    return _SPACES_RE.sub(" ", statement).strip()
+
+
+def _format_param(param):
+    if isinstance(param, Variable):
+        param = param.get()
+    param = repr(param)
+    if len(param) > MAX_PARAM_LENGTH:
+        param = param[:MAX_PARAM_LENGTH] + "..."
+    return param
+
+
+class SlowQueryTracer(object):
+    """
+    Storm tracer logging the statements slower than ``threshold`` seconds to
+    the file at ``path``.
+    """
+
+    def __init__(self, threshold, path):
+        self.threshold = threshold
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def connection_raw_execute(self, connection, raw_cursor, statement,
+                               params):
+        self._local.start = time.time()
+
+    def connection_raw_execute_success(self, connection, raw_cursor,
+                                       statement, params):
+        self._done(statement, params, None)
+
+    def connection_raw_execute_error(self, connection, raw_cursor,
+                                     statement, params, error):
+        self._done(statement, params, error)
+
+    def _done(self, statement, params, error):
+        start = getattr(self._local, "start", None)
+        if start is None:
+            return
+        self._local.start = None
+        duration = time.time() - start
+        if duration >= self.threshold:
+            self.record(statement, params, duration, error)
+
+    def record(self, statement, params, duration, error=None):
+        """Append a statement to the log."""
+        record = {
+            "time": int(time.time()),
+            "duration": round(duration * 1000, 1),
+            "statement": statement,
+            "params": [ _format_param(p) for p in params or () ],
+            "origin": get_origin(),
+        }
+        if error is not None:
+            record["error"] = unicode(error)
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            with open(self.path, "a") as log_file:
+                log_file.write(line)
+
+
+def install():
+    """Install the tracer if the ``SLOW_QUERY_LOG`` setting is set. The
+    tracer is global to the process, it is only installed once.
+
+    :returns: The tracer, or None if the slow query log is disabled.
+    """
+    global _tracer
+    path = getattr(settings, "SLOW_QUERY_LOG", None)
+    if not path:
+        return None
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = SlowQueryTracer(
+                    getattr(settings, "SLOW_QUERY_THRESHOLD", 0.1), path)
+            install_tracer(_tracer)
+    return _tracer
+
+
+def read_log(path):
+    """Iterate over the records of a slow query log. The truncated lines,
+    written while the log was read, are skipped."""
+    with open(path) as log_file:
+        for line in log_file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+class QueryShape(object):
+    """The slow statements sharing the same shape."""
+
+    def __init__(self, statement):
+        self.statement = statement
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.origins = {}
+        self.slowest = None
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    def add(self, record):
+        self.count += 1
+        self.total += record["duration"]
+        origin = record.get("origin") or "-"
+        self.origins[origin] = self.origins.get(origin, 0) + 1
+        if self.slowest is None or record["duration"] > self.max:
+            self.max = record["duration"]
+            self.slowest = record
+
+
+def aggregate(records, origin=None):
+    """Group the slow statements by shape.
+
+    :param records: The records of the log, as returned by :func:`read_log`.
+    :param origin: Only keep the statements run for this view or path.
+    :returns: A list of :class:`QueryShape` objects.
+    """
+    shapes = {}
+    for record in records:
+        if origin is not None and record.get("origin") != origin:
+            continue
+        shape = normalize(record["statement"])
+        if shape not in shapes:
+            shapes[shape] = QueryShape(shape)
+        shapes[shape].add(record)
+    return shapes.values()
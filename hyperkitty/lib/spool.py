@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+"""
+Durable on-disk spool for the messages sent to the archiver
+
+Each message is written to its own file, in a layout similar to Maildir: the
+file is written in the "tmp" subdirectory, synced to disk, and then atomically
+moved to the "new" subdirectory. The file names sort in arrival order.
+Messages which could not be archived are moved to the "failed" subdirectory.
+"""
+
+import os
+import time
+import fcntl
+import logging
+import itertools
+from collections import namedtuple
+from email import message_from_string
+from email.message import Message
+from email.utils import unquote
+
+from django.conf import settings
+import django.utils.simplejson as json
+
+
+logger = logging.getLogger(__name__)
+
+# Minimal implementation of Mailman's IMailingList, with only the attributes
+# KittyStore reads when archiving a message.
+MailingList = namedtuple("MailingList",
+                         ["fqdn_listname", "display_name", "subject_prefix"])
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def get_spool_dir():
+    """Return the spool directory of the archiver: the ``ARCHIVER_SPOOL_DIR``
+    setting, or else the ``hyperkitty/spool`` subdirectory of Mailman's var
+    directory. The latter is only known in Mailman's process, the other
+    processes get None.
+    """
+    spool_dir = getattr(settings, "ARCHIVER_SPOOL_DIR", None)
+    if spool_dir is not None:
+        return spool_dir
+    try:
+        from mailman.config import config
+        var_dir = config.VAR_DIR
+    except (ImportError, AttributeError):
+        return None
+    return os.path.join(var_dir, "hyperkitty", "spool")
+
+
+def is_stored(store, mlist, msg):
+    """Return True if the message is already in the store: KittyStore
+    returns its hash without adding it again, and the pipeline must not
+    count it twice. It happens when a process dies between the commit of a
+    batch and the removal of its messages from the spool.
+    """
+    if not msg.get("Message-Id"):
+        return False # KittyStore will refuse it
+    return bool(store.is_message_in_list(mlist.fqdn_listname,
+                                         unicode(unquote(msg["Message-Id"]))))
+
+
+class ArchiveSpool(object):
+    """
+    A directory holding the messages which have not been committed to the
+    store yet.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._counter = itertools.count()
+        for subdir in ("tmp", "new", "failed"):
+            subdir = os.path.join(self.path, subdir)
+            if not os.path.isdir(subdir):
+                os.makedirs(subdir)
+
+    def _new_key(self):
+        return "%016d.%08d.%08d" % (int(time.time() * 1000000), os.getpid(),
+                                     self._counter.next() % 100000000)
+
+    def put(self, mlist, msg):
+        """Write a message to the spool.
+
+        :param mlist: The IMailingList object.
+        :param msg: The message object.
+        :returns: The key of the spooled message.
+        """
+        metadata = {
+            "fqdn_listname": mlist.fqdn_listname,
+            "display_name": mlist.display_name,
+            "subject_prefix": mlist.subject_prefix,
+        }
+        return self._write(metadata, msg.as_string())
+
+    def put_reference(self, list_name, message_id_hash):
+        """Write a reference to an archived message to the spool.
+
+        :param list_name: The fully qualified list name.
+        :param message_id_hash: The Message-ID hash of the archived message.
+        :returns: The key of the spooled reference.
+        """
+        metadata = {
+            "list_name": list_name,
+            "message_id_hash": message_id_hash,
+        }
+        return self._write(metadata, "")
+
+    def _write(self, metadata, content):
+        key = self._new_key()
+        tmp_path = os.path.join(self.path, "tmp", key)
+        with open(tmp_path, "wb") as spool_file:
+            spool_file.write(json.dumps(metadata) + "\n")
+            spool_file.write(content)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        os.rename(tmp_path, os.path.join(self.path, "new", key))
+        _fsync_dir(os.path.join(self.path, "new"))
+        return key
+
+    def keys(self, min_age=None):
+        """Return the keys of the spooled messages, oldest first.
+
+        :param min_age: Only return the messages spooled at least this number
+            of seconds ago.
+        """
+        keys = sorted(os.listdir(os.path.join(self.path, "new")))
+        if min_age is not None:
+            keys = [ key for key in keys if self.age(key) >= min_age ]
+        return keys
+
+    def age(self, key):
+        """Return the number of seconds since the message was spooled."""
+        return time.time() - int(key.partition(".")[0]) / 1000000.0
+
+    def get(self, key, message_class=Message):
+        """Read a message from the spool.
+
+        :param key: The key returned by :meth:`put`.
+        :param message_class: The class to instanciate the message with.
+        :returns: A couple formed of the mailing-list and the message.
+        """
+        with open(os.path.join(self.path, "new", key), "rb") as spool_file:
+            metadata = json.loads(spool_file.readline())
+            msg = message_from_string(spool_file.read(), message_class)
+        return MailingList(**dict((str(k), v) for k, v in metadata.items())), msg
+
+    def get_reference(self, key):
+        """Read a reference written by :meth:`put_reference`.
+
+        :returns: A couple formed of the list name and the Message-ID hash.
+        """
+        with open(os.path.join(self.path, "new", key), "rb") as spool_file:
+            metadata = json.loads(spool_file.readline())
+        return metadata["list_name"], metadata["message_id_hash"]
+
+    def remove(self, key):
+        """Remove a message from the spool, once it has been committed."""
+        try:
+            os.remove(os.path.join(self.path, "new", key))
+        except OSError:
+            pass # already removed
+
+    def bury(self, key):
+        """Move a message which can't be archived out of the way."""
+        os.rename(os.path.join(self.path, "new", key),
+                  os.path.join(self.path, "failed", key))
+
+    def __len__(self):
+        return len(os.listdir(os.path.join(self.path, "new")))
+
+    def _read_archived(self):
+        try:
+            with open(os.path.join(self.path, "archived")) as counter_file:
+                return int(counter_file.read())
+        except (IOError, ValueError):
+            return 0
+
+    def add_archived(self, count):
+        """Add to the number of messages archived from the spool. The
+        consumers of all the processes may call this method: the update is
+        done under a lock, and the counter is replaced atomically for the
+        readers."""
+        with open(os.path.join(self.path, "archived.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                tmp_path = os.path.join(self.path, "tmp", "archived")
+                with open(tmp_path, "w") as counter_file:
+                    counter_file.write(str(self._read_archived() + count))
+                os.rename(tmp_path, os.path.join(self.path, "archived"))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self):
+        """
+        Return the backlog metrics: the number of spooled messages, the age
+        of the oldest one in seconds, the number of failed messages, and the
+        number of messages archived since the spool was created.
+        """
+        keys = self.keys()
+        if keys:
+            oldest = self.age(keys[0])
+        else:
+            oldest = 0
+        return {
+            "backlog": len(keys),
+            "oldest": oldest,
+            "failed": len(os.listdir(os.path.join(self.path, "failed"))),
+            "archived": self._read_archived(),
+        }
+
+
+class SpoolConsumer(object):
+    """
+    Archive the spooled messages in the store, in arrival order.
+
+    A message which can't be archived is retried before any later message is
+    committed, and moved to the "failed" subdirectory of the spool after
+    ``max_retries`` attempts.
+
+    The ``post_archive`` callable, if given, is called after each commit with
+    the list of archived messages, as couples formed of the list name and the
+    Message-ID hash. The messages which were already in the store are left
+    out.
+    """
+
+    def __init__(self, spool, store, batch_size=100, max_retries=5,
+                 message_class=Message, post_archive=None):
+        self.spool = spool
+        self.store = store
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.message_class = message_class
+        self.post_archive = post_archive
+        self._attempts = {}
+
+    def consume(self, keys):
+        """Archive the given spooled messages and commit them.
+
+        :param keys: The keys of the spooled messages, in arrival order. The
+            keys already removed by a concurrent consumer are skipped.
+        :returns: The number of handled keys. If it is lower than the number
+            of keys, no message has been committed and the failed one will be
+            retried.
+        """
+        archived = []
+        consumed = []
+        for key in keys:
+            try:
+                mlist, msg = self.spool.get(key, self.message_class)
+            except IOError:
+                # archived by a concurrent consumer in the meantime
+                continue
+            try:
+                stored = is_stored(self.store, mlist, msg)
+                msg_hash = self.store.add_to_list(mlist, msg)
+            except Exception, e:
+                logger.exception("Could not archive the spooled message %s: %s"
+                                 % (key, e))
+                # The rollback also drops the previous messages of the batch
+                self.store.rollback()
+                self._attempts[key] = self._attempts.get(key, 0) + 1
+                if self._attempts[key] >= self.max_retries:
+                    logger.error("Giving up on the spooled message %s" % key)
+                    self.spool.bury(key)
+                    del self._attempts[key]
+                return 0
+            consumed.append(key)
+            if not stored:
+                archived.append( (mlist.fqdn_listname, msg_hash) )
+        self.store.commit()
+        for key in consumed:
+            self.spool.remove(key)
+            self._attempts.pop(key, None)
+        if consumed:
+            self.spool.add_archived(len(consumed))
+        if self.post_archive is not None and archived:
+            self.post_archive(archived)
+        return len(keys)
+
+    def consume_batch(self):
+        """Archive the oldest batch of spooled messages."""
+        return self.consume(self.spool.keys()[:self.batch_size])
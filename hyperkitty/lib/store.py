@@ -25,11 +25,37 @@ WSGI and Django middlewares for KittyStore
 Inspired by http://pypi.python.org/pypi/middlestorm
 """
 
-from threading import local
+from threading import local, Lock
 
 from django.conf import settings
 import kittystore
 
+from hyperkitty.lib import slowqueries
+
+
+_store_count = 0
+_store_count_lock = Lock()
+
+
+def _open_store(local_data):
+    """Return the store of the current thread, opening it if necessary."""
+    global _store_count
+    try:
+        return local_data.store
+    except AttributeError:
+        slowqueries.install()
+        local_data.store = kittystore.get_store(settings.KITTYSTORE_URL,
+                                                settings.KITTYSTORE_DEBUG)
+        with _store_count_lock:
+            _store_count += 1
+        return local_data.store
+
+
+def get_store_count():
+    """Return the number of stores opened by the middlewares in this
+    process, which is the number of threads which served a request."""
+    return _store_count
+
 
 class KittyStoreWSGIMiddleware(object):
     """WSGI middleware.
@@ -46,17 +72,13 @@ class KittyStoreWSGIMiddleware(object):
         self._local = local()
 
     def __call__(self, environ, start_response):
-        try:
-            environ['kittystore.store']  = self._local.store
-        except AttributeError:
-            environ['kittystore.store']  = \
-                    self._local.__dict__.setdefault('store',
-                        kittystore.get_store(settings.KITTYSTORE_URL,
-                                             settings.KITTYSTORE_DEBUG))
+        environ['kittystore.store'] = _open_store(self._local)
+        slowqueries.set_origin(environ.get("PATH_INFO"))
         try:
             return self._app(environ, start_response)
         finally:
             environ['kittystore.store'].rollback()
+            slowqueries.set_origin(None)
             #environ['kittystore.store'].close()
 
 
@@ -71,17 +93,18 @@ class KittyStoreDjangoMiddleware(object):
         self._local = local()
 
     def process_request(self, request):
-        try:
-            request.environ['kittystore.store']  = self._local.store
-        except AttributeError:
-            request.environ['kittystore.store']  = \
-                    self._local.__dict__.setdefault('store',
-                        kittystore.get_store(settings.KITTYSTORE_URL,
-                                             settings.KITTYSTORE_DEBUG))
-
-    #def process_response(self, request, response):
-    #    request.environ['kittystore.store'].close()
-    #    return response
+        request.environ['kittystore.store'] = _open_store(self._local)
+        slowqueries.set_origin(request.path)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        resolver_match = getattr(request, "resolver_match", None)
+        if resolver_match is not None and resolver_match.url_name:
+            slowqueries.set_origin(resolver_match.url_name)
+
+    def process_response(self, request, response):
+        #request.environ['kittystore.store'].close()
+        slowqueries.set_origin(None)
+        return response
 
     def process_exception(self, request, exception):
         request.environ['kittystore.store'].rollback()
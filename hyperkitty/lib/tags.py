@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Tag cloud and tag autocompletion, read from the per-list tag counts in the
+:class:`~hyperkitty.models.TagStats` table.
+"""
+
+import math
+from collections import namedtuple
+
+from hyperkitty.models import TagStats
+
+
+CLOUD_SIZE = 30
+CLOUD_WEIGHTS = 5
+SUGGESTIONS = 10
+
+CloudTag = namedtuple("CloudTag", ["tag", "count", "weight"])
+
+
+def get_tag_cloud(list_name, size=CLOUD_SIZE):
+    """Return the most used tags of a list, in alphabetical order, with a
+    weight between 1 and CLOUD_WEIGHTS on a logarithmic scale."""
+    stats = list(TagStats.objects.filter(list_address=list_name,
+                    count__gt=0).order_by("-count")[:size])
+    if not stats:
+        return []
+    low = math.log(stats[-1].count)
+    high = math.log(stats[0].count)
+    cloud = []
+    for tag_stats in sorted(stats, key=lambda s: s.tag):
+        if high == low:
+            weight = 1
+        else:
+            weight = 1 + int(round((math.log(tag_stats.count) - low)
+                                   / (high - low) * (CLOUD_WEIGHTS - 1)))
+        cloud.append(CloudTag(tag_stats.tag, tag_stats.count, weight))
+    return cloud
+
+
+def get_tag_suggestions(list_name, prefix, limit=SUGGESTIONS):
+    """Return the most used tags of a list starting with the given prefix.
+
+    The prefix is matched with a range on the (list_address, tag) index
+    rather than with a LIKE query, which most databases can't answer from a
+    B-tree index.
+    """
+    if not prefix:
+        return []
+    stats = TagStats.objects.filter(list_address=list_name, count__gt=0,
+                tag__gte=prefix, tag__lt=prefix + u"\uffff"
+            ).order_by("-count", "tag").values_list("tag", flat=True)
+    return list(stats[:limit])
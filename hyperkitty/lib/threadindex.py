@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+
+"""
+Index of the threads of each list, ordered by activity date, to find the
+previous, next and next unread threads without querying the database.
+
+The index holds the (date_active, thread_id) couples of a list in a sorted
+list. It is loaded from the database with a single query the first time it
+is needed in a process, then refreshed with the threads active since the
+most recent date it knows, at most every ``REFRESH_INTERVAL`` seconds or as
+soon as an unknown thread is asked for. A thread archived with an older date
+than that is not found by the refresh: it is inserted with its own date, or
+the whole index is loaded again. When the archiver runs in the same process,
+its pipeline stage updates the index directly. The whole index is loaded
+again every ``RELOAD_INTERVAL`` seconds, to drop the deleted threads and to
+move the threads whose activity date changed without being found.
+
+The read threads are only remembered for the logged-in users, the anonymous
+visitors do not get a session.
+"""
+
+import time
+import calendar
+import datetime
+import threading
+from bisect import bisect_left, insort
+from collections import namedtuple
+
+from hyperkitty.lib.cache import LRUCache
+from hyperkitty.lib.pipeline import Stage
+from hyperkitty.lib.queries import get_thread_dates, get_thread_summaries
+
+
+REFRESH_INTERVAL = 30
+RELOAD_INTERVAL = 60 * 10
+# Messages may be archived with a date older than the most recent one
+REFRESH_MARGIN = datetime.timedelta(days=1)
+# Threads remembered as read in the session, per list
+MAX_READ_THREADS = 1000
+READ_SESSION_KEY = "hyperkitty_read_threads"
+# Subjects of the neighbor threads kept in each index
+MAX_SUBJECTS = 1000
+
+IndexEntry = namedtuple("IndexEntry", ["thread_id", "date_active", "subject"])
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _timestamp(date):
+    return calendar.timegm(date.utctimetuple())
+
+
+class ThreadIndex(object):
+    """The threads of a list, ordered by activity date."""
+
+    def __init__(self, list_name):
+        self.list_name = list_name
+        self.refreshed = None
+        self.loaded = None
+        self._keys = [] # sorted (date_active, thread_id) couples
+        self._dates = {} # thread_id -> date_active
+        self._subjects = LRUCache(MAX_SUBJECTS)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, thread_id):
+        return thread_id in self._dates
+
+    def get_date(self, thread_id):
+        """Return the activity date of a thread, or None if it is unknown."""
+        return self._dates.get(thread_id)
+
+    def load(self, store):
+        """Load the whole index from the store."""
+        dated = get_thread_dates(store, self.list_name)
+        with self._lock:
+            self._keys = sorted(dated)
+            self._dates = dict( (thread_id, date_active)
+                                for date_active, thread_id in dated )
+            self.refreshed = self.loaded = time.time()
+
+    def refresh(self, store, force=False):
+        """Add the threads which became active since the last refresh, if
+        it is older than ``REFRESH_INTERVAL`` seconds or if ``force`` is
+        True. The whole index is loaded again if it is older than
+        ``RELOAD_INTERVAL`` seconds."""
+        if self.loaded is None or time.time() >= self.loaded + RELOAD_INTERVAL:
+            return self.load(store)
+        if not force and time.time() < self.refreshed + REFRESH_INTERVAL:
+            return
+        with self._lock:
+            since = self._keys[-1][0] - REFRESH_MARGIN if self._keys else None
+        self.update(get_thread_dates(store, self.list_name, since))
+        self.refreshed = time.time()
+
+    def update(self, dated):
+        """Set the activity dates of threads.
+
+        :param dated: An iterable of (date_active, thread_id) couples.
+        """
+        with self._lock:
+            for date_active, thread_id in dated:
+                old_date = self._dates.get(thread_id)
+                if old_date == date_active:
+                    continue
+                if old_date is not None:
+                    del self._keys[bisect_left(self._keys,
+                                               (old_date, thread_id))]
+                insort(self._keys, (date_active, thread_id))
+                self._dates[thread_id] = date_active
+
+    def _position(self, thread_id):
+        return bisect_left(self._keys, (self._dates[thread_id], thread_id))
+
+    def neighbors(self, thread_id):
+        """Return the ids of the previous (older) and the next (more
+        recently active) threads, or None."""
+        with self._lock:
+            if thread_id not in self._dates:
+                return (None, None)
+            position = self._position(thread_id)
+            older = self._keys[position - 1][1] if position > 0 else None
+            newer = self._keys[position + 1][1] \
+                    if position + 1 < len(self._keys) else None
+        return (older, newer)
+
+    def next_unread(self, thread_id, read):
+        """Return the id of the first thread more recently active than the
+        given one which has not been read since its last activity, or None.
+
+        :param read: A dict mapping the ids of the read threads to the
+            timestamp of their activity date when they were read.
+        """
+        with self._lock:
+            if thread_id not in self._dates:
+                return None
+            for date_active, other_id in \
+                    self._keys[self._position(thread_id) + 1:]:
+                if read.get(other_id, -1) < _timestamp(date_active):
+                    return other_id
+        return None
+
+    def get_entries(self, store, thread_ids):
+        """Return the index entries of threads, with their subject. The
+        subjects of the threads are only loaded the first time.
+
+        :returns: A list of :class:`IndexEntry` objects, or None for the
+            None or unknown ids.
+        """
+        subjects = dict( (t, self._subjects.get(t))
+                         for t in thread_ids if t is not None )
+        missing = [ t for t, subject in subjects.items() if subject is None ]
+        if missing:
+            for summary in get_thread_summaries(store, self.list_name,
+                                                missing):
+                subjects[summary.thread_id] = summary.subject
+                self._subjects.set(summary.thread_id, summary.subject)
+        entries = []
+        for thread_id in thread_ids:
+            date_active = self._dates.get(thread_id)
+            if date_active is None:
+                entries.append(None)
+                continue
+            entries.append(IndexEntry(thread_id, date_active,
+                                      subjects.get(thread_id)))
+        return entries
+
+
+def get_thread_index(store, list_name, thread_id=None, date_active=None):
+    """Return the up-to-date index of a list.
+
+    :param thread_id: If the index does not contain this thread yet, it is
+        refreshed immediately.
+    :param date_active: The activity date of the thread. If the index does
+        not have this date for the thread, the thread is moved or inserted
+        with it; without it, the whole index is loaded again if the refresh
+        did not find the thread.
+    """
+    with _indexes_lock:
+        index = _indexes.get(list_name)
+        if index is None:
+            index = _indexes[list_name] = ThreadIndex(list_name)
+    index.refresh(store, force=thread_id is not None
+                               and index.refreshed is not None
+                               and thread_id not in index)
+    if thread_id is None:
+        return index
+    if date_active is not None:
+        # archived with a date older than the refresh margin
+        if index.get_date(thread_id) != date_active:
+            index.update([ (date_active, thread_id) ])
+    elif thread_id not in index:
+        index.load(store)
+    return index
+
+
+def _get_session(request):
+    """Return the session of a logged-in user, or None."""
+    user = getattr(request, "user", None)
+    if user is None or not user.is_authenticated():
+        return None
+    return getattr(request, "session", None)
+
+
+def get_read_threads(request, list_name):
+    """Return the threads of a list read in the session, as a dict mapping
+    the thread ids to the timestamps of their activity date when they were
+    read."""
+    session = _get_session(request)
+    if session is None:
+        return {}
+    return session.get(READ_SESSION_KEY, {}).get(list_name, {})
+
+
+def mark_read(request, list_name, thread_id, date_active):
+    """Remember in the session that a thread has been read. Only the
+    ``MAX_READ_THREADS`` most recently active threads are remembered. The
+    anonymous visitors are not tracked, to not create sessions for them."""
+    session = _get_session(request)
+    if session is None:
+        return
+    timestamp = _timestamp(date_active)
+    read_threads = session.get(READ_SESSION_KEY, {})
+    read = read_threads.setdefault(list_name, {})
+    if read.get(thread_id) == timestamp:
+        return
+    read[thread_id] = timestamp
+    if len(read) > MAX_READ_THREADS:
+        for old_id, _ts in sorted(read.items(), key=lambda r: r[1]
+                                  )[:len(read) - MAX_READ_THREADS]:
+            del read[old_id]
+    session[READ_SESSION_KEY] = read_threads
+
+
+class ThreadIndexStage(Stage):
+    """
+    Archiver pipeline stage moving the threads which received new messages
+    in the thread index, if it is loaded in this process.
+    """
+
+    def process_batch(self, store, list_name, emails):
+        index = _indexes.get(list_name)
+        if index is None or index.refreshed is None:
+            return
+        dates = {}
+        for email in emails:
+            known = dates.get(email.thread_id,
+                              index.get_date(email.thread_id))
+            if known is None or email.date > known:
+                dates[email.thread_id] = email.date
+        index.update( (date_active, thread_id)
+                      for thread_id, date_active in dates.items() )
+
+    def rebuild(self, store, list_name):
+        with _indexes_lock:
+            _indexes.pop(list_name, None)
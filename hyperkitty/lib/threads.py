@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Layout of the replies in the thread view.
+
+The layout of a thread is the list of its messages in display order, with
+their indentation level. It is computed from a projection of the emails
+table, without loading the messages. The messages are then loaded by batch,
+for the replies which are displayed only: replies in deep subtrees are
+collapsed, and the remaining replies are paginated.
+
+The layouts are cached under a key containing the thread's activity date and
+number of emails. A new message changes the count even when its date is not
+later than the activity date, so the cached layouts are never stale, even when
+the messages are archived by another process with its own cache.
+"""
+
+from collections import namedtuple
+
+from django.core.cache import cache
+from storm.expr import And
+from kittystore.storm.model import Email
+
+from hyperkitty.lib.queries import (get_messages_by_hashes,
+        set_messages_attachments)
+from hyperkitty.lib.metrics import record_cache_lookup
+
+
+# Indentation is capped at this level, and the deeper replies are collapsed
+MAX_LEVEL = 5
+REPLIES_PER_PAGE = 50
+CACHE_TIMEOUT = 60 * 60 * 24
+
+LayoutEntry = namedtuple("LayoutEntry", ["message_id_hash", "level"])
+
+
+def _cache_key(list_name, thread, sort_mode):
+    return "hyperkitty:thread_layout:%s:%s:%s:%d:%s" % (list_name,
+            thread.thread_id, thread.date_active.strftime("%Y%m%d%H%M%S%f"),
+            len(thread), sort_mode)
+
+
+def get_thread_layout(store, list_name, thread, sort_mode="thread"):
+    """Return the messages of a thread in display order.
+
+    :param store: The KittyStore object.
+    :param list_name: The fully qualified list name.
+    :param thread: The thread, as returned by the store.
+    :param sort_mode: "thread" to sort by reply, "date" to sort by date.
+    :returns: A list of :class:`LayoutEntry`. The level of the starting
+        email is -1 in thread mode, and all the levels are 0 in date mode.
+    """
+    thread_id = thread.thread_id
+    key = _cache_key(list_name, thread, sort_mode)
+    layout = cache.get(key)
+    record_cache_lookup("thread_layout", layout is not None)
+    if layout is None:
+        layout = compute_thread_layout(store, list_name, thread_id, sort_mode)
+        cache.set(key, layout, CACHE_TIMEOUT)
+    return layout
+
+
+def compute_thread_layout(store, list_name, thread_id, sort_mode="thread"):
+    """Compute the layout of a thread, see :func:`get_thread_layout`."""
+    if hasattr(store, "get_thread_layout"):
+        return store.get_thread_layout(list_name, thread_id, sort_mode)
+    if sort_mode == "date":
+        order_by = Email.date
+    else:
+        order_by = Email.thread_order
+    rows = store.db.find((Email.message_id_hash, Email.thread_depth), And(
+                Email.list_name == unicode(list_name),
+                Email.thread_id == unicode(thread_id),
+            )).order_by(order_by)
+    if sort_mode == "date":
+        return [ LayoutEntry(message_id_hash, 0)
+                 for message_id_hash, _depth in rows ]
+    # replies start ragged left
+    return [ LayoutEntry(message_id_hash, depth - 1)
+             for message_id_hash, depth in rows ]
+
+
+def get_subtree(layout, message_id_hash):
+    """Return the replies below a message, in a layout in thread order."""
+    for index, entry in enumerate(layout):
+        if entry.message_id_hash == message_id_hash:
+            break
+    else:
+        return []
+    subtree = []
+    for reply in layout[index+1:]:
+        if reply.level <= entry.level:
+            break
+        subtree.append(reply)
+    return subtree
+
+
+def collapse(layout, max_level):
+    """Hide the replies deeper than the given level.
+
+    :returns: A list of couples formed of a visible entry and the number of
+        replies collapsed below it.
+    """
+    visible = []
+    for entry in layout:
+        if entry.level > max_level and visible:
+            last_entry, hidden = visible[-1]
+            visible[-1] = (last_entry, hidden + 1)
+        else:
+            visible.append( (entry, 0) )
+    return visible
+
+
+def get_replies_page(store, list_name, layout, offset=0, count=None,
+                     base_level=0):
+    """Load the messages for a page of replies.
+
+    :param layout: The layout of the replies to paginate, in display order.
+    :param offset: The number of visible replies to skip.
+    :param count: The maximum number of replies to load, defaults to
+        REPLIES_PER_PAGE.
+    :param base_level: The level of the shallowest replies in the layout,
+        the replies deeper than MAX_LEVEL below it are collapsed.
+    :returns: A couple formed of the list of messages, with their ``level``,
+        ``hidden_replies`` and ``attachment_list`` attributes set, and the
+        offset of the next page, or None if this is the last page.
+    """
+    if count is None:
+        count = REPLIES_PER_PAGE
+    visible = collapse(layout, base_level + MAX_LEVEL)
+    page = visible[offset:offset+count]
+    messages = get_messages_by_hashes(store, list_name,
+                    [ entry.message_id_hash for entry, _hidden in page ])
+    replies = []
+    for entry, hidden in page:
+        message = messages.get(entry.message_id_hash)
+        if message is None:
+            continue # deleted in the meantime
+        message.level = min(entry.level, MAX_LEVEL)
+        message.hidden_replies = hidden
+        replies.append(message)
+    set_messages_attachments(store, list_name, replies)
+    if offset + count < len(visible):
+        next_offset = offset + count
+    else:
+        next_offset = None
+    return replies, next_offset
+
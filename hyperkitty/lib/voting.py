@@ -21,6 +21,7 @@
 
 
 from hyperkitty.models import Rating
+from hyperkitty.lib.queries import CHUNK_SIZE
 
 
 def get_votes(message_id_hash, user=None):
@@ -41,10 +42,33 @@ def get_votes(message_id_hash, user=None):
     return likes, dislikes, myvote
 
 
-def set_message_votes(message, user=None):
-    # Extract all the votes for this message
-    message.likes, message.dislikes, message.myvote = \
-            get_votes(message.message_id_hash, user)
+def get_votes_by_message(message_id_hashes, user=None):
+    """Extract the votes for several messages with a single query.
+
+    :returns: A dict mapping the Message-ID hashes to the same tuples as
+        :func:`get_votes`.
+    """
+    votes = dict( (h, [0, 0, 0]) for h in message_id_hashes )
+    if user is not None and user.is_authenticated():
+        user_id = user.id
+    else:
+        user_id = None
+    message_id_hashes = list(message_id_hashes)
+    for index in range(0, len(message_id_hashes), CHUNK_SIZE):
+        for messageid, vote, voter_id in Rating.objects.filter(
+                    messageid__in=message_id_hashes[index:index+CHUNK_SIZE]
+                ).values_list("messageid", "vote", "user_id"):
+            counts = votes[messageid]
+            if vote == 1:
+                counts[0] += 1
+            elif vote == -1:
+                counts[1] += 1
+            if voter_id == user_id:
+                counts[2] = vote
+    return dict( (h, tuple(counts)) for h, counts in votes.items() )
+
+
+def _set_likestatus(message):
     message.likestatus = "neutral"
     if message.likes - message.dislikes >= 10:
         message.likestatus = "likealot"
@@ -52,3 +76,20 @@ def set_message_votes(message, user=None):
         message.likestatus = "like"
     #elif message.likes - message.dislikes < 0:
     #    message.likestatus = "dislike"
+
+
+def set_message_votes(message, user=None):
+    # Extract all the votes for this message
+    message.likes, message.dislikes, message.myvote = \
+            get_votes(message.message_id_hash, user)
+    _set_likestatus(message)
+
+
+def set_messages_votes(messages, user=None):
+    """Same as :func:`set_message_votes` for several messages at once."""
+    votes = get_votes_by_message(
+            [ message.message_id_hash for message in messages ], user)
+    for message in messages:
+        message.likes, message.dislikes, message.myvote = \
+                votes[message.message_id_hash]
+        _set_likestatus(message)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Benchmark the views against a generated archive, in a test database.
+
+The command fails if a view makes more database queries or store calls than
+its budget, declared in :mod:`hyperkitty.lib.benchmark`.
+"""
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (setup_test_environment,
+        teardown_test_environment, override_settings)
+
+from hyperkitty.lib.benchmark import (BenchmarkArchive, VIEWS, run_view,
+        over_budget, store_budget, percentile)
+
+
+class Command(BaseCommand):
+    args = "[<view> ...]"
+    help = "Measure the latency and the queries of the views (default: all)"
+    option_list = BaseCommand.option_list + (
+        make_option("-s", "--size", type="int", default=2000,
+                    help="number of messages in the archive "
+                         "(default: %default)"),
+        make_option("--seed", type="int", default=42,
+                    help="random seed of the archive (default: %default)"),
+        make_option("-n", "--requests", type="int", default=20,
+                    help="number of requests per view (default: %default)"),
+        make_option("--sqlite", action="store_true",
+                    help="hold the archive in an SQLite store and count the "
+                         "SQL statements instead of the store calls"),
+        )
+
+    def handle(self, *args, **options):
+        views = [ view for view in VIEWS if not args or view.name in args ]
+        if not views:
+            raise CommandError("Unknown views: %s" % ", ".join(args))
+        verbosity = int(options["verbosity"])
+        if "south" in settings.INSTALLED_APPS:
+            from south.management.commands import patch_for_test_db_setup
+            patch_for_test_db_setup()
+        setup_test_environment()
+        old_name = settings.DATABASES["default"]["NAME"]
+        connection.creation.create_test_db(verbosity=0)
+        # the store is given to the views in the request environment
+        middlewares = [ m for m in settings.MIDDLEWARE_CLASSES if m !=
+                        "hyperkitty.lib.store.KittyStoreDjangoMiddleware" ]
+        try:
+            with override_settings(MIDDLEWARE_CLASSES=middlewares,
+                                   USE_SSL=False):
+                if verbosity >= 1:
+                    self.stdout.write("Generating %d messages\n"
+                                      % options["size"])
+                archive = BenchmarkArchive(options["size"], options["seed"],
+                                           options["sqlite"])
+                try:
+                    failed = self._run(archive, views, options["requests"])
+                finally:
+                    archive.close()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        if failed:
+            raise CommandError("Over budget: %s" % ", ".join(failed))
+
+    def _run(self, archive, views, requests):
+        client = archive.client()
+        urls = archive.urls()
+        calls = archive.count_calls()
+        self.stdout.write("%-12s %6s %9s %9s %9s %13s %13s\n" % ("view",
+                "status", "p50 (ms)", "p90 (ms)", "p99 (ms)", "queries",
+                "statements" if archive.sqlite else "store calls"))
+        failed = []
+        for view in views:
+            result = run_view(client, archive.store, calls, view,
+                              urls[view.name], requests)
+            latencies = [ percentile(result.latencies or [0], p) * 1000
+                          for p in (50, 90, 99) ]
+            self.stdout.write("%-12s %6d %9.1f %9.1f %9.1f %6d / %-4d "
+                    "%6d / %-4d%s\n" % ((view.name, result.status)
+                    + tuple(latencies) + (result.queries, view.queries,
+                    result.store_calls, store_budget(view, archive.sqlite),
+                    " OVER BUDGET" if over_budget(result, archive.sqlite)
+                    else "")))
+            if result.error:
+                self.stdout.write("    %s\n" % result.error)
+            if over_budget(result, archive.sqlite):
+                failed.append(view.name)
+        return failed
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Archive the messages spooled by the archiver in asynchronous mode
+(``ARCHIVER_ASYNC``), and run the deferred stages of the archiver pipeline.
+"""
+
+import os
+import time
+import logging
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import kittystore
+
+from hyperkitty.lib.spool import ArchiveSpool, SpoolConsumer, get_spool_dir
+from hyperkitty.lib.slowqueries import install as install_slow_query_log
+from hyperkitty.lib.pipeline import run_pipeline, run_deferred
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Archive the messages waiting in the archiver's spool"
+    option_list = BaseCommand.option_list + (
+        make_option("-b", "--batch-size", type="int", default=100,
+                    help="number of messages to commit at once "
+                         "(default: %default)"),
+        make_option("-r", "--max-retries", type="int", default=5,
+                    help="number of attempts before a message is moved to the "
+                         "spool's \"failed\" directory (default: %default)"),
+        make_option("-i", "--interval", type="float", default=1.0,
+                    help="seconds to wait when the spool is empty or after a "
+                         "failure (default: %default)"),
+        make_option("--once", action="store_true",
+                    help="exit when the spool is empty"),
+        make_option("--stats", action="store_true",
+                    help="only show the spool's backlog metrics"),
+        )
+
+    def handle(self, *args, **options):
+        spool_dir = get_spool_dir()
+        if spool_dir is None:
+            raise CommandError("The ARCHIVER_SPOOL_DIR setting is missing, "
+                               "set it to the archiver's spool directory")
+        spool = ArchiveSpool(spool_dir)
+        deferred_queue = ArchiveSpool(os.path.join(spool_dir, "deferred"))
+        if options["stats"]:
+            self._print_stats(spool, deferred_queue)
+            return
+        install_slow_query_log()
+        store = kittystore.get_store(settings.KITTYSTORE_URL,
+                                     settings.KITTYSTORE_DEBUG)
+        consumer = SpoolConsumer(spool, store,
+                batch_size=options["batch_size"],
+                max_retries=options["max_retries"],
+                post_archive=lambda archived: run_pipeline(store, archived))
+        verbosity = int(options["verbosity"])
+        try:
+            while True:
+                start = time.time()
+                consumed = consumer.consume_batch()
+                if consumed and verbosity >= 1:
+                    stats = spool.stats()
+                    self.stdout.write("Archived %d messages (%.1f msg/s), "
+                        "backlog: %d, oldest: %.1fs, failed: %d\n"
+                        % (consumed, consumed / (time.time() - start),
+                           stats["backlog"], stats["oldest"],
+                           stats["failed"]))
+                consumed += run_deferred(deferred_queue, store,
+                                         options["batch_size"])
+                if len(spool) == 0 and len(deferred_queue) == 0:
+                    if options["once"]:
+                        break
+                    time.sleep(options["interval"])
+                elif not consumed:
+                    # failure, wait before retrying
+                    time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            store.close()
+
+    def _print_stats(self, spool, deferred_queue):
+        stats = spool.stats()
+        self.stdout.write("backlog: %d\n" % stats["backlog"])
+        self.stdout.write("oldest: %.1f\n" % stats["oldest"])
+        self.stdout.write("failed: %d\n" % stats["failed"])
+        self.stdout.write("archived: %d\n" % stats["archived"])
+        self.stdout.write("deferred: %d\n" % len(deferred_queue))
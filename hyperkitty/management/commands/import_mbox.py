@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Import mbox files into the archives, parsing the messages in parallel and
+committing them by large batches. The derived data is rebuilt once at the end
+instead of going through the archiver pipeline for each message.
+"""
+
+import re
+import time
+import mailbox
+import itertools
+from email import message_from_string
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import kittystore
+from kittystore.utils import get_message_id_hash
+
+from hyperkitty.lib.spool import MailingList, is_stored
+from hyperkitty.lib.pipeline import get_pipeline
+
+
+TEXTWRAP_RE = re.compile("\n\s*")
+
+
+def parse_message(raw):
+    """
+    Parse a message in a worker process.
+
+    :returns: A couple formed of the Message-ID hash and the message, or None
+        if the message has no Message-ID.
+    """
+    msg = message_from_string(raw)
+    if not msg["Message-Id"]:
+        return None
+    # Un-wrap the subject line if necessary
+    if msg["Subject"]:
+        msg.replace_header("Subject", TEXTWRAP_RE.sub(" ", msg["Subject"]))
+    msg_id = msg["Message-Id"].strip().strip("<>")
+    return get_message_id_hash(msg_id), msg
+
+
+def read_mbox(path):
+    """Yield the raw messages of a mbox file, in order."""
+    mbox = mailbox.mbox(path, create=False)
+    try:
+        for key in mbox.iterkeys():
+            yield mbox.get_string(key)
+    finally:
+        mbox.close()
+
+
+def chunks(iterable, size):
+    """Yield lists of ``size`` items of an iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Command(BaseCommand):
+    args = "<mbox_file> [<mbox_file> ...]"
+    help = "Import mbox files into the archives of a mailing-list"
+    option_list = BaseCommand.option_list + (
+        make_option("-l", "--list-name",
+                    help="the fully-qualified list name (including the '@' "
+                         "symbol and the domain name)"),
+        make_option("-j", "--jobs", type="int", default=cpu_count(),
+                    help="number of processes parsing the messages "
+                         "(default: %default)"),
+        make_option("-b", "--batch-size", type="int", default=1000,
+                    help="number of messages to commit at once "
+                         "(default: %default)"),
+        )
+
+    def handle(self, *args, **options):
+        list_name = options["list_name"]
+        if not list_name or "@" not in list_name:
+            raise CommandError("The fully-qualified list name must be given "
+                               "with --list-name")
+        if not args:
+            raise CommandError("No mbox file selected")
+        self.verbosity = int(options["verbosity"])
+        self.batch_size = options["batch_size"]
+        self.store = kittystore.get_store(settings.KITTYSTORE_URL,
+                                          settings.KITTYSTORE_DEBUG)
+        existing_list = self.store.get_list(list_name)
+        if existing_list is not None:
+            self.mlist = MailingList(unicode(list_name),
+                                     existing_list.display_name,
+                                     existing_list.subject_prefix)
+        else:
+            self.mlist = MailingList(unicode(list_name), None, None)
+        if options["jobs"] > 1:
+            pool = Pool(options["jobs"])
+            parse = lambda raws: pool.map(parse_message, raws, chunksize=50)
+        else:
+            pool = None
+            parse = lambda raws: [ parse_message(raw) for raw in raws ]
+        self.seen = set()
+        self.imported = 0
+        self.duplicates = 0
+        self.start_time = time.time()
+        try:
+            for mbfile in args:
+                if self.verbosity >= 1:
+                    self.stdout.write("Importing from mbox file %s\n" % mbfile)
+                # Only a batch of messages is read and parsed at once
+                for raws in chunks(read_mbox(mbfile), self.batch_size):
+                    self.import_messages(parse(raws))
+            self.store.commit()
+            if self.verbosity >= 1:
+                self.stdout.write("Rebuilding the derived data\n")
+            get_pipeline().rebuild(self.store, list_name)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            self.store.close()
+        if self.verbosity >= 1:
+            duration = time.time() - self.start_time
+            self.stdout.write("Imported %d messages in %d seconds "
+                "(%.1f msg/s), %d duplicates skipped\n"
+                % (self.imported, duration,
+                   self.imported / max(duration, 0.001), self.duplicates))
+
+    def import_messages(self, parsed_messages):
+        # The messages are added in the mbox order, the threading depends on it
+        for parsed in parsed_messages:
+            if parsed is None:
+                continue
+            msg_hash, msg = parsed
+            if msg_hash in self.seen or is_stored(self.store, self.mlist, msg):
+                # duplicate in the mbox files or already archived
+                self.duplicates += 1
+                continue
+            self.seen.add(msg_hash)
+            try:
+                self.store.add_to_list(self.mlist, msg)
+            except ValueError, e:
+                self.stderr.write("Could not import message %s: %s\n"
+                                  % (msg["Message-Id"], e.args[0]))
+                continue
+            self.imported += 1
+            if self.imported % self.batch_size == 0:
+                self.store.commit()
+                if self.verbosity >= 1:
+                    duration = time.time() - self.start_time
+                    self.stdout.write("  %d messages imported (%.1f msg/s)\n"
+                                      % (self.imported,
+                                         self.imported / duration))
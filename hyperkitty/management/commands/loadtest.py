@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Load test the WSGI application in-process, with several threads and
+processes, to size a deployment.
+"""
+
+import multiprocessing
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+import kittystore
+
+from hyperkitty.lib.benchmark import percentile
+from hyperkitty.lib.corpus import CorpusGenerator, to_message
+from hyperkitty.lib.loadtest import get_urls, run_worker, run_worker_process
+from hyperkitty.lib.months import MonthsStage
+from hyperkitty.lib.spool import MailingList
+
+
+class Command(BaseCommand):
+    help = "Measure the throughput of the application under concurrent load"
+    option_list = BaseCommand.option_list + (
+        make_option("-t", "--threads", type="int", default=4,
+                    help="number of threads per process (default: %default)"),
+        make_option("-p", "--processes", type="int", default=1,
+                    help="number of processes (default: %default)"),
+        make_option("-d", "--duration", type="float", default=10,
+                    help="duration of the test in seconds "
+                         "(default: %default)"),
+        make_option("--store-url",
+                    help="URL of the KittyStore database "
+                         "(default: the KITTYSTORE_URL setting)"),
+        make_option("--generate", type="int", default=0, metavar="SIZE",
+                    help="first archive SIZE generated messages in the store"),
+        make_option("--server-name", default="localhost",
+                    help="host name of the requests, it must be allowed by "
+                         "the ALLOWED_HOSTS setting (default: %default)"),
+        )
+
+    def handle(self, *args, **options):
+        store_url = options["store_url"] or settings.KITTYSTORE_URL
+        if store_url in ("sqlite:", "sqlite:///:memory:"):
+            raise CommandError("Each thread would get its own empty in-memory "
+                               "database, use a database file")
+        verbosity = int(options["verbosity"])
+        store = kittystore.get_store(store_url, settings.KITTYSTORE_DEBUG)
+        try:
+            if options["generate"]:
+                if verbosity >= 1:
+                    self.stdout.write("Archiving %d messages\n"
+                                      % options["generate"])
+                self._generate(store, options["generate"])
+            urls = get_urls(store)
+        finally:
+            store.close()
+        if not urls:
+            raise CommandError("The archives are empty, use --generate")
+
+        # the stores are given to the views by the WSGI middleware
+        middlewares = [ m for m in settings.MIDDLEWARE_CLASSES if m !=
+                        "hyperkitty.lib.store.KittyStoreDjangoMiddleware" ]
+        with override_settings(KITTYSTORE_URL=store_url,
+                               MIDDLEWARE_CLASSES=middlewares):
+            if verbosity >= 1:
+                self.stdout.write("Requesting %d pages for %ss with %d "
+                        "process(es) of %d thread(s)\n" % (len(urls),
+                        options["duration"], options["processes"],
+                        options["threads"]))
+            worker_args = [ (urls, options["threads"], options["duration"],
+                             num, options["server_name"])
+                            for num in range(options["processes"]) ]
+            if options["processes"] == 1:
+                results = [ run_worker(*worker_args[0]) ]
+            else:
+                # don't share the database connection with the children
+                connection.close()
+                pool = multiprocessing.Pool(options["processes"])
+                try:
+                    results = pool.map(run_worker_process, worker_args)
+                finally:
+                    pool.close()
+                    pool.join()
+        self._report(results, options["duration"])
+
+    def _generate(self, store, size):
+        mlist = MailingList(u"loadtest@example.com", u"Load test", u"")
+        for num, message in enumerate(CorpusGenerator(size)):
+            store.add_to_list(mlist, to_message(message))
+            if num % 100 == 99:
+                store.commit()
+        store.commit()
+        MonthsStage().rebuild(store, mlist.fqdn_listname)
+
+    def _report(self, results, duration):
+        latencies = []
+        for result in results:
+            latencies.extend(result.latencies)
+        if not latencies:
+            raise CommandError("No request was completed")
+        errors = sum(result.errors for result in results)
+        self.stdout.write("Requests:    %d (%d errors)\n"
+                          % (len(latencies), errors))
+        self.stdout.write("Throughput:  %.1f requests/s\n"
+                          % (len(latencies) / duration))
+        self.stdout.write("Latency:     p50 %.1f ms, p90 %.1f ms, "
+                "p99 %.1f ms, max %.1f ms\n" % tuple(
+                percentile(latencies, p) * 1000 for p in (50, 90, 99, 100)))
+        for num, result in enumerate(results):
+            self.stdout.write("Process %d:   %d store connections, %d "
+                    "database connections, %.1f MB max RSS\n" % (num,
+                    result.store_connections, result.db_connections,
+                    result.max_rss / 1024.0 / 1024))
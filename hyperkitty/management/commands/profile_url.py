@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Make a URL profiling a page with the profiling middleware, for users who are
+not superusers.
+"""
+
+import urllib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from hyperkitty.lib.profiling import make_token
+
+
+class Command(BaseCommand):
+    args = "<path>"
+    help = ("Print the URL profiling the given page, valid for "
+            "PROFILE_TOKEN_MAX_AGE seconds")
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the path of the page, "
+                               "like /list/devel@example.com/")
+        path = args[0].partition("?")[0]
+        self.stdout.write("%s?%s\n" % (path,
+                          urllib.urlencode({"profile": make_token(path)})))
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Recompute the data derived from the archives by the archiver pipeline, for
+example after an upgrade which adds new stages.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+import kittystore
+
+from hyperkitty.lib.pipeline import get_pipeline
+
+
+class Command(BaseCommand):
+    args = "[<list_name> ...]"
+    help = "Rebuild the derived data of the given lists (default: all lists)"
+
+    def handle(self, *args, **options):
+        store = kittystore.get_store(settings.KITTYSTORE_URL,
+                                     settings.KITTYSTORE_DEBUG)
+        try:
+            list_names = args or store.get_list_names()
+            for list_name in list_names:
+                if int(options["verbosity"]) >= 1:
+                    self.stdout.write("Rebuilding %s\n" % list_name)
+                get_pipeline().rebuild(store, list_name)
+        finally:
+            store.close()
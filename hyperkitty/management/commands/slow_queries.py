@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+
+"""
+Print the slowest statement shapes of the slow query log (``SLOW_QUERY_LOG``).
+"""
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from hyperkitty.lib.slowqueries import read_log, aggregate
+
+
+class Command(BaseCommand):
+    help = "Print the statements which take the most time in the store"
+    option_list = BaseCommand.option_list + (
+        make_option("-l", "--log",
+                    help="slow query log to read (default: the SLOW_QUERY_LOG "
+                         "setting)"),
+        make_option("-n", "--top", type="int", default=10,
+                    help="number of statements to print (default: %default)"),
+        make_option("-s", "--sort", default="total",
+                    choices=["total", "count", "mean", "max"],
+                    help="sort the statements by total, count, mean or max "
+                         "duration (default: %default)"),
+        make_option("-o", "--origin",
+                    help="only count the statements run for this view "
+                         "(URL name) or path"),
+        )
+
+    def handle(self, *args, **options):
+        path = options["log"] or getattr(settings, "SLOW_QUERY_LOG", None)
+        if not path:
+            raise CommandError("The SLOW_QUERY_LOG setting is missing")
+        try:
+            shapes = aggregate(read_log(path), options["origin"])
+        except IOError, e:
+            raise CommandError("Can't read the slow query log: %s" % e)
+        shapes.sort(key=lambda s: getattr(s, options["sort"]), reverse=True)
+        if not shapes:
+            self.stdout.write("No slow statement\n")
+            return
+        self.stdout.write("%10s %6s %9s %9s  statement\n"
+                          % ("total (ms)", "count", "mean", "max"))
+        for shape in shapes[:options["top"]]:
+            self.stdout.write("%10.1f %6d %9.1f %9.1f  %s\n"
+                              % (shape.total, shape.count, shape.mean,
+                                 shape.max, shape.statement))
+            origins = sorted(shape.origins.items(), key=lambda o: o[1],
+                             reverse=True)
+            self.stdout.write("%38s origins: %s\n" % ("", ", ".join(
+                    "%s (%d)" % origin for origin in origins)))
+            self.stdout.write("%38s slowest: %s\n" % ("", ", ".join(
+                    shape.slowest["params"])))
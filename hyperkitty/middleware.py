@@ -19,6 +19,22 @@
 # Author: Aamir Khan <syst3m.w0rm@gmail.com>
 #
 
+import os
+import time
+import random
+import logging
+import threading
+
+from django.http import HttpResponse
+import django.utils.simplejson as json
+
+from hyperkitty.lib.instrumentation import (start_recording, stop_recording,
+        InstrumentedStore, instrument_templates, instrument_store_db,
+        instrument_db)
+from hyperkitty.lib.metrics import REQUEST_DURATION
+from hyperkitty.lib.profiling import Sampler, check_token
+
+
 class PaginationMiddleware(object):
     """
     Inserts a variable representing the current page onto the request object if
@@ -69,3 +85,161 @@ class SSLRedirect(object):
         """Django can't perform a SSL redirect while maintaining POST data.
            Please structure your views so that redirects only occur during GETs."""
         return HttpResponsePermanentRedirect(newurl)
+
+
+
+timing_logger = logging.getLogger("hyperkitty.timing")
+
+def _instrument_store(request):
+    store = request.environ.get("kittystore.store")
+    if store is not None and not isinstance(store, InstrumentedStore):
+        request.environ["kittystore.store"] = InstrumentedStore(store)
+
+class TimingMiddleware(object):
+    """
+    Time the store calls, the database queries and the template rendering of
+    each request. The timings are logged to the "hyperkitty.timing" logger,
+    and sent in a Server-Timing header to the staff users, or to all the
+    users if ``TIMING_HEADER`` is set. The full list of calls is logged for
+    a sample of the requests slower than ``TIMING_SLOW_THRESHOLD`` seconds.
+
+    It must be placed after the middleware which provides the store.
+    """
+
+    def __init__(self):
+        instrument_templates()
+        instrument_store_db()
+        instrument_db()
+        self.header = getattr(settings, "TIMING_HEADER", False)
+        self.slow_threshold = getattr(settings, "TIMING_SLOW_THRESHOLD", 1.0)
+        self.trace_rate = getattr(settings, "TIMING_TRACE_RATE", 0.1)
+
+    def process_request(self, request):
+        start_recording()
+        _instrument_store(request)
+
+    def process_response(self, request, response):
+        timings = stop_recording()
+        if timings is None:
+            return response
+        total = time.time() - timings.start
+        totals = timings.totals()
+        user = getattr(request, "user", None)
+        if self.header or (user is not None and user.is_staff):
+            response["Server-Timing"] = ", ".join(
+                ['%s;dur=%.1f;desc="%d"' % (kind, duration * 1000, count)
+                 for kind, (count, duration) in sorted(totals.items())]
+                + ["total;dur=%.1f" % (total * 1000)])
+        resolver_match = getattr(request, "resolver_match", None)
+        record = {
+            "path": request.path,
+            "view": resolver_match.url_name if resolver_match else None,
+            "status": response.status_code,
+            "total": round(total * 1000, 1),
+        }
+        for kind, (count, duration) in totals.items():
+            record[kind] = {"count": count,
+                            "duration": round(duration * 1000, 1)}
+        record["store_calls"] = dict(
+                (name, {"count": count, "duration": round(duration * 1000, 1)})
+                for name, (count, duration)
+                in timings.by_name("store").items() )
+        timing_logger.info(json.dumps(record))
+        if total > self.slow_threshold and random.random() < self.trace_rate:
+            timing_logger.warning("Slow request %s: %s" % (request.path,
+                json.dumps([ {"kind": kind, "name": name,
+                              "start": None if start is None
+                                       else round(start * 1000, 1),
+                              "duration": round(duration * 1000, 1),
+                              "depth": depth}
+                             for kind, name, start, duration, depth
+                             in timings.events ])))
+        return response
+
+
+class MetricsMiddleware(object):
+    """
+    Measure the latency of the requests by URL name, and count the store
+    calls, for the metrics view.
+
+    It must be placed after the middleware which provides the store.
+    """
+
+    def process_request(self, request):
+        request._metrics_start = time.time()
+        _instrument_store(request)
+
+    def process_response(self, request, response):
+        if not hasattr(request, "_metrics_start"):
+            return response
+        resolver_match = getattr(request, "resolver_match", None)
+        if resolver_match is None:
+            view = "unknown"
+        else:
+            view = resolver_match.url_name or "other"
+        REQUEST_DURATION.observe(time.time() - request._metrics_start,
+                                 view=view)
+        return response
+
+
+
+_hot_sampler = None
+
+class ProfilingMiddleware(object):
+    """
+    Profile a single request when the ``profile`` query parameter is set to
+    ``1`` by a superuser, or to a token made by the ``profile_url`` command.
+    The sampled stacks are returned instead of the page, in the collapsed
+    format of the flamegraph tools, or written to the ``PROFILE_DIR``
+    directory if it is set.
+
+    If ``PROFILE_SAMPLER_INTERVAL`` is set, a background thread also samples
+    the stacks of all the threads at that interval (in seconds), and
+    ``profile=hot`` returns the aggregated stacks.
+
+    It must be placed after the authentication middleware.
+    """
+
+    def __init__(self):
+        global _hot_sampler
+        self.interval = getattr(settings, "PROFILE_INTERVAL", 0.005)
+        self.directory = getattr(settings, "PROFILE_DIR", None)
+        self.token_max_age = getattr(settings, "PROFILE_TOKEN_MAX_AGE", 3600)
+        sampler_interval = getattr(settings, "PROFILE_SAMPLER_INTERVAL", None)
+        if sampler_interval and _hot_sampler is None:
+            _hot_sampler = Sampler(sampler_interval)
+            _hot_sampler.start()
+
+    def _allowed(self, request, value):
+        if value == "1" or value == "hot":
+            return request.user.is_superuser
+        return check_token(value, request.path, self.token_max_age)
+
+    def process_request(self, request):
+        value = request.GET.get("profile")
+        if not value or not self._allowed(request, value):
+            return
+        if value == "hot":
+            if _hot_sampler is None:
+                return HttpResponse("The background sampler is disabled",
+                                    content_type="text/plain", status=404)
+            return HttpResponse(_hot_sampler.collapsed(),
+                                content_type="text/plain")
+        request._profiler = Sampler(self.interval,
+                                    threading.current_thread().ident)
+        request._profiler.start()
+
+    def process_response(self, request, response):
+        profiler = getattr(request, "_profiler", None)
+        if profiler is None:
+            return response
+        profiler.stop()
+        if self.directory is None:
+            return HttpResponse(profiler.collapsed(),
+                                content_type="text/plain")
+        filename = "%s-%d.folded" % (time.strftime("%Y%m%d-%H%M%S"),
+                                     os.getpid())
+        with open(os.path.join(self.directory, filename), "w") as output:
+            output.write(profiler.collapsed())
+        response["X-Profile"] = filename
+        return response
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'SenderKarma'
+        db.create_table('hyperkitty_senderkarma', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('list_address', self.gf('django.db.models.fields.CharField')(max_length=50)),
+            ('sender_email', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('sender_name', self.gf('django.db.models.fields.CharField')(max_length=255, blank=True)),
+            ('period', self.gf('django.db.models.fields.DateField')()),
+            ('posts', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('likes', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('dislikes', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('score', self.gf('django.db.models.fields.IntegerField')(default=0, db_index=True)),
+        ))
+        db.send_create_signal('hyperkitty', ['SenderKarma'])
+
+        # Adding unique constraint on 'SenderKarma', fields ['list_address', 'period', 'sender_email']
+        db.create_unique('hyperkitty_senderkarma', ['list_address', 'period', 'sender_email'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'SenderKarma', fields ['list_address', 'period', 'sender_email']
+        db.delete_unique('hyperkitty_senderkarma', ['list_address', 'period', 'sender_email'])
+
+        # Deleting model 'SenderKarma'
+        db.delete_table('hyperkitty_senderkarma')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'hyperkitty.favorite': {
+            'Meta': {'object_name': 'Favorite'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'list_address': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'threadid': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'hyperkitty.rating': {
+            'Meta': {'object_name': 'Rating'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'list_address': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'messageid': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'vote': ('django.db.models.fields.SmallIntegerField', [], {})
+        },
+        'hyperkitty.senderkarma': {
+            'Meta': {'unique_together': "(('list_address', 'period', 'sender_email'),)", 'object_name': 'SenderKarma'},
+            'dislikes': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'likes': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'list_address': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'period': ('django.db.models.fields.DateField', [], {}),
+            'posts': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'score': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_index': 'True'}),
+            'sender_email': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'sender_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'})
+        },
+        'hyperkitty.tag': {
+            'Meta': {'object_name': 'Tag'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'list_address': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'tag': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'threadid': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'hyperkitty.userprofile': {
+            'Meta': {'object_name': 'UserProfile'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'karma': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True'})
+        }
+    }
+
+    complete_apps = ['hyperkitty']
\ No newline at end of file
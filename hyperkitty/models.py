@@ -20,6 +20,9 @@
 #
 
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.contrib import admin
@@ -67,7 +70,7 @@ class Tag(models.Model):
     # @TODO: instead of threadid, use thread model from kittystore?
     threadid = models.CharField(max_length=100)
 
-    tag = models.CharField(max_length=255)
+    tag = models.CharField(max_length=255, db_index=True)
 
     def __unicode__(self):
         """Unicode representation"""
@@ -88,3 +91,81 @@ class Favorite(models.Model):
                 unicode(self.user))
 
 admin.site.register(Favorite)
+
+
+class SenderKarma(models.Model):
+    """
+    Score of a sender on a mailing-list for a given month, derived from the
+    posted messages and the votes on them. Used as a leaderboard.
+    """
+    list_address = models.CharField(max_length=50)
+    sender_email = models.CharField(max_length=255)
+    sender_name = models.CharField(max_length=255, blank=True)
+    period = models.DateField() # first day of the month
+    posts = models.IntegerField(default=0)
+    likes = models.IntegerField(default=0)
+    dislikes = models.IntegerField(default=0)
+    score = models.IntegerField(default=0, db_index=True)
+
+    class Meta:
+        unique_together = ("list_address", "period", "sender_email")
+
+    def __unicode__(self):
+        """Unicode representation"""
+        return u"%s has a karma of %d on %s in %s" % (
+                unicode(self.sender_email), self.score,
+                unicode(self.list_address), self.period.strftime("%Y-%m"))
+
+
+class TagStats(models.Model):
+    """
+    Number of threads a tag is set on in a mailing-list, kept up to date when
+    tags are added or removed. The (list_address, tag) index is used for the
+    tag autocompletion.
+    """
+    list_address = models.CharField(max_length=50)
+    tag = models.CharField(max_length=255, db_index=True)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("list_address", "tag")
+
+    def __unicode__(self):
+        """Unicode representation"""
+        return u"Tag %s is set %d times in list %s" % (unicode(self.tag),
+                self.count, unicode(self.list_address))
+
+
+class ArchiveMonth(models.Model):
+    """
+    Number of messages archived in a mailing-list for a given month, kept up
+    to date by the archiver. Lists the months to show in the archives.
+    """
+    list_address = models.CharField(max_length=50)
+    month = models.DateField() # first day of the month
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("list_address", "month")
+
+    def __unicode__(self):
+        """Unicode representation"""
+        return u"%d messages in list %s in %s" % (self.count,
+                unicode(self.list_address), self.month.strftime("%Y-%m"))
+
+
+@receiver(post_save, sender=Tag)
+def on_tag_added(sender, instance, created, **kwargs):
+    if not created:
+        return
+    stats, _created = TagStats.objects.get_or_create(
+            list_address=instance.list_address, tag=instance.tag)
+    TagStats.objects.filter(pk=stats.pk).update(count=F("count") + 1)
+
+
+@receiver(post_delete, sender=Tag)
+def on_tag_removed(sender, instance, **kwargs):
+    stats = TagStats.objects.filter(list_address=instance.list_address,
+                                    tag=instance.tag)
+    stats.update(count=F("count") - 1)
+    stats.filter(count__lte=0).delete()
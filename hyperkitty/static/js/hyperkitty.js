@@ -73,7 +73,16 @@ function setup_vote() {
  */
 
 function setup_add_tag() {
-    $("#add-tag-form").submit( function () {
+    var form = $("#add-tag-form");
+    form.find("input[name='tag']").attr("autocomplete", "off").typeahead({
+        source: function (query, process) {
+            $.getJSON(form.attr("data-suggest"), {q: query}, function(data) {
+                process(data.tags);
+            });
+        },
+        minLength: 1
+    });
+    form.submit( function () {
         $.ajax({
             type: "POST",
             dataType: "json",
@@ -144,8 +153,9 @@ function setup_favorites() {
  * Replies
  */
 
-function setup_replies() {
-    $("a.reply").click(function(e) {
+function setup_replies(root) {
+    root = $(root || document);
+    root.find("a.reply").click(function(e) {
         e.preventDefault();
         if (!$(this).hasClass("disabled")) {
             $(this).next().slideToggle("fast", function() {
@@ -155,7 +165,7 @@ function setup_replies() {
             });
         }
     });
-    $(".reply-form button[type='submit']").click(function(e) {
+    root.find(".reply-form button[type='submit']").click(function(e) {
         e.preventDefault();
         var form = $(this).parents("form").first();
         var data = form_to_json(form);
@@ -181,11 +191,11 @@ function setup_replies() {
             }
         });
     });
-    $(".reply-form a.cancel").click(function(e) {
+    root.find(".reply-form a.cancel").click(function(e) {
         e.preventDefault();
         $(this).parents(".reply-form").first().slideUp();
     });
-    $(".reply-form a.quote").click(function(e) {
+    root.find(".reply-form a.quote").click(function(e) {
         e.preventDefault();
         var quoted = $(this).parents(".email").first()
                         .find(".email-body").clone()
@@ -207,6 +217,46 @@ function setup_replies() {
 }
 
 
+/*
+ * Thread view
+ */
+
+function fold_quotes(root) {
+    $(root).find('div.email-body .quoted-text').each(function() {
+        var linescount = $(this).text().split("\n").length;
+        if (linescount > 3) {
+            // hide if the quote is more than 3 lines long
+            $(this).hide();
+        }
+    });
+}
+
+function setup_thread_replies() {
+    // load the collapsed or paginated replies
+    $("#thread-content").on("click", ".hidden-replies a, .more-replies a",
+                            function(e) {
+        e.preventDefault();
+        var container = $(this).parent();
+        $.ajax({
+            url: $(this).attr("href"),
+            dataType: "json",
+            success: function(data) {
+                var replies = $("<div/>").html(data.html);
+                fold_quotes(replies);
+                setup_attachments(replies);
+                setup_quotes(replies);
+                setup_replies(replies);
+                setup_disabled_tooltips(replies);
+                container.replaceWith(replies);
+            },
+            error: function(jqXHR, textStatus, errorThrown) {
+                alert(jqXHR.responseText);
+            }
+        });
+    });
+}
+
+
 /*
  * Recent activity graph
  */
@@ -297,8 +347,8 @@ function activity_graph(elem_id, dates, counts, baseurl) {
  * Misc.
  */
 
-function setup_attachments() {
-    $(".email-info .attachments a.attachments").each(function() {
+function setup_attachments(root) {
+    $(root || document).find(".email-info .attachments a.attachments").each(function() {
         var att_list = $(this).next("ul.attachments-list");
         var pos = $(this).position();
         att_list.css("left", pos.left);
@@ -308,8 +358,8 @@ function setup_attachments() {
     });
 }
 
-function setup_quotes() {
-    $('div.email-body .quoted-switch a')
+function setup_quotes(root) {
+    $(root || document).find('div.email-body .quoted-switch a')
         .click(function(e) {
             e.preventDefault();
             $(this).parent().next(".quoted-text").slideToggle('fast');
@@ -326,8 +376,8 @@ function setup_months_list() {
     $("#months-list").accordion({ collapsible: true, active: current });
 }
 
-function setup_disabled_tooltips() {
-    $("a.disabled").tooltip().click(function (e) {
+function setup_disabled_tooltips(root) {
+    $(root || document).find("a.disabled").tooltip().click(function (e) {
         e.preventDefault();
     });
 }
@@ -24,11 +24,16 @@ import re
 
 from dateutil.tz import tzutc, tzoffset
 from django import template
+from django.conf import settings
+from django.template.defaultfilters import wordwrap, urlizetrunc
 from django.utils.datastructures import SortedDict
 from django.templatetags.tz import localtime
 from django.utils.html import conditional_escape
 from django.utils.safestring import mark_safe
 
+from hyperkitty.lib.cache import TieredCache
+from hyperkitty.lib.metrics import record_cache_lookup
+
 register = template.Library()
 
 
@@ -148,32 +153,55 @@ def snip_quoted(content, quotemsg="...", autoescape=None):
     """Snip quoted text in messages"""
     if autoescape:
         content = conditional_escape(content)
-    quoted = []
+    output = []
     current_quote = []
     current_quote_orig = []
-    lastline = None
     for line in content.split("\n"):
         match = SNIPPED_RE.match(line)
         if match is not None:
-            #if lastline == "":
-            #    current_quote_orig.append(lastline)
             current_quote_orig.append(line)
             content_start = len(match.group(1))
             current_quote.append(line[content_start:])
+        elif current_quote:
+            # the quote replaces the line break before the current line
+            output.append('<div class="quoted-switch"><a href="#">%s</a></div>'
+                          % quotemsg
+                          + '<div class="quoted-text">'
+                          + "\n".join(current_quote)
+                          + ' </div>' + line)
+            current_quote = []
+            current_quote_orig = []
         else:
-            if current_quote_orig:
-                current_quote_orig.append("")
-                quoted.append( (current_quote_orig[:], current_quote[:]) )
-                current_quote = []
-                current_quote_orig = []
-        lastline = line
-    for quote_orig, quote in quoted:
-        replaced = ('<div class="quoted-switch"><a href="#">%s</a></div>' % quotemsg
-                   +'<div class="quoted-text">'
-                   +"\n".join(quote)
-                   +' </div>')
-        content = content.replace("\n".join(quote_orig), replaced)
-    return mark_safe(content)
+            output.append(line)
+    # a quote at the very end of the message is left as is
+    output.extend(current_quote_orig)
+    return mark_safe("\n".join(output))
+
+
+# Bump this number when the rendering of the message bodies changes
+BODY_RENDER_VERSION = 2
+_body_cache = TieredCache(
+        getattr(settings, "MESSAGE_BODY_CACHE_SIZE", 1000),
+        getattr(settings, "MESSAGE_BODY_CACHE_BACKEND", None))
+
+@register.filter(is_safe=True)
+def render_body(email):
+    """
+    Render the body of a message: quote snipping, line wrapping, links and
+    address obfuscation. Archived messages never change, so the result is
+    cached.
+    """
+    key = "hyperkitty:body:%d:%s:%s" % (BODY_RENDER_VERSION,
+            email.list_name, email.message_id_hash)
+    html = _body_cache.get(key)
+    record_cache_lookup("message_body", html is not None)
+    if html is None:
+        html = snip_quoted(email.content, autoescape=True)
+        html = wordwrap(html, 90)
+        html = urlizetrunc(html, 76, autoescape=True)
+        html = escapeemail(html)
+        _body_cache.set(key, unicode(html))
+    return mark_safe(html)
 
 
 @register.filter()
@@ -24,3 +24,4 @@ from hyperkitty.tests.test_models import *
 from hyperkitty.tests.test_forms import *
 from hyperkitty.tests.test_templatetags import *
 from hyperkitty.tests.test_lib import *
+from hyperkitty.tests.test_commands import *
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+"""
+Micro-benchmarks of the template filters used to render the messages.
+
+This module is not part of the test suite, run it with:
+
+    DJANGO_SETTINGS_MODULE=settings python -m hyperkitty.tests.bench_templatetags
+
+Each filter is run over a generated corpus of messages. Since the absolute
+speeds depend on the machine, a reference loop which does not use HyperKitty
+is timed in the same run, and each filter's speed is stored relative to it.
+Those ratios are compared to the baseline stored in ``bench_baseline.json``:
+the run fails if a filter is slower than the baseline by more than the
+tolerance. Use ``--save-baseline`` to store the results of the run as the new
+baseline, and ``--report-only`` to never fail.
+
+The allocations are the number of container objects (lists, dicts,
+tuples...) created per call and not freed, as counted by the garbage
+collector.
+
+The ``--scaling`` option times snip_quoted on bodies with 10 to 1000 quote
+blocks: the time per block should stay roughly constant, showing that it
+runs in linear time.
+"""
+
+import os
+import gc
+import sys
+import random
+import datetime
+import timeit
+from optparse import OptionParser
+from collections import namedtuple
+
+import django.utils.simplejson as json
+
+from hyperkitty.templatetags.hk_generic import trimString, truncatesmart, \
+        escapeemail, snip_quoted, sender_date, viewer_date, listsort
+from hyperkitty.templatetags.storm import strip_subject
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "bench_baseline.json")
+TOLERANCE = 0.25
+BLOCK_COUNTS = (10, 30, 100, 300, 1000)
+
+FakeEmail = namedtuple("FakeEmail", ["subject", "content", "date", "timezone"])
+FakeMList = namedtuple("FakeMList", ["name", "display_name"])
+
+WORDS = ("the package update build release fedora kernel python fix "
+         "review meeting proposal guidelines bug spec mirror").split()
+
+
+def make_body(blocks):
+    """Build a message body with the given number of interleaved quotes."""
+    lines = []
+    for num in range(blocks):
+        lines.append("On day %d, someone wrote:" % num)
+        lines.extend("&gt; quoted line %d of block %d" % (line, num)
+                     for line in range(3))
+        lines.append("Answer to block %d" % num)
+        lines.append("")
+    return "\n".join(lines)
+
+
+def _sentence(rng, length):
+    return " ".join(rng.choice(WORDS) for i in range(length))
+
+
+def make_corpus(size=500, seed=42):
+    """Generate messages similar to a real archive.
+
+    :returns: A list of fake emails.
+    """
+    rng = random.Random(seed)
+    emails = []
+    start = datetime.datetime(2012, 1, 1)
+    for num in range(size):
+        lines = []
+        for paragraph in range(rng.randint(1, 6)):
+            if rng.random() < 0.4:
+                lines.append("On Monday, someone <someone@example.com> wrote:")
+                lines.extend("&gt; " + _sentence(rng, rng.randint(4, 12))
+                             for i in range(rng.randint(1, 8)))
+            lines.extend(_sentence(rng, rng.randint(4, 15))
+                         for i in range(rng.randint(1, 5)))
+            if rng.random() < 0.3:
+                lines.append("See http://example.com/%s/%d for details"
+                             % (rng.choice(WORDS), num))
+            lines.append("")
+        lines.extend(["-- ", "Sender %d <sender%d@example.com>" % (num, num)])
+        subject = "[Devel] " + ("Re: " * rng.randint(0, 2)) + \
+                  _sentence(rng, rng.randint(2, 16))
+        date = start + datetime.timedelta(minutes=rng.randint(0, 500000))
+        emails.append(FakeEmail(subject, "\n".join(lines), date,
+                                rng.choice([-480, -300, 0, 60, 120, 330])))
+    return emails
+
+
+def reference(corpus):
+    """Pure Python string work, which the filter speeds are relative to."""
+    return [ " ".join(sorted(e.subject.lower().split())) for e in corpus ]
+
+
+def get_benchmarks(corpus):
+    """Return the benchmarked calls, each running a filter on the corpus."""
+    mlist = FakeMList("devel@example.com", "Devel")
+    months = dict( (year, range(1, 13)) for year in range(2000, 2013) )
+    participants = dict( ("Sender %d" % num, "sender%d@example.com" % num)
+                         for num in range(50) )
+    def run(func, items):
+        return lambda: [ func(item) for item in items ]
+    return [
+        ("trimString", run(trimString, [ e.subject for e in corpus ])),
+        ("truncatesmart", run(truncatesmart, [ e.subject for e in corpus ])),
+        ("escapeemail", run(escapeemail, [ e.content for e in corpus ])),
+        ("snip_quoted", run(snip_quoted, [ e.content for e in corpus ])),
+        ("sender_date", run(sender_date, corpus)),
+        ("viewer_date", run(viewer_date, corpus)),
+        ("listsort", run(listsort, [ dict(months) for e in corpus[:100] ]
+                                 + [ participants.items() ] * 100)),
+        ("strip_subject", run(lambda s: strip_subject(s, mlist),
+                              [ e.subject for e in corpus ])),
+    ]
+
+
+def measure(func, calls, min_time=0.2, repeat=5):
+    """Measure the speed and the allocations of a benchmarked call.
+
+    :param calls: The number of filter calls the benchmarked call makes.
+    :returns: A dict with the filter calls per second and the allocations
+        per filter call.
+    """
+    number = 1
+    while timeit.timeit(func, number=number) < min_time:
+        number *= 2
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        func()
+        allocations = gc.get_count()[0] - before
+    finally:
+        gc.enable()
+    return {
+        "ops": calls * number / best,
+        "allocations": float(allocations) / calls,
+    }
+
+
+def run_benchmarks(corpus, names=None):
+    """Measure the filters, see :func:`measure`.
+
+    :returns: A dict of results by filter name, which also have the
+        ``relative`` key: their speed relative to the reference loop.
+    """
+    reference_ops = measure(lambda: reference(corpus), len(corpus))["ops"]
+    results = {}
+    for name, func in get_benchmarks(corpus):
+        if names and name not in names:
+            continue
+        # all the benchmarks make one call per item, except listsort
+        calls = 200 if name == "listsort" else len(corpus)
+        results[name] = measure(func, calls)
+        results[name]["relative"] = results[name]["ops"] / reference_ops
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Return the names of the filters slower than the baseline.
+
+    The relative speeds are compared, the absolute speeds of a baseline saved
+    on another machine are meaningless.
+    """
+    regressions = []
+    for name, result in results.items():
+        if "relative" not in baseline.get(name, {}):
+            continue
+        if result["relative"] < baseline[name]["relative"] * (1 - tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def bench_snip_quoted(block_counts=BLOCK_COUNTS, repeat=3):
+    """Time snip_quoted on bodies with increasing numbers of quotes.
+
+    :returns: A list of couples formed of the number of quote blocks and the
+        best time in seconds.
+    """
+    results = []
+    for blocks in block_counts:
+        body = make_body(blocks)
+        number = max(1, 10000 // blocks)
+        best = min(timeit.repeat(lambda: snip_quoted(body),
+                                 repeat=repeat, number=number))
+        results.append( (blocks, best / number) )
+    return results
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [filter...]")
+    parser.add_option("--size", type="int", default=500,
+                      help="number of messages in the corpus")
+    parser.add_option("--baseline", default=BASELINE,
+                      help="baseline file (default: %default)")
+    parser.add_option("--tolerance", type="float", default=TOLERANCE,
+                      help="accepted slowdown ratio (default: %default)")
+    parser.add_option("--save-baseline", action="store_true",
+                      help="store the results as the new baseline")
+    parser.add_option("--report-only", action="store_true",
+                      help="do not fail on regressions")
+    parser.add_option("--scaling", action="store_true",
+                      help="show how snip_quoted scales with the quotes")
+    opts, args = parser.parse_args()
+
+    if opts.scaling:
+        print "%8s %14s %16s" % ("blocks", "time (ms)", "per block (us)")
+        for blocks, duration in bench_snip_quoted():
+            print "%8d %14.3f %16.2f" % (blocks, duration * 1000,
+                                         duration / blocks * 1000000)
+        return 0
+
+    results = run_benchmarks(make_corpus(opts.size), args)
+    baseline = {}
+    if os.path.exists(opts.baseline):
+        with open(opts.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions = compare(results, baseline, opts.tolerance)
+
+    print "%-16s %14s %10s %10s %12s" % ("filter", "ops/sec", "relative",
+                                          "baseline", "allocations")
+    for name in sorted(results):
+        result = results[name]
+        if "relative" in baseline.get(name, {}):
+            expected = "%10.2f" % baseline[name]["relative"]
+        else:
+            expected = "%10s" % "-"
+        print "%-16s %14.0f %10.2f %s %12.2f%s" % (name, result["ops"],
+                result["relative"], expected, result["allocations"],
+                " REGRESSION" if name in regressions else "")
+
+    if opts.save_baseline:
+        baseline.update(results)
+        with open(opts.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=4, sort_keys=True)
+        print "Baseline saved to %s" % opts.baseline
+        return 0
+    if regressions and not opts.report_only:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
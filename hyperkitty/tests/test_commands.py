@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aamir Khan <syst3m.w0rm@gmail.com>
+#
+
+import os
+import shutil
+import mailbox
+import tempfile
+from StringIO import StringIO
+from email.message import Message
+
+from mock import Mock, patch
+from django.test import TestCase
+from django.core.management import call_command
+
+from hyperkitty.lib.fakestore import FakeStore
+from hyperkitty.lib.spool import MailingList
+from hyperkitty.management.commands.import_mbox import chunks
+
+
+class ImportMboxTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+        self.store = Mock(wraps=FakeStore())
+        self.pipeline = Mock()
+        self.mlist = MailingList(u"list@example.com", u"List", u"")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_message(self, num):
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg%d@example.com>" % num
+        msg["Subject"] = "Dummy subject %d" % num
+        msg["Date"] = "Tue, %02d Jan 2013 00:00:00 +0000" % (num + 1)
+        msg.set_payload("Dummy content %d" % num)
+        return msg
+
+    def _make_mbox(self, name, nums):
+        path = os.path.join(self.tmpdir, name)
+        mbox = mailbox.mbox(path)
+        for num in nums:
+            mbox.add(self._make_message(num))
+        mbox.close()
+        return path
+
+    def _import(self, *paths, **options):
+        with patch("kittystore.get_store", return_value=self.store):
+            with patch("hyperkitty.management.commands.import_mbox."
+                       "get_pipeline", return_value=self.pipeline):
+                output = StringIO()
+                call_command("import_mbox", *paths,
+                             list_name="list@example.com", stdout=output,
+                             **options)
+        return output.getvalue()
+
+    def test_import(self):
+        path = self._make_mbox("first.mbox", range(5))
+        output = self._import(path, jobs=1, batch_size=2)
+        self.assertEqual(self.store.add_to_list.call_count, 5)
+        self.assertEqual(self.store.get_list_size(u"list@example.com"), 5)
+        # every 2 messages, and at the end
+        self.assertEqual(self.store.commit.call_count, 3)
+        self.pipeline.rebuild.assert_called_once_with(self.store,
+                                                      "list@example.com")
+        self.assertTrue("Imported 5 messages" in output)
+
+    def test_duplicates(self):
+        self.store.add_to_list(self.mlist, self._make_message(0))
+        self.store.add_to_list.reset_mock()
+        first = self._make_mbox("first.mbox", range(3))
+        second = self._make_mbox("second.mbox", range(2, 4))
+        output = self._import(first, second, jobs=1)
+        # message 0 is in the store, message 2 in both files
+        self.assertEqual(self.store.add_to_list.call_count, 3)
+        self.assertEqual(self.store.get_list_size(u"list@example.com"), 4)
+        self.assertTrue("Imported 3 messages" in output)
+        self.assertTrue("2 duplicates skipped" in output)
+
+    def test_parallel(self):
+        path = self._make_mbox("first.mbox", range(5))
+        self._import(path, jobs=2, batch_size=2)
+        self.assertEqual([ call[0][1]["Message-ID"] for call
+                           in self.store.add_to_list.call_args_list ],
+                         [ "<msg%d@example.com>" % num for num in range(5) ])
+
+    def test_chunks(self):
+        self.assertEqual(list(chunks(iter(range(5)), 2)),
+                         [ [0, 1], [2, 3], [4] ])
@@ -19,11 +19,52 @@
 # Author: Aamir Khan <syst3m.w0rm@gmail.com>
 #
 
+import os
+import time
 import datetime
+import threading
+import shutil
+import tempfile
+from email.message import Message
 
+from mock import Mock, MagicMock, patch
+from storm.tracer import install_tracer, remove_tracer
+import kittystore
+from kittystore.utils import get_message_id_hash
 from django.test import TestCase
+from django.core.cache import cache
+from django.contrib.auth.models import User
 
 from hyperkitty.lib import get_display_dates
+from hyperkitty.lib.spool import (ArchiveSpool, SpoolConsumer, MailingList,
+        get_spool_dir)
+from hyperkitty.lib.pipeline import Stage, Pipeline, run_pipeline
+from hyperkitty.lib.karma import record_vote, get_top_authors, KarmaStage
+from hyperkitty.lib import months
+from hyperkitty.lib.months import get_months, MonthsStage
+from hyperkitty.lib import threadindex
+from hyperkitty.lib.threadindex import (ThreadIndex, ThreadIndexStage,
+        get_thread_index, get_read_threads, mark_read)
+from hyperkitty.lib.categories import (get_threads_per_category,
+        update_categories, CategoriesStage, CategoryThread)
+from hyperkitty.lib.tags import get_tag_cloud, get_tag_suggestions
+from hyperkitty.lib.cache import LRUCache, TieredCache, MAX_TIMEOUT
+from hyperkitty.lib.threads import (LayoutEntry, collapse, get_subtree,
+        get_thread_layout)
+from hyperkitty.lib.corpus import CorpusGenerator, to_message
+from hyperkitty.lib.fakestore import FakeStore
+from hyperkitty.lib.store import KittyStoreWSGIMiddleware, get_store_count
+from hyperkitty.lib.queries import (KeysetPage, get_thread_summaries,
+        count_participants, count_thread_participants, count_messages,
+        count_threads, get_thread_at, get_email_id_hashes,
+        get_attachments_by_ids, get_existing_thread_ids, ThreadSequence)
+from hyperkitty.lib.loadtest import request
+from hyperkitty.lib.metrics import Counter, Histogram
+from hyperkitty.lib.profiling import Sampler, make_token, check_token
+from hyperkitty.lib.slowqueries import (SlowQueryTracer, normalize, read_log,
+        aggregate, set_origin)
+from hyperkitty.models import (SenderKarma, UserProfile, Tag, TagStats,
+        ArchiveMonth, Rating)
 
 
 class GetDisplayDatesTestCase(TestCase):
@@ -45,3 +86,993 @@ class GetDisplayDatesTestCase(TestCase):
         begin_date, end_date = get_display_dates('2012', '4', '2')
         self.assertEqual(begin_date, datetime.datetime(2012, 4, 2))
         self.assertEqual(end_date, datetime.datetime(2012, 4, 3))
+
+
+class ArchiveSpoolTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+        self.spool = ArchiveSpool(self.tmpdir)
+        self.mlist = MailingList("list@example.com", u"List", u"[List] ")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_message(self, msg_id):
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<%s>" % msg_id
+        msg["Subject"] = "Testing"
+        msg.set_payload("Dummy message")
+        return msg
+
+    def test_put_get(self):
+        key = self.spool.put(self.mlist, self._make_message("msg1"))
+        self.assertEqual(len(self.spool), 1)
+        mlist, msg = self.spool.get(key)
+        self.assertEqual(mlist, self.mlist)
+        self.assertEqual(msg["Message-ID"], "<msg1>")
+        self.assertEqual(msg.get_payload(), "Dummy message")
+
+    def test_order(self):
+        keys = [ self.spool.put(self.mlist, self._make_message("msg%d" % i))
+                 for i in range(5) ]
+        self.assertEqual(self.spool.keys(), keys)
+
+    def test_min_age(self):
+        key = self.spool.put(self.mlist, self._make_message("msg1"))
+        self.assertEqual(self.spool.keys(min_age=60), [])
+        old_key = "%016d%s" % (int((time.time() - 120) * 1000000),
+                               key[16:].replace(".0", ".1", 1))
+        os.rename(os.path.join(self.tmpdir, "new", key),
+                  os.path.join(self.tmpdir, "new", old_key))
+        self.assertEqual(self.spool.keys(min_age=60), [old_key])
+        self.assertTrue(self.spool.age(old_key) >= 120)
+
+    def test_remove(self):
+        key = self.spool.put(self.mlist, self._make_message("msg1"))
+        self.spool.remove(key)
+        self.assertEqual(len(self.spool), 0)
+        self.spool.remove(key) # no error on already removed messages
+
+    def test_consume(self):
+        for i in range(3):
+            self.spool.put(self.mlist, self._make_message("msg%d" % i))
+        store = Mock()
+        store.is_message_in_list.return_value = 0
+        consumer = SpoolConsumer(self.spool, store, batch_size=2)
+        self.assertEqual(consumer.consume_batch(), 2)
+        self.assertEqual(consumer.consume_batch(), 1)
+        self.assertEqual(len(self.spool), 0)
+        archived = [ call[0][1]["Message-ID"]
+                     for call in store.add_to_list.call_args_list ]
+        self.assertEqual(archived, ["<msg0>", "<msg1>", "<msg2>"])
+        self.assertEqual(store.commit.call_count, 2)
+        self.assertEqual(self.spool.stats()["archived"], 3)
+
+    def test_add_archived_concurrently(self):
+        def add():
+            for i in range(50):
+                self.spool.add_archived(1)
+        threads = [ threading.Thread(target=add) for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.spool.stats()["archived"], 200)
+
+    def test_consume_failure(self):
+        for i in range(2):
+            self.spool.put(self.mlist, self._make_message("msg%d" % i))
+        store = Mock()
+        store.is_message_in_list.return_value = 0
+        store.add_to_list.side_effect = lambda l, m: \
+                m["Message-ID"] == "<msg1>" and 1/0
+        consumer = SpoolConsumer(self.spool, store, max_retries=2)
+        self.assertEqual(consumer.consume_batch(), 0)
+        self.assertEqual(len(self.spool), 2) # will be retried
+        self.assertEqual(consumer.consume_batch(), 0)
+        self.assertEqual(len(self.spool), 1) # given up on msg1
+        self.assertEqual(self.spool.stats()["failed"], 1)
+        self.assertFalse(store.commit.called)
+        self.assertEqual(consumer.consume_batch(), 1)
+
+    def test_consume_removed(self):
+        # archived by a concurrent consumer
+        keys = [ self.spool.put(self.mlist, self._make_message("msg%d" % i))
+                 for i in range(2) ]
+        self.spool.remove(keys[0])
+        store = Mock()
+        store.is_message_in_list.return_value = 0
+        consumer = SpoolConsumer(self.spool, store)
+        self.assertEqual(consumer.consume(keys), 2)
+        self.assertEqual(store.add_to_list.call_count, 1)
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(self.spool.stats()["archived"], 1)
+
+    def test_spool_dir(self):
+        with self.settings(ARCHIVER_SPOOL_DIR=self.tmpdir):
+            self.assertEqual(get_spool_dir(), self.tmpdir)
+
+    def test_consume_stored(self):
+        # committed by a process which died before cleaning the spool
+        store = FakeStore()
+        store.add_to_list(self.mlist, self._make_message("msg0"))
+        for i in range(2):
+            self.spool.put(self.mlist, self._make_message("msg%d" % i))
+        post_archive = Mock()
+        consumer = SpoolConsumer(self.spool, store, post_archive=post_archive)
+        self.assertEqual(consumer.consume_batch(), 2)
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(post_archive.call_args[0][0],
+                [ ("list@example.com", get_message_id_hash("msg1")) ])
+
+
+class PipelineTestCase(TestCase):
+
+    def _make_stage(self, deferred=False):
+        stage = Stage()
+        stage.deferred = deferred
+        stage.processed = []
+        stage.process = lambda store, list_name, email: \
+                stage.processed.append( (list_name, email) )
+        return stage
+
+    def test_run(self):
+        inline = self._make_stage()
+        deferred = self._make_stage(deferred=True)
+        pipeline = Pipeline([inline, deferred])
+        self.assertTrue(pipeline.has_deferred)
+        pipeline.run(Mock(), "list@example.com", ["msg1", "msg2"],
+                     deferred=False)
+        self.assertEqual(inline.processed, [("list@example.com", "msg1"),
+                                            ("list@example.com", "msg2")])
+        self.assertEqual(deferred.processed, [])
+        pipeline.run(Mock(), "list@example.com", ["msg3"])
+        self.assertEqual(deferred.processed, [("list@example.com", "msg3")])
+
+    def test_failing_stage(self):
+        failing = Stage() # process() is not implemented
+        stage = self._make_stage()
+        pipeline = Pipeline([failing, stage])
+        pipeline.run(Mock(), "list@example.com", ["msg1"])
+        self.assertEqual(stage.processed, [("list@example.com", "msg1")])
+
+    def test_run_pipeline(self):
+        stage = self._make_stage()
+        store = FakeStore()
+        mlist = MailingList("list@example.com", u"List", u"[List] ")
+        messages = list(CorpusGenerator(5, seed=1))
+        store.add_corpus(mlist, messages)
+        archived = [ ("list@example.com", get_message_id_hash(m.message_id))
+                     for m in reversed(messages) ]
+        archived.append( ("list@example.com", "unknown") )
+        store.calls.clear()
+        with patch("hyperkitty.lib.pipeline._pipeline", Pipeline([stage])):
+            run_pipeline(store, archived)
+        self.assertEqual(dict(store.calls), {"get_messages_by_hashes": 1})
+        self.assertEqual([ email.message_id_hash for _l, email
+                           in stage.processed ], [ h for _l, h in archived[:-1] ])
+
+
+class KarmaTestCase(TestCase):
+
+    def _email(self, sender_email, date=None):
+        email = Mock()
+        email.sender_email = sender_email
+        email.sender_name = sender_email.partition("@")[0]
+        email.date = date or datetime.datetime.now()
+        return email
+
+    def test_posts(self):
+        emails = [ self._email("dummy@example.com") for i in range(3) ]
+        emails.append(self._email("other@example.com"))
+        KarmaStage().process_batch(None, "list@example.com", emails)
+        karma = SenderKarma.objects.get(sender_email="dummy@example.com")
+        self.assertEqual(karma.posts, 3)
+        self.assertEqual(karma.score, 3)
+        self.assertEqual(SenderKarma.objects.count(), 2)
+
+    def test_votes(self):
+        email = self._email("dummy@example.com")
+        record_vote("list@example.com", email, 0, 1)
+        record_vote("list@example.com", email, 0, 1)
+        record_vote("list@example.com", email, 1, -1)
+        karma = SenderKarma.objects.get(sender_email="dummy@example.com")
+        self.assertEqual(karma.likes, 1)
+        self.assertEqual(karma.dislikes, 1)
+        record_vote("list@example.com", email, -1, 0)
+        karma = SenderKarma.objects.get(sender_email="dummy@example.com")
+        self.assertEqual(karma.dislikes, 0)
+        self.assertEqual(karma.score, 2)
+
+    def test_profile(self):
+        user = User.objects.create_user("dummy", "dummy@example.com", "x")
+        UserProfile.objects.create(user=user)
+        record_vote("list@example.com", self._email("dummy@example.com"),
+                    0, 1)
+        self.assertEqual(UserProfile.objects.get(user=user).karma, 3)
+
+    def test_top_authors(self):
+        last_year = datetime.datetime.now() - datetime.timedelta(days=365)
+        emails = [ self._email("dummy@example.com") for i in range(2) ]
+        emails.append(self._email("other@example.com"))
+        emails.extend(self._email("old@example.com", last_year)
+                      for i in range(5))
+        KarmaStage().process_batch(None, "list@example.com", emails)
+        authors = get_top_authors("list@example.com")
+        self.assertEqual([ (a.email, a.kudos) for a in authors ],
+                         [("dummy@example.com", 2), ("other@example.com", 1)])
+
+    def test_created_concurrently(self):
+        # another archiver creates the karma between the update and the insert
+        create = SenderKarma.objects.create
+        def create_twice(**kwargs):
+            create(**kwargs)
+            return create(**kwargs)
+        with patch.object(SenderKarma.objects, "create", create_twice):
+            KarmaStage().process_batch(None, "list@example.com",
+                                       [ self._email("dummy@example.com") ])
+        karma = SenderKarma.objects.get(sender_email="dummy@example.com")
+        self.assertEqual(karma.posts, 2)
+
+    def test_rebuild(self):
+        store = FakeStore()
+        mlist = MailingList(u"list@example.com", u"list@example.com", u"")
+        store.add_corpus(mlist, CorpusGenerator(20, seed=2))
+        user = User.objects.create_user("dummy", "dummy@example.com", "x")
+        emails = list(store.get_messages(u"list@example.com",
+                datetime.datetime(1970, 1, 1), datetime.datetime.utcnow()))
+        for email in emails[:3]:
+            Rating.objects.create(list_address="list@example.com",
+                    messageid=email.message_id_hash, user=user, vote=1)
+        store.calls.clear()
+        KarmaStage().rebuild(store, "list@example.com")
+        self.assertEqual(store.calls["get_messages_by_hashes"], 1)
+        self.assertEqual(sum(SenderKarma.objects.values_list(
+                         "posts", flat=True)), 20)
+        self.assertEqual(sum(SenderKarma.objects.values_list(
+                         "likes", flat=True)), 3)
+
+
+class MonthsTestCase(TestCase):
+
+    def setUp(self):
+        months._cache.clear()
+        self.store = FakeStore()
+        self.mlist = MailingList(u"list@example.com", u"list@example.com",
+                                 u"")
+        self.store.add_list(self.mlist.fqdn_listname,
+                            self.mlist.display_name, u"")
+
+    def _add(self, num, date):
+        self.store._add(self.mlist.fqdn_listname, u"msg%d@example.com" % num,
+                        None, u"Sender", u"sender@example.com", u"Subject",
+                        u"Content", date, 0, [])
+        return self.store.get_message_by_id_from_list(
+                self.mlist.fqdn_listname, u"msg%d@example.com" % num)
+
+    def test_months(self):
+        self.assertEqual(get_months("list@example.com"), [])
+        emails = [ self._add(1, datetime.datetime(2012, 12, 31)),
+                   self._add(2, datetime.datetime(2013, 1, 1)),
+                   self._add(3, datetime.datetime(2013, 3, 2)),
+                   self._add(4, datetime.datetime(2013, 3, 3)) ]
+        MonthsStage().process_batch(self.store, "list@example.com", emails)
+        self.assertEqual(get_months("list@example.com"), [
+                (2013, [(2013, 3, 2), (2013, 1, 1)]),
+                (2012, [(2012, 12, 1)]) ])
+        self.assertEqual(get_months("other@example.com"), [])
+
+    def test_process_twice(self):
+        emails = [ self._add(1, datetime.datetime(2013, 3, 2)),
+                   self._add(2, datetime.datetime(2013, 3, 3)) ]
+        MonthsStage().process_batch(self.store, "list@example.com", emails)
+        MonthsStage().process_batch(self.store, "list@example.com", emails)
+        self.assertEqual(get_months("list@example.com"),
+                         [ (2013, [(2013, 3, 2)]) ])
+
+    def test_created_concurrently(self):
+        # another archiver creates the month between the update and the insert
+        email = self._add(1, datetime.datetime(2013, 3, 2))
+        create = ArchiveMonth.objects.create
+        def create_twice(**kwargs):
+            create(**kwargs)
+            return create(**kwargs)
+        with patch.object(ArchiveMonth.objects, "create", create_twice):
+            MonthsStage().process_batch(self.store, "list@example.com",
+                                        [email])
+        self.assertEqual(get_months("list@example.com"),
+                         [ (2013, [(2013, 3, 1)]) ])
+
+    def test_cached(self):
+        get_months("list@example.com")
+        with self.assertNumQueries(0):
+            get_months("list@example.com")
+
+    def test_rebuild(self):
+        store = FakeStore()
+        mlist = MailingList(u"list@example.com", u"list@example.com", u"")
+        store.add_corpus(mlist, CorpusGenerator(50, seed=1))
+        MonthsStage().rebuild(store, "list@example.com")
+        result = get_months("list@example.com")
+        self.assertEqual(sum(m.count for year, year_months in result
+                             for m in year_months), 50)
+
+
+class CategoriesTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        now = datetime.datetime.utcnow()
+        self.threads = [ CategoryThread("thread%d" % i, "Subject %d" % i,
+                                        now - datetime.timedelta(hours=i))
+                         for i in range(3) ]
+        Tag.objects.create(list_address="list@example.com",
+                           threadid="thread1", tag="question")
+        Tag.objects.create(list_address="list@example.com",
+                           threadid="thread2", tag="question")
+        Tag.objects.create(list_address="list@example.com",
+                           threadid="old", tag="question")
+        Tag.objects.create(list_address="other@example.com",
+                           threadid="thread0", tag="question")
+
+    def test_compute(self):
+        categories = get_threads_per_category("list@example.com",
+                                              self.threads)
+        self.assertEqual(categories.keys(), ["question"])
+        self.assertEqual([ t.thread_id for t in categories["question"] ],
+                         ["thread1", "thread2"])
+
+    def test_cached(self):
+        get_threads_per_category("list@example.com", self.threads)
+        Tag.objects.all().delete()
+        categories = get_threads_per_category("list@example.com", [])
+        self.assertEqual(len(categories["question"]), 2)
+
+    def test_update(self):
+        get_threads_per_category("list@example.com", self.threads)
+        update_categories("list@example.com", self.threads[0], ["idea"])
+        categories = get_threads_per_category("list@example.com", [])
+        self.assertEqual([ t.thread_id for t in categories["idea"] ],
+                         ["thread0"])
+
+    def test_stage(self):
+        get_threads_per_category("list@example.com", self.threads)
+        store = Mock()
+        store.get_thread.return_value = CategoryThread("old", "Old subject",
+                datetime.datetime.utcnow())
+        email = Mock()
+        email.thread_id = "old"
+        CategoriesStage().process_batch(store, "list@example.com", [email])
+        store.get_thread.assert_called_with("list@example.com", "old")
+        categories = get_threads_per_category("list@example.com", [])
+        self.assertEqual([ t.thread_id for t in categories["question"] ],
+                         ["old", "thread1", "thread2"])
+
+
+class TagsTestCase(TestCase):
+
+    def setUp(self):
+        for tag, count in [("question", 10), ("quality", 3), ("qa", 1),
+                           ("bug", 1)]:
+            TagStats.objects.create(list_address="list@example.com",
+                                    tag=tag, count=count)
+        TagStats.objects.create(list_address="other@example.com",
+                                tag="quirk", count=5)
+
+    def test_cloud(self):
+        cloud = get_tag_cloud("list@example.com")
+        self.assertEqual([ (t.tag, t.weight) for t in cloud ],
+                         [("bug", 1), ("qa", 1), ("quality", 3),
+                          ("question", 5)])
+
+    def test_cloud_empty(self):
+        self.assertEqual(get_tag_cloud("empty@example.com"), [])
+
+    def test_suggestions(self):
+        self.assertEqual(get_tag_suggestions("list@example.com", "qu"),
+                         ["question", "quality"])
+        self.assertEqual(get_tag_suggestions("list@example.com", "q", 2),
+                         ["question", "quality"])
+        self.assertEqual(get_tag_suggestions("list@example.com", "x"), [])
+        self.assertEqual(get_tag_suggestions("list@example.com", ""), [])
+
+
+class ThreadLayoutTestCase(TestCase):
+
+    def setUp(self):
+        levels = [0, 1, 2, 3, 1, 0]
+        self.layout = [ LayoutEntry("msg%d" % num, level)
+                        for num, level in enumerate(levels) ]
+
+    def test_subtree(self):
+        self.assertEqual(get_subtree(self.layout, "msg1"), self.layout[2:4])
+        self.assertEqual(get_subtree(self.layout, "msg4"), [])
+        self.assertEqual(get_subtree(self.layout, "unknown"), [])
+
+    def test_collapse(self):
+        visible = collapse(self.layout, 1)
+        self.assertEqual([ (entry.message_id_hash, hidden)
+                           for entry, hidden in visible ],
+                         [("msg0", 0), ("msg1", 2), ("msg4", 0), ("msg5", 0)])
+        self.assertEqual(len(collapse(self.layout, 5)), len(self.layout))
+
+    def test_cache(self):
+        cache.clear()
+        store = Mock()
+        store.get_thread_layout.return_value = self.layout
+        thread = MagicMock()
+        thread.thread_id = "thread1"
+        thread.date_active = datetime.datetime(2012, 1, 1)
+        thread.__len__.return_value = 6
+        for i in range(2):
+            layout = get_thread_layout(store, "list@example.com", thread)
+            self.assertEqual(layout, self.layout)
+        self.assertEqual(store.get_thread_layout.call_count, 1)
+        # A new message changes the activity date, even when it was archived
+        # by another process
+        thread.date_active = datetime.datetime(2012, 1, 2)
+        thread.__len__.return_value = 7
+        get_thread_layout(store, "list@example.com", thread)
+        self.assertEqual(store.get_thread_layout.call_count, 2)
+        # A reply dated before the activity date only changes the count
+        thread.__len__.return_value = 8
+        get_thread_layout(store, "list@example.com", thread)
+        self.assertEqual(store.get_thread_layout.call_count, 3)
+
+
+class ThreadIndexTestCase(TestCase):
+
+    def setUp(self):
+        threadindex._indexes.clear()
+        self.mlist = MailingList(u"list@example.com", u"list@example.com", u"")
+        self.store = FakeStore()
+        self.store.add_corpus(self.mlist, CorpusGenerator(100, seed=4))
+
+    def _date(self, day):
+        return datetime.datetime(2013, 1, day)
+
+    def test_neighbors(self):
+        index = ThreadIndex("list@example.com")
+        index.update([ (self._date(2), "b"), (self._date(1), "a"),
+                       (self._date(3), "c") ])
+        self.assertEqual(index.neighbors("a"), (None, "b"))
+        self.assertEqual(index.neighbors("b"), ("a", "c"))
+        self.assertEqual(index.neighbors("c"), ("b", None))
+        self.assertEqual(index.neighbors("unknown"), (None, None))
+        # a new message in thread "a"
+        index.update([ (self._date(4), "a") ])
+        self.assertEqual(index.neighbors("a"), ("c", None))
+        self.assertEqual(len(index), 3)
+
+    def test_same_date(self):
+        index = ThreadIndex("list@example.com")
+        index.update([ (self._date(1), "a"), (self._date(1), "b"),
+                       (self._date(1), "c") ])
+        self.assertEqual(index.neighbors("b"), ("a", "c"))
+
+    def test_same_as_store(self):
+        index = get_thread_index(self.store, "list@example.com")
+        self.assertEqual(self.store.calls["get_thread_dates"], 1)
+        for (_name, thread_id), thread in self.store._threads.items():
+            prev_id, next_id = index.neighbors(thread_id)
+            prev_thread, next_thread = self.store.get_thread_neighbors(
+                    "list@example.com", thread_id)
+            if prev_thread is not None \
+                    and prev_thread.date_active < thread.date_active:
+                self.assertEqual(prev_id, prev_thread.thread_id)
+            if next_thread is not None \
+                    and next_thread.date_active > thread.date_active:
+                self.assertEqual(next_id, next_thread.thread_id)
+        # cached in the process
+        get_thread_index(self.store, "list@example.com")
+        self.assertEqual(self.store.calls["get_thread_dates"], 1)
+
+    def test_refresh(self):
+        index = get_thread_index(self.store, "list@example.com")
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<new@example.com>"
+        msg["Subject"] = "New thread"
+        msg["Date"] = "Mon, 01 Jan 2035 00:00:00 +0000"
+        msg.set_payload("Dummy message")
+        thread_id = self.store.add_to_list(self.mlist, msg)
+        self.assertFalse(thread_id in index)
+        index = get_thread_index(self.store, "list@example.com", thread_id)
+        self.assertTrue(thread_id in index)
+        self.assertEqual(index.neighbors(thread_id)[1], None)
+        entries = index.get_entries(self.store, [thread_id, None])
+        self.assertEqual(entries[0].subject, "New thread")
+        self.assertEqual(entries[1], None)
+
+    def _add_old_thread(self):
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<old@example.com>"
+        msg["Subject"] = "Old thread"
+        msg["Date"] = "Mon, 01 Jan 1990 00:00:00 +0000"
+        msg.set_payload("Dummy message")
+        thread_id = self.store.add_to_list(self.mlist, msg)
+        return self.store.get_thread("list@example.com", thread_id)
+
+    def test_refresh_old_thread(self):
+        index = get_thread_index(self.store, "list@example.com")
+        thread = self._add_old_thread()
+        index = get_thread_index(self.store, "list@example.com",
+                                 thread.thread_id, thread.date_active)
+        self.assertTrue(thread.thread_id in index)
+        self.assertEqual(index.neighbors(thread.thread_id)[0], None)
+        # inserted without loading the whole index again
+        self.assertEqual(self.store.calls["get_thread_dates"], 2)
+
+    def test_refresh_old_thread_without_date(self):
+        index = get_thread_index(self.store, "list@example.com")
+        thread = self._add_old_thread()
+        index = get_thread_index(self.store, "list@example.com",
+                                 thread.thread_id)
+        self.assertTrue(thread.thread_id in index)
+        self.assertEqual(index.neighbors(thread.thread_id)[0], None)
+        self.assertEqual(self.store.calls["get_thread_dates"], 3)
+
+    def test_stage(self):
+        index = get_thread_index(self.store, "list@example.com")
+        thread_id = index._keys[0][1]
+        email = Mock()
+        email.thread_id = thread_id
+        email.date = datetime.datetime(2035, 1, 1)
+        ThreadIndexStage().process_batch(self.store, "list@example.com",
+                                         [email])
+        self.assertEqual(index.neighbors(thread_id)[1], None)
+        self.assertEqual(index.get_date(thread_id), email.date)
+
+    def test_reload(self):
+        index = get_thread_index(self.store, "list@example.com")
+        deleted_id = index._keys[0][1]
+        moved_id = index._keys[-1][1]
+        del self.store._threads[("list@example.com", deleted_id)]
+        self.store._threads[("list@example.com", moved_id)].date_active = \
+                datetime.datetime(1990, 1, 1)
+        # the refresh only finds the recently active threads
+        index.refresh(self.store, force=True)
+        self.assertTrue(deleted_id in index)
+        index.loaded -= threadindex.RELOAD_INTERVAL
+        index.refresh(self.store)
+        self.assertFalse(deleted_id in index)
+        self.assertEqual(index.neighbors(moved_id)[0], None)
+
+    def test_stale_date(self):
+        index = get_thread_index(self.store, "list@example.com")
+        thread_id = index._keys[-1][1]
+        # a reply dated before the refresh margin
+        date_active = datetime.datetime(1990, 1, 1)
+        index = get_thread_index(self.store, "list@example.com", thread_id,
+                                 date_active)
+        self.assertEqual(index.get_date(thread_id), date_active)
+        self.assertEqual(index.neighbors(thread_id)[0], None)
+
+    def test_subjects_capped(self):
+        index = get_thread_index(self.store, "list@example.com")
+        thread_ids = [ thread_id for _date, thread_id in index._keys ]
+        with patch("hyperkitty.lib.threadindex.MAX_SUBJECTS", 2):
+            index = ThreadIndex("list@example.com")
+        index.load(self.store)
+        entries = index.get_entries(self.store, thread_ids[:3])
+        self.assertTrue(all(entry.subject for entry in entries))
+        self.assertEqual(len(index._subjects), 2)
+
+    def test_next_unread(self):
+        request = Mock()
+        request.session = {}
+        request.user.is_authenticated.return_value = True
+        index = ThreadIndex("list@example.com")
+        index.update([ (self._date(1), "a"), (self._date(2), "b"),
+                       (self._date(3), "c") ])
+        mark_read(request, "list@example.com", "b", self._date(2))
+        read = get_read_threads(request, "list@example.com")
+        self.assertEqual(index.next_unread("a", read), "c")
+        # a new message in "b"
+        index.update([ (self._date(4), "b") ])
+        self.assertEqual(index.next_unread("a", read), "c")
+        self.assertEqual(index.next_unread("c", read), "b")
+        self.assertEqual(get_read_threads(request, "other@example.com"), {})
+
+    def test_anonymous_not_tracked(self):
+        request = Mock()
+        request.session = {}
+        request.user.is_authenticated.return_value = False
+        mark_read(request, "list@example.com", "a", self._date(1))
+        self.assertEqual(request.session, {})
+        self.assertEqual(get_read_threads(request, "list@example.com"), {})
+
+
+class KeysetPageTestCase(TestCase):
+
+    def setUp(self):
+        self.mlist = MailingList(u"list@example.com", u"list@example.com", u"")
+        self.start = datetime.datetime(2000, 1, 1)
+        self.end = datetime.datetime(2100, 1, 1)
+
+    def _check_pages(self, store):
+        threads = store.get_threads(u"list@example.com", self.start, self.end)
+        expected = [ t.thread_id for t in sorted(threads, reverse=True,
+                     key=lambda t: (t.date_active, t.thread_id)) ]
+        pages = []
+        page = KeysetPage(store, u"list@example.com", self.start, self.end,
+                          count=len(threads), per_page=7)
+        self.assertFalse(page.has_previous)
+        pages.append(page)
+        while page.has_next:
+            page = KeysetPage(store, u"list@example.com", self.start,
+                    self.end, before=page.next_key, per_page=7)
+            self.assertTrue(page.has_previous)
+            pages.append(page)
+        self.assertEqual([ t.thread_id for p in pages for t in p ], expected)
+        self.assertEqual(len(pages), (len(expected) + 6) / 7)
+        # and back to the first page
+        page = pages[-1]
+        back = [ page ]
+        while page.has_previous:
+            page = KeysetPage(store, u"list@example.com", self.start,
+                    self.end, after=page.previous_key, per_page=7)
+            back.insert(0, page)
+        self.assertEqual([ [ t.thread_id for t in p ] for p in back ],
+                         [ [ t.thread_id for t in p ] for p in pages ])
+        # the count and the offsets for the old page numbers
+        self.assertEqual(count_threads(store, u"list@example.com",
+                         self.start, self.end), len(expected))
+        self.assertEqual(get_thread_at(store, u"list@example.com",
+                         self.start, self.end, 7).thread_id, expected[7])
+        self.assertEqual(get_thread_at(store, u"list@example.com",
+                         self.start, self.end, len(expected)), None)
+
+    def test_fake_store(self):
+        store = FakeStore()
+        store.add_corpus(self.mlist, CorpusGenerator(100, seed=5))
+        self._check_pages(store)
+
+    def test_kittystore(self):
+        store = kittystore.get_store("sqlite:", debug=False)
+        for msg in CorpusGenerator(100, seed=5):
+            store.add_to_list(self.mlist, to_message(msg))
+        self._check_pages(store)
+
+    def test_invalid_key(self):
+        store = FakeStore()
+        store.add_corpus(self.mlist, CorpusGenerator(20, seed=5))
+        page = KeysetPage(store, u"list@example.com", self.start, self.end,
+                          before="garbage")
+        first_page = KeysetPage(store, u"list@example.com", self.start,
+                                self.end)
+        self.assertFalse(page.has_previous)
+        self.assertEqual(list(page), list(first_page))
+
+
+class LRUCacheTestCase(TestCase):
+
+    def test_evict(self):
+        lru = LRUCache(2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        self.assertEqual(lru.get("a"), 1) # "b" is now the oldest
+        lru.set("c", 3)
+        self.assertEqual(len(lru), 2)
+        self.assertEqual(lru.get("b"), None)
+        self.assertEqual(lru.get("a"), 1)
+        self.assertEqual(lru.get("c"), 3)
+
+    def test_tiered_timeout(self):
+        tiered = TieredCache(2)
+        tiered.shared = Mock()
+        tiered.set("a", 1)
+        tiered.shared.set.assert_called_once_with("a", 1, MAX_TIMEOUT)
+
+
+class CorpusTestCase(TestCase):
+
+    def test_generate(self):
+        messages = list(CorpusGenerator(300, seed=1))
+        self.assertEqual(len(messages), 300)
+        self.assertEqual(messages, list(CorpusGenerator(300, seed=1)))
+        self.assertNotEqual(messages, list(CorpusGenerator(300, seed=2)))
+        dates = [ msg.date for msg in messages ]
+        self.assertEqual(dates, sorted(dates))
+        seen = set()
+        for msg in messages:
+            if msg.in_reply_to is not None:
+                self.assertTrue(msg.in_reply_to in seen)
+            seen.add(msg.message_id)
+        self.assertTrue(any(msg.content.startswith(u"On ")
+                            for msg in messages))
+
+
+class FakeStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.mlist = MailingList(u"list@example.com", u"list@example.com", u"")
+        self.messages = list(CorpusGenerator(200, seed=3))
+
+    def test_same_as_kittystore(self):
+        # the generated messages are archived in the same way by the real
+        # store and by the fake one
+        fake_store = FakeStore()
+        fake_store.add_corpus(self.mlist, self.messages)
+        store = kittystore.get_store("sqlite:", debug=False)
+        for msg in self.messages:
+            store.add_to_list(self.mlist, to_message(msg))
+        start = datetime.datetime(2000, 1, 1)
+        end = datetime.datetime(2100, 1, 1)
+        threads = store.get_threads(u"list@example.com", start, end)
+        fake_threads = fake_store.get_threads(u"list@example.com", start, end)
+        self.assertEqual([ t.thread_id for t in fake_threads ],
+                         [ t.thread_id for t in threads ])
+        for thread, fake_thread in zip(threads, fake_threads):
+            self.assertEqual(
+                [ (e.message_id_hash, e.thread_depth)
+                  for e in fake_thread.emails_by_reply ],
+                [ (e.message_id_hash, e.thread_depth)
+                  for e in thread.emails_by_reply ])
+            self.assertEqual(len(fake_thread), len(thread))
+        self.assertEqual(fake_store.calls["get_threads"], 1)
+
+    def test_lazy_loads(self):
+        # the attributes KittyStore loads with a query are counted
+        store = FakeStore()
+        store.add_corpus(self.mlist, self.messages)
+        thread = store.get_threads(u"list@example.com",
+                datetime.datetime(2000, 1, 1), datetime.datetime(2100, 1, 1))[0]
+        store.calls.clear()
+        thread.starting_email.attachments
+        len(thread)
+        self.assertEqual(dict(store.calls), {"FakeThread.starting_email": 1,
+                "FakeEmail.attachments": 1, "FakeThread.__len__": 1})
+        store.calls.clear()
+        get_thread_summaries(store, u"list@example.com", [thread.thread_id])
+        get_email_id_hashes(store, u"list@example.com", [thread.thread_id])
+        self.assertEqual(dict(store.calls), {"get_thread_summaries": 1,
+                                             "get_email_id_hashes": 1})
+
+    def test_attachments(self):
+        fake_store = FakeStore()
+        fake_store.add_corpus(self.mlist, self.messages)
+        store = kittystore.get_store("sqlite:", debug=False)
+        for msg in self.messages:
+            store.add_to_list(self.mlist, to_message(msg))
+        message_ids = [ m.message_id for m in self.messages ]
+        attachments = get_attachments_by_ids(store, u"list@example.com",
+                                             message_ids)
+        self.assertTrue(any(attachments.values()))
+        self.assertEqual(attachments, get_attachments_by_ids(fake_store,
+                         u"list@example.com", message_ids))
+
+    def test_add_to_list(self):
+        store = FakeStore()
+        for msg in self.messages[:20]:
+            store.add_to_list(self.mlist, to_message(msg))
+        fake_store = FakeStore()
+        fake_store.add_corpus(self.mlist, self.messages[:20])
+        for msg in self.messages[:20]:
+            email = store.get_message_by_id_from_list(
+                    u"list@example.com", msg.message_id)
+            fake_email = fake_store.get_message_by_id_from_list(
+                    u"list@example.com", msg.message_id)
+            self.assertEqual(email.thread_id, fake_email.thread_id)
+            self.assertEqual(email.date, fake_email.date)
+            self.assertEqual(len(email.attachments),
+                             len(fake_email.attachments))
+
+    def test_neighbors(self):
+        store = FakeStore()
+        store.add_corpus(self.mlist, self.messages)
+        threads = store.get_threads(u"list@example.com",
+                datetime.datetime(2000, 1, 1), datetime.datetime(2100, 1, 1))
+        prev_thread, next_thread = store.get_thread_neighbors(
+                u"list@example.com", threads[1].thread_id)
+        self.assertEqual(prev_thread, threads[2])
+        self.assertEqual(next_thread, threads[0])
+
+    def test_thread_summaries(self):
+        fake_store = FakeStore()
+        fake_store.add_corpus(self.mlist, self.messages)
+        store = kittystore.get_store("sqlite:", debug=False)
+        for msg in self.messages:
+            store.add_to_list(self.mlist, to_message(msg))
+        threads = store.get_threads(u"list@example.com",
+                datetime.datetime(2000, 1, 1), datetime.datetime(2100, 1, 1))
+        summaries = get_thread_summaries(store, u"list@example.com")
+        self.assertEqual(summaries, get_thread_summaries(fake_store,
+                                                         u"list@example.com"))
+        self.assertEqual(len(summaries), len(threads))
+        for summary in summaries:
+            thread = store.get_thread(u"list@example.com", summary.thread_id)
+            self.assertEqual(summary.subject, thread.subject)
+            self.assertEqual(summary.length, len(thread))
+            self.assertEqual(summary.participants, len(set(
+                    email for _name, email in thread.participants)))
+        some = get_thread_summaries(store, u"list@example.com",
+                                    [ t.thread_id for t in threads[:3] ])
+        self.assertEqual(some, summaries[:3])
+        self.assertRaises(AttributeError, setattr, summaries[0], "likes", 1)
+
+    def test_existing_thread_ids(self):
+        fake_store = FakeStore()
+        fake_store.add_corpus(self.mlist, self.messages)
+        store = kittystore.get_store("sqlite:", debug=False)
+        for msg in self.messages:
+            store.add_to_list(self.mlist, to_message(msg))
+        threads = store.get_threads(u"list@example.com",
+                datetime.datetime(2000, 1, 1), datetime.datetime(2100, 1, 1))
+        thread_ids = [ t.thread_id for t in threads[:3] ]
+        for s in (store, fake_store):
+            self.assertEqual(get_existing_thread_ids(s, u"list@example.com",
+                    thread_ids[:2] + ["unknown"] + thread_ids[2:]),
+                thread_ids)
+            sequence = ThreadSequence(s, u"list@example.com", thread_ids)
+            self.assertEqual([ t.thread_id for t in sequence[1:] ],
+                             thread_ids[1:])
+
+    def test_count_participants(self):
+        fake_store = FakeStore()
+        fake_store.add_corpus(self.mlist, self.messages)
+        store = kittystore.get_store("sqlite:", debug=False)
+        for msg in self.messages:
+            store.add_to_list(self.mlist, to_message(msg))
+        start = datetime.datetime(2000, 1, 1)
+        end = datetime.datetime(2100, 1, 1)
+        threads = store.get_threads(u"list@example.com", start, end)
+        senders = set(email for thread in threads
+                      for _name, email in thread.participants)
+        thread_ids = [ t.thread_id for t in threads ]
+        for s in (store, fake_store):
+            self.assertEqual(len(senders), count_participants(
+                    s, u"list@example.com", start, end))
+            self.assertEqual(len(senders), count_thread_participants(
+                    s, u"list@example.com", thread_ids))
+            self.assertEqual(0, count_participants(
+                    s, u"list@example.com", end, end))
+
+    def test_count_messages(self):
+        fake_store = FakeStore()
+        fake_store.add_corpus(self.mlist, self.messages)
+        store = kittystore.get_store("sqlite:", debug=False)
+        for msg in self.messages:
+            store.add_to_list(self.mlist, to_message(msg))
+        dates = sorted(msg.date for msg in self.messages)
+        middle = dates[len(dates) // 2]
+        expected = len([ d for d in dates if d < middle ])
+        for s in (store, fake_store):
+            self.assertEqual(expected, count_messages(
+                    s, u"list@example.com", dates[0], middle))
+
+
+class StoreMiddlewareTestCase(TestCase):
+
+    def test_thread_local(self):
+        stores = []
+        def app(environ, start_response):
+            stores.append(environ["kittystore.store"])
+            start_response("200 OK", [])
+            return [""]
+        app = KittyStoreWSGIMiddleware(app)
+        count = get_store_count()
+        self.assertEqual(request(app, "/"), 200)
+        self.assertEqual(request(app, "/"), 200)
+        thread = threading.Thread(target=request, args=(app, "/"))
+        thread.start()
+        thread.join()
+        self.assertTrue(stores[0] is stores[1])
+        self.assertFalse(stores[0] is stores[2])
+        self.assertEqual(get_store_count(), count + 2)
+
+
+class MetricsTestCase(TestCase):
+
+    def test_counter(self):
+        counter = Counter("test_total", "Test counter.", ["method"])
+        def run():
+            for i in range(1000):
+                counter.inc(method='get_"thread"')
+        threads = [ threading.Thread(target=run) for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.expose(), "# HELP test_total Test counter.\n"
+                "# TYPE test_total counter\n"
+                'test_total{method="get_\\"thread\\""} 4000')
+        self.assertRaises(ValueError, counter.inc, other="value")
+
+    def test_histogram(self):
+        histogram = Histogram("test_seconds", "Test histogram.", ["view"],
+                              buckets=[0.1, 1])
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value, view="thread")
+        lines = histogram.expose().split("\n")[2:]
+        self.assertEqual(lines, [
+                'test_seconds_bucket{view="thread",le="0.1"} 1',
+                'test_seconds_bucket{view="thread",le="1.0"} 3',
+                'test_seconds_bucket{view="thread",le="+Inf"} 4',
+                'test_seconds_sum{view="thread"} 6.05',
+                'test_seconds_count{view="thread"} 4',
+                ])
+
+
+def _busy_loop(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+class ProfilingTestCase(TestCase):
+
+    def test_sampler(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=_busy_loop, args=(stop, ))
+        thread.start()
+        sampler = Sampler(0.001, thread.ident)
+        sampler.start()
+        time.sleep(0.05)
+        sampler.stop()
+        stop.set()
+        thread.join()
+        self.assertTrue(sampler.samples > 0)
+        for line in sampler.collapsed().splitlines():
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(":_busy_loop" in stack)
+            self.assertTrue(int(count) > 0)
+
+    def test_token(self):
+        token = make_token("/list/list@example.com/")
+        self.assertTrue(check_token(token, "/list/list@example.com/", 60))
+        self.assertFalse(check_token(token, "/list/other@example.com/", 60))
+        self.assertFalse(check_token(token + "x", "/list/list@example.com/",
+                                     60))
+
+
+class SlowQueriesTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="hyperkitty-testing-")
+        self.log = os.path.join(self.tmpdir, "slow.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        set_origin(None)
+
+    def test_normalize(self):
+        self.assertEqual(normalize("SELECT * FROM email\n  WHERE "
+                "list_name = 'it''s' AND number > 42 AND thread_id IN "
+                "(?, ?,?)"), "SELECT * FROM email WHERE list_name = ? AND "
+                "number > ? AND thread_id IN (...)")
+        self.assertEqual(normalize("SELECT t1.id FROM t1 WHERE id = %s"),
+                         "SELECT t1.id FROM t1 WHERE id = ?")
+
+    def test_tracer(self):
+        store = kittystore.get_store("sqlite:", debug=False)
+        tracer = SlowQueryTracer(0, self.log)
+        install_tracer(tracer)
+        try:
+            set_origin("thread")
+            list(store.get_messages(u"list@example.com",
+                                    datetime.datetime(2012, 1, 1),
+                                    datetime.datetime(2013, 1, 1)))
+            set_origin("overview")
+            list(store.get_messages(u"other@example.com",
+                                    datetime.datetime(2012, 1, 1),
+                                    datetime.datetime(2013, 1, 1)))
+        finally:
+            remove_tracer(tracer)
+        records = list(read_log(self.log))
+        self.assertEqual(len(records), 2)
+        self.assertTrue("u'list@example.com'" in records[0]["params"])
+        shapes = aggregate(records)
+        self.assertEqual(len(shapes), 1)
+        self.assertEqual(shapes[0].count, 2)
+        self.assertEqual(shapes[0].origins, {"thread": 1, "overview": 1})
+        self.assertEqual(len(aggregate(records, "thread")), 1)
+        self.assertEqual(aggregate(records, "thread")[0].count, 1)
+
+    def test_threshold(self):
+        tracer = SlowQueryTracer(10, self.log)
+        tracer.connection_raw_execute(None, None, "SELECT 1", ())
+        tracer.connection_raw_execute_success(None, None, "SELECT 1", ())
+        self.assertFalse(os.path.exists(self.log))
@@ -21,7 +21,7 @@
 
 import datetime
 from django.test import TestCase
-from hyperkitty.models import Rating, Tag
+from hyperkitty.models import Rating, Tag, TagStats
 
 class RatingTestCase(TestCase):
     fixtures = ['rating_testdata.json']
@@ -42,3 +42,29 @@ class TagTestCase(TestCase):
     def setUp(self):
         super(TagTestCase, self).setUp()
         self.tag_1 = Tag.objects.get(pk=1)
+
+
+class TagStatsTestCase(TestCase):
+
+    def _count(self, tag):
+        try:
+            return TagStats.objects.get(list_address="list@example.com",
+                                        tag=tag).count
+        except TagStats.DoesNotExist:
+            return 0
+
+    def test_add(self):
+        for threadid in ("thread1", "thread2"):
+            Tag.objects.create(list_address="list@example.com",
+                               threadid=threadid, tag="question")
+        self.assertEqual(self._count("question"), 2)
+
+    def test_remove(self):
+        for threadid in ("thread1", "thread2"):
+            Tag.objects.create(list_address="list@example.com",
+                               threadid=threadid, tag="question")
+        Tag.objects.filter(threadid="thread1").delete()
+        self.assertEqual(self._count("question"), 1)
+        Tag.objects.all().delete()
+        self.assertEqual(self._count("question"), 0)
+        self.assertFalse(TagStats.objects.exists())
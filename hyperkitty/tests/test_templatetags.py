@@ -19,9 +19,12 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 
+from mock import Mock
 from django.test import TestCase
+from django.template import Template, Context
 
-from hyperkitty.templatetags.hk_generic import snip_quoted
+from hyperkitty.templatetags.hk_generic import snip_quoted, render_body, \
+        _body_cache
 
 class SnipQuotedTestCase(TestCase):
 
@@ -41,3 +44,49 @@ On Fri, 09.11.12 11:27, Someone wrote:
 """ % self.quotemsg
         result = snip_quoted(contents, self.quotemsg)
         self.assertEqual(result, expected)
+
+    def test_same_quote_twice(self):
+        # A quote which is also the end of a later quote must not be
+        # replaced in the later quote
+        contents = """&gt; Second line
+Response
+&gt; First line
+&gt; Second line
+Other response
+"""
+        expected = """<div class="quoted-switch"><a href="#">%s</a></div><div class="quoted-text"> Second line </div>Response
+<div class="quoted-switch"><a href="#">%s</a></div><div class="quoted-text"> First line
+ Second line </div>Other response
+""" % (self.quotemsg, self.quotemsg)
+        result = snip_quoted(contents, self.quotemsg)
+        self.assertEqual(result, expected)
+
+class RenderBodyTestCase(TestCase):
+
+    content = """Hi <everyone>,
+
+On Fri, 09.11.12 11:27, Someone <someone@example.com> wrote:
+> This is the first quoted line, with a link: http://example.com/page
+> This is the second quoted line
+This is the response, see http://example.com/%s
+-- 
+Dummy Sender <dummy@example.com>
+""" % ("a" * 100)
+
+    def setUp(self):
+        _body_cache.clear()
+        self.email = Mock()
+        self.email.list_name = "list@example.com"
+        self.email.message_id_hash = "DUMMYHASH"
+        self.email.content = self.content
+
+    def test_same_as_filters(self):
+        template = Template("{% load hk_generic %}{{ email.content|snip_quoted"
+                            "|wordwrap:90|urlizetrunc:76|escapeemail }}")
+        expected = template.render(Context({"email": self.email}))
+        self.assertEqual(render_body(self.email), expected)
+
+    def test_cached(self):
+        result = render_body(self.email)
+        self.email.content = "Changed"
+        self.assertEqual(render_body(self.email), result)
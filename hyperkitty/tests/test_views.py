@@ -22,18 +22,29 @@
 
 import datetime
 import urllib
+from email.message import Message
 
 from mock import Mock, patch
 
+import kittystore
 import django.utils.simplejson as json
 from django.test import TestCase
 from django.test.client import Client, RequestFactory
 from django.test.utils import override_settings
 from django.contrib.auth.models import User, AnonymousUser
 from django.core.urlresolvers import reverse
+from django.core.cache import cache
+from django.db import connections
 import django_assets.env
 
-from hyperkitty.models import Rating
+from hyperkitty.models import Rating, Tag
+from hyperkitty.lib import threadindex
+from hyperkitty.lib.spool import MailingList
+from hyperkitty.lib.profiling import make_token
+from hyperkitty.views.list import search_tag, search_keyword
+from hyperkitty.views.thread import thread_index, replies
+from hyperkitty.views.metrics import metrics
+from hyperkitty.middleware import TimingMiddleware, ProfilingMiddleware
 
 
 @override_settings(USE_SSL=False, USE_INTERNAL_AUTH=True, DEBUG=True, ASSETS_DEBUG=True)
@@ -94,6 +105,9 @@ class MessageViewsTestCase(TestCase):
         class FakeMessage(object):
             def __init__(self, h):
                 self.message_id_hash = h
+                self.sender_name = "Dummy Sender"
+                self.sender_email = "dummy@example.com"
+                self.date = datetime.datetime.now()
         self.store = Mock()
         self.store.get_message_by_hash_from_list.side_effect = \
                 lambda l, h: FakeMessage(h)
@@ -181,3 +195,289 @@ class ListArchivesTestCase(TestCase):
                         'month': today.month,
                 })
         self.assertEqual(response["location"], final_url)
+
+    @override_settings(USE_SSL=False, DEBUG=True, ASSETS_DEBUG=True)
+    def test_keyset_pagination(self):
+        django_assets.env.reset()
+        django_assets.env.get_env()
+        threadindex._indexes.clear()
+        store = kittystore.get_store("sqlite:", debug=False)
+        mlist = MailingList(u"list@example.com", u"list@example.com", u"")
+        for num in range(15):
+            msg = Message()
+            msg["From"] = "sender%d@example.com" % num
+            msg["Message-ID"] = "<msg%d@example.com>" % num
+            msg["Subject"] = "Dummy subject %d" % num
+            msg["Date"] = "Tue, %02d Jan 2013 00:00:00 +0000" % (num + 1)
+            msg.set_payload("Dummy content %d" % num)
+            store.add_to_list(mlist, msg)
+        store.commit()
+        factory = RequestFactory(**{"kittystore.store": store})
+        request = factory.get("/archives")
+        request.user = AnonymousUser()
+        response = archives(request, "list@example.com", "2013", "1")
+        self.assertContains(response, "15 discussions")
+        self.assertContains(response, "15 participants")
+        self.assertContains(response, "Dummy subject 14")
+        self.assertNotContains(response, "Dummy subject 4<")
+        next_key = response.content.partition("?before=")[2].partition('"')[0]
+        request = factory.get("/archives", {"before": urllib.unquote(next_key)})
+        request.user = AnonymousUser()
+        response = archives(request, "list@example.com", "2013", "1")
+        self.assertContains(response, "Dummy subject 4<")
+        self.assertNotContains(response, "Dummy subject 5<")
+        self.assertContains(response, "?after=")
+        # the old links with a page number
+        request = factory.get("/archives", {"page": "2"})
+        response = archives(request, "list@example.com", "2013", "1")
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["location"],
+                         "/archives?before=" + next_key)
+        request = factory.get("/archives", {"page": "garbage"})
+        response = archives(request, "list@example.com", "2013", "1")
+        self.assertEqual(response["location"], "/archives")
+        store.close()
+
+
+
+@override_settings(USE_SSL=False, DEBUG=True, ASSETS_DEBUG=True)
+class SearchTagTestCase(TestCase):
+
+    def setUp(self):
+        django_assets.env.reset()
+        django_assets.env.get_env()
+        self.store = kittystore.get_store("sqlite:", debug=False)
+        self.threads = {}
+        for list_name in (u"list@example.com", u"other@example.com"):
+            mlist = MailingList(list_name, list_name, u"")
+            for num in range(3):
+                msg = Message()
+                msg["From"] = "sender%d@example.com" % num
+                msg["Message-ID"] = "<msg%d@%s>" % (num, list_name)
+                msg["Subject"] = "Thread %d on %s" % (num, list_name)
+                msg.set_payload("Dummy message")
+                self.threads[(list_name, num)] = \
+                        self.store.add_to_list(mlist, msg)
+        self.store.commit()
+        for list_name, num in [("list@example.com", 0),
+                               ("list@example.com", 2),
+                               ("other@example.com", 1)]:
+            Tag.objects.create(list_address=list_name, tag="tagged",
+                               threadid=self.threads[(list_name, num)])
+        self.factory = RequestFactory(**{"kittystore.store": self.store})
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_list_scoped(self):
+        request = self.factory.get("/tag")
+        request.user = AnonymousUser()
+        response = search_tag(request, "list@example.com", "tagged")
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Thread 0 on list@example.com")
+        self.assertContains(response, "Thread 2 on list@example.com")
+        self.assertNotContains(response, "Thread 1 on list@example.com")
+        self.assertNotContains(response, "other@example.com")
+
+    def test_constant_queries(self):
+        for num in range(3, 30):
+            Tag.objects.create(list_address="list@example.com", tag="tagged",
+                               threadid="unknown%d" % num)
+        request = self.factory.get("/tag")
+        request.user = AnonymousUser()
+        # tagged threads, votes, tags of the page
+        with self.assertNumQueries(3):
+            search_tag(request, "list@example.com", "tagged")
+
+    def test_search_keyword(self):
+        request = self.factory.get("/search")
+        request.user = AnonymousUser()
+        response = search_keyword(request, "list@example.com", "Subject",
+                                  "Thread 1")
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Thread 1 on list@example.com")
+        self.assertNotContains(response, "Thread 0 on list@example.com")
+        self.assertNotContains(response, "other@example.com")
+
+    def test_search_keyword_page(self):
+        mlist = MailingList(u"list@example.com", u"list@example.com", u"")
+        for num in range(15):
+            msg = Message()
+            msg["From"] = "sender@example.com"
+            msg["Message-ID"] = "<paged%d@example.com>" % num
+            msg["Subject"] = "Paged thread %d" % num
+            msg.set_payload("Dummy message")
+            self.store.add_to_list(mlist, msg)
+        self.store.commit()
+        request = self.factory.get("/search")
+        request.user = AnonymousUser()
+        response = search_keyword(request, "list@example.com", "Subject",
+                                  "Paged", "2")
+        self.assertContains(response, "?page=1")
+        self.assertNotContains(response, "?page=3")
+        # the paginator links take precedence
+        request = self.factory.get("/search", {"page": "1"})
+        request.user = AnonymousUser()
+        response = search_keyword(request, "list@example.com", "Subject",
+                                  "Paged", "2")
+        self.assertContains(response, "?page=2")
+
+
+@override_settings(USE_SSL=False, DEBUG=True, ASSETS_DEBUG=True)
+class ThreadViewsTestCase(TestCase):
+
+    def setUp(self):
+        django_assets.env.reset()
+        django_assets.env.get_env()
+        cache.clear()
+        threadindex._indexes.clear()
+        self.store = kittystore.get_store("sqlite:", debug=False)
+        mlist = MailingList(u"list@example.com", u"list@example.com", u"")
+        # A chain of replies, each one replying to the previous one
+        for num in range(10):
+            msg = Message()
+            msg["From"] = "sender%d@example.com" % num
+            msg["Message-ID"] = "<msg%d@example.com>" % num
+            if num > 0:
+                msg["In-Reply-To"] = "<msg%d@example.com>" % (num - 1)
+            msg["Subject"] = "Dummy subject"
+            msg.set_payload("Dummy content %d" % num)
+            msg_hash = self.store.add_to_list(mlist, msg)
+            if num == 0:
+                self.threadid = msg_hash
+            elif num == 6:
+                self.collapsed = msg_hash
+        self.store.commit()
+        self.factory = RequestFactory(**{"kittystore.store": self.store})
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_collapsed(self):
+        request = self.factory.get("/thread")
+        request.user = AnonymousUser()
+        response = thread_index(request, "list@example.com", self.threadid)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Dummy content 6")
+        self.assertNotContains(response, "Dummy content 7")
+        self.assertContains(response, "Show 3 more replies")
+
+    def test_neighbors(self):
+        mlist = MailingList(u"list@example.com", u"list@example.com", u"")
+        thread_ids = []
+        for num in range(2):
+            msg = Message()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<newer%d@example.com>" % num
+            msg["Subject"] = "Newer thread %d" % num
+            msg["Date"] = "Mon, 0%d Jan 2035 00:00:00 +0000" % (num + 1)
+            msg.set_payload("Dummy message")
+            thread_ids.append(self.store.add_to_list(mlist, msg))
+        self.store.commit()
+        request = self.factory.get("/thread")
+        request.user = User.objects.create_user("reader", "reader@example.com",
+                                                "reader")
+        request.session = {}
+        response = thread_index(request, "list@example.com", thread_ids[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Newer thread 1")
+        self.assertContains(response, "Dummy subject")
+        self.assertContains(response, "Next unread")
+        # the next unread thread is the newer one until it is read
+        response = thread_index(request, "list@example.com", thread_ids[1])
+        response = thread_index(request, "list@example.com", self.threadid)
+        self.assertNotContains(response, "Next unread")
+
+    def test_subtree(self):
+        request = self.factory.get("/replies", {"parent": self.collapsed})
+        request.user = AnonymousUser()
+        response = replies(request, "list@example.com", self.threadid)
+        result = json.loads(response.content)
+        for num in range(7, 10):
+            self.assertTrue("Dummy content %d" % num in result["html"])
+        self.assertFalse("Dummy content 6" in result["html"])
+        self.assertEqual(result["more"], None)
+
+    @patch("hyperkitty.lib.threads.REPLIES_PER_PAGE", 2)
+    def test_pagination(self):
+        request = self.factory.get("/replies", {"sort": "date", "offset": 2})
+        request.user = AnonymousUser()
+        response = replies(request, "list@example.com", self.threadid)
+        result = json.loads(response.content)
+        self.assertTrue("Dummy content 3" in result["html"])
+        self.assertTrue("Dummy content 4" in result["html"])
+        self.assertFalse("Dummy content 5" in result["html"])
+        self.assertEqual(result["more"], 4)
+
+    @override_settings(TIMING_SLOW_THRESHOLD=0, TIMING_TRACE_RATE=1)
+    def test_timing(self):
+        request = self.factory.get("/thread")
+        request.user = AnonymousUser()
+        middleware = TimingMiddleware()
+        connection = connections["default"]
+        queries = len(connection.queries)
+        with patch("hyperkitty.middleware.timing_logger") as logger:
+            with patch.object(connection, "use_debug_cursor", False):
+                middleware.process_request(request)
+                response = thread_index(request, "list@example.com",
+                                        self.threadid)
+                response = middleware.process_response(request, response)
+        self.assertFalse(response.has_header("Server-Timing"))
+        record = json.loads(logger.info.call_args[0][0])
+        self.assertEqual(record["store_calls"]["get_thread"]["count"], 1)
+        self.assertTrue(record["storedb"]["count"] > 0)
+        self.assertTrue(record["db"]["count"] > 0)
+        self.assertTrue(record["template"]["duration"] > 0)
+        self.assertTrue(logger.warning.called)
+        # the queries are not kept like with the debug cursor
+        self.assertEqual(len(connection.queries), queries)
+
+    def test_timing_header(self):
+        middleware = TimingMiddleware()
+        request = self.factory.get("/thread")
+        request.user = User.objects.create_user("staff", "staff@example.com",
+                                                "staff")
+        request.user.is_staff = True
+        middleware.process_request(request)
+        response = thread_index(request, "list@example.com", self.threadid)
+        response = middleware.process_response(request, response)
+        timing = response["Server-Timing"]
+        for metric in ("store;", "storedb;", "db;", "template;", "total;"):
+            self.assertTrue(metric in timing)
+
+    def test_profiling(self):
+        middleware = ProfilingMiddleware()
+        request = self.factory.get("/thread", {"profile": "1"})
+        request.user = AnonymousUser()
+        self.assertEqual(middleware.process_request(request), None)
+        self.assertFalse(hasattr(request, "_profiler"))
+        request = self.factory.get("/thread",
+                                   {"profile": make_token("/thread")})
+        request.user = AnonymousUser()
+        middleware.process_request(request)
+        response = thread_index(request, "list@example.com", self.threadid)
+        response = middleware.process_response(request, response)
+        self.assertEqual(response["Content-Type"], "text/plain")
+        self.assertContains(response, ":thread_index;")
+
+
+class MetricsViewTestCase(TestCase):
+
+    @override_settings(METRICS_ALLOWED_IPS=("127.0.0.1", ))
+    def test_metrics(self):
+        factory = RequestFactory()
+        response = metrics(factory.get("/metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response,
+                "# TYPE hyperkitty_request_duration_seconds histogram")
+        self.assertContains(response, "hyperkitty_stores ")
+
+    @override_settings(METRICS_ALLOWED_IPS=("127.0.0.1", ))
+    def test_forbidden(self):
+        factory = RequestFactory(REMOTE_ADDR="192.0.2.1")
+        response = metrics(factory.get("/metrics"))
+        self.assertEqual(response.status_code, 403)
+
+    def test_forbidden_by_default(self):
+        response = metrics(RequestFactory().get("/metrics"))
+        self.assertEqual(response.status_code, 403)
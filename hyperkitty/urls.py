@@ -76,8 +76,12 @@ urlpatterns = patterns('hyperkitty.views',
         'thread.thread_index', name='thread'),
     url(r'^list/(?P<mlist_fqdn>[^/@]+@[^/@]+)/thread/(?P<threadid>\w+)/addtag$',
         'thread.add_tag', name='add_tag'),
+    url(r'^list/(?P<mlist_fqdn>[^/@]+@[^/@]+)/thread/(?P<threadid>\w+)/replies$',
+        'thread.replies', name='thread_replies'),
     url(r'^list/(?P<mlist_fqdn>[^/@]+@[^/@]+)/thread/(?P<threadid>\w+)/favorite$',
         'thread.favorite', name='favorite'),
+    url(r'^list/(?P<mlist_fqdn>[^/@]+@[^/@]+)/tags/suggest$',
+        'thread.suggest_tags', name='suggest_tags'),
 
 
     # Search Tag
@@ -85,6 +89,8 @@ urlpatterns = patterns('hyperkitty.views',
         'list.search_tag', name='search_tag'),
 
     # Search
+    url(r'^list/(?P<mlist_fqdn>[^/@]+@[^/@]+)/search/(?P<target>[^/]+)/(?P<keyword>.+)/(?P<page>\d+)/$',
+        'list.search_keyword', name="search_keyword_page"),
     url(r'^list/(?P<mlist_fqdn>[^/@]+@[^/@]+)/search/(?P<target>.*)/(?P<keyword>.*)/$',
         'list.search_keyword', name="search_keyword"),
     url(r'^list/(?P<mlist_fqdn>[^/@]+@[^/@]+)/search/$',
@@ -108,6 +114,9 @@ urlpatterns = patterns('hyperkitty.views',
     # Admin
     url(r'^admin/', include(admin.site.urls), {"SSL": True}),
 
+    # Metrics
+    url(r'^metrics$', 'metrics.metrics', name='metrics'),
+
     # Robots.txt
     url(r'^robots\.txt$', TextTemplateView.as_view(template_name="robots.txt")),
 
@@ -34,6 +34,7 @@ from django.utils.translation import gettext as _
 from hyperkitty.models import UserProfile, Rating, Favorite
 from hyperkitty.views.forms import RegistrationForm, UserProfileForm
 from hyperkitty.lib import get_store
+from hyperkitty.lib.queries import get_messages_by_hashes, get_threads_by_ids
 
 
 logger = logging.getLogger(__name__)
@@ -78,11 +79,16 @@ def user_profile(request, user_email=None):
         votes = Rating.objects.filter(user=request.user)
     except Rating.DoesNotExist:
         votes = []
+    votes = list(votes)
+    messages = {}
+    for list_address in set(vote.list_address for vote in votes):
+        messages[list_address] = get_messages_by_hashes(store, list_address,
+                [ vote.messageid for vote in votes
+                  if vote.list_address == list_address ])
     votes_up = []
     votes_down = []
     for vote in votes:
-        message = store.get_message_by_hash_from_list(
-                vote.list_address, vote.messageid)
+        message = messages[vote.list_address].get(vote.messageid)
         vote_data = {"list_address": vote.list_address,
                      "messageid": vote.messageid,
                      "message": message,
@@ -97,9 +103,22 @@ def user_profile(request, user_email=None):
         favorites = Favorite.objects.filter(user=request.user)
     except Favorite.DoesNotExist:
         favorites = []
+    favorites = list(favorites)
+    threads = {}
+    starting_emails = {}
+    for list_address in set(fav.list_address for fav in favorites):
+        thread_ids = [ fav.threadid for fav in favorites
+                       if fav.list_address == list_address ]
+        for thread in get_threads_by_ids(store, list_address, thread_ids):
+            threads[(list_address, thread.thread_id)] = thread
+        # Starting email: same id as the thread_id
+        for message_id_hash, message in get_messages_by_hashes(store,
+                    list_address, thread_ids).items():
+            starting_emails[(list_address, message_id_hash)] = message
     for fav in favorites:
-        thread = store.get_thread(fav.list_address, fav.threadid)
-        fav.thread = thread
+        fav.thread = threads.get((fav.list_address, fav.threadid))
+        fav.starting_email = starting_emails.get(
+                (fav.list_address, fav.threadid))
 
     flash_messages = []
     flash_msg = request.GET.get("msg")
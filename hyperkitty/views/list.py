@@ -20,8 +20,9 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 
+import urllib
 import datetime
-from collections import namedtuple, defaultdict
+from collections import defaultdict
 
 from django.shortcuts import redirect, render
 from django.conf import settings
@@ -31,8 +32,16 @@ from django.utils import formats
 from django.utils.dateformat import format as date_format
 
 from hyperkitty.models import Tag, Favorite
-from hyperkitty.lib import get_months, get_store, get_display_dates, daterange
-from hyperkitty.lib.voting import get_votes
+from hyperkitty.lib import get_store, get_display_dates, daterange
+from hyperkitty.lib.months import get_months
+from hyperkitty.lib.voting import get_votes_by_message
+from hyperkitty.lib.karma import get_top_authors
+from hyperkitty.lib.categories import get_threads_per_category
+from hyperkitty.lib.tags import get_tag_cloud
+from hyperkitty.lib.queries import (get_email_id_hashes, sort_thread_ids,
+        count_thread_participants, count_participants, count_threads,
+        get_thread_summaries, get_thread_at, get_messages_by_hashes,
+        make_key, ThreadSequence, KeysetPage)
 from forms import SearchForm
 
 
@@ -56,8 +65,15 @@ def archives(request, mlist_fqdn, year=None, month=None, day=None):
 
     begin_date, end_date = get_display_dates(year, month, day)
     store = get_store(request)
+    if "page" in request.GET and "before" not in request.GET \
+            and "after" not in request.GET:
+        return _redirect_page_number(request, store, mlist_fqdn,
+                                     begin_date, end_date)
     mlist = store.get_list(mlist_fqdn)
-    threads = store.get_threads(mlist_fqdn, start=begin_date, end=end_date)
+    threads = KeysetPage(store, mlist_fqdn, begin_date, end_date,
+            before=request.GET.get("before"), after=request.GET.get("after"),
+            count=count_threads(store, mlist_fqdn, begin_date, end_date))
+    participants = count_participants(store, mlist_fqdn, begin_date, end_date)
     if day is None:
         list_title = date_format(begin_date, "F Y")
         no_results_text = "for this month"
@@ -71,75 +87,112 @@ def archives(request, mlist_fqdn, year=None, month=None, day=None):
         "list_title": list_title.capitalize(),
         "no_results_text": no_results_text,
     }
-    return _thread_list(request, mlist, threads, extra_context=extra_context)
+    return _thread_list(request, mlist, threads, extra_context=extra_context,
+                        participants=participants)
 
 
-def _thread_list(request, mlist, threads, template_name='thread_list.html', extra_context={}):
+def _redirect_page_number(request, store, mlist_fqdn, begin_date, end_date):
+    """Redirect the archives URLs with a page number, from before the keyset
+    pagination, to the same page. An invalid or out of range page number
+    leads to the first page."""
+    try:
+        page_num = int(request.GET["page"])
+    except ValueError:
+        page_num = 1
+    thread = None
+    if page_num > 1:
+        # the page starts after the last thread of the previous one
+        thread = get_thread_at(store, mlist_fqdn, begin_date, end_date,
+                               (page_num - 1) * 10 - 1)
+    url = request.path
+    if thread is not None:
+        url += "?" + urllib.urlencode({"before": make_key(thread)})
+    return redirect(url)
+
+
+def _thread_list(request, mlist, threads, template_name='thread_list.html',
+                 extra_context={}, participants=None, page_num=None):
     store = get_store(request)
     search_form = SearchForm(auto_id=False)
 
-    participants = set()
-    for thread in threads:
-        participants.update(thread.participants)
+    if participants is None:
+        participants = count_thread_participants(store, mlist.name,
+                [ thread.thread_id for thread in threads ])
+
+    # Only the threads in the page are annotated
+    # the page in the query string comes from the paginator links
+    page_num = request.GET.get('page', page_num)
+    if isinstance(threads, KeysetPage):
+        page = threads
+        thread_count = threads.count
+    else:
+        paginator = Paginator(threads, 10)
+        try:
+            page = paginator.page(page_num)
+        except PageNotAnInteger:
+            # If page is not an integer, deliver first page.
+            page = paginator.page(1)
+        except EmptyPage:
+            # If page is out of range (e.g. 9999), deliver last page of results.
+            page = paginator.page(paginator.num_pages)
+        thread_count = paginator.count
+
+    thread_ids = [ thread.thread_id for thread in page ]
+    summaries = dict( (summary.thread_id, summary) for summary in
+                      get_thread_summaries(store, mlist.name, thread_ids) )
+    # Starting email: same id as the thread_id
+    starting_emails = get_messages_by_hashes(store, mlist.name, thread_ids)
+    email_id_hashes = get_email_id_hashes(store, mlist.name, thread_ids)
+    votes = get_votes_by_message(
+            [ h for hashes in email_id_hashes.values() for h in hashes ],
+            request.user)
+    favorites = set()
+    if request.user.is_authenticated():
+        favorites = set(Favorite.objects.filter(list_address=mlist.name,
+                            threadid__in=thread_ids, user=request.user
+                        ).values_list("threadid", flat=True))
+    tags = defaultdict(list)
+    for tag in Tag.objects.filter(list_address=mlist.name,
+                                  threadid__in=thread_ids):
+        tags[tag.threadid].append(tag)
 
+    threads = []
+    for thread_id in thread_ids:
+        if thread_id not in summaries:
+            continue
         # Votes
         totalvotes = 0
         totallikes = 0
         totaldislikes = 0
-        for message_id_hash in thread.email_id_hashes:
-            likes, dislikes, myvote = get_votes(message_id_hash, request.user)
+        thread_myvote = 0
+        for message_id_hash in email_id_hashes.get(thread_id, []):
+            likes, dislikes, myvote = votes[message_id_hash]
             totallikes = totallikes + likes
             totalvotes = totalvotes + likes + dislikes
             totaldislikes = totaldislikes + dislikes
-            if message_id_hash == thread.thread_id:
-                # Starting email: same id as the thread_id
-                thread.myvote = myvote
+            if message_id_hash == thread_id:
+                thread_myvote = myvote
         try:
-            thread.likes = totallikes / totalvotes
+            thread_likes = totallikes / totalvotes
         except ZeroDivisionError:
-            thread.likes = 0
+            thread_likes = 0
         try:
-            thread.dislikes = totaldislikes / totalvotes
+            thread_dislikes = totaldislikes / totalvotes
         except ZeroDivisionError:
-            thread.dislikes = 0
-        thread.likestatus = "neutral"
-        if thread.likes - thread.dislikes >= 10:
-            thread.likestatus = "likealot"
-        elif thread.likes - thread.dislikes > 0:
-            thread.likestatus = "like"
-        #elif thread.likes - thread.dislikes < 0:
-        #    thread.likestatus = "dislike"
-
-        # Favorites
-        thread.favorite = False
-        if request.user.is_authenticated():
-            try:
-                Favorite.objects.get(list_address=mlist.name,
-                                     threadid=thread.thread_id,
-                                     user=request.user)
-            except Favorite.DoesNotExist:
-                pass
-            else:
-                thread.favorite = True
-
-        # Tags
-        try:
-            thread.tags = Tag.objects.filter(threadid=thread.thread_id,
-                                             list_address=mlist.name)
-        except Tag.DoesNotExist:
-            thread.tags = []
-
-    all_threads = threads
-    paginator = Paginator(threads, 10)
-    page_num = request.GET.get('page')
-    try:
-        threads = paginator.page(page_num)
-    except PageNotAnInteger:
-        # If page is not an integer, deliver first page.
-        threads = paginator.page(1)
-    except EmptyPage:
-        # If page is out of range (e.g. 9999), deliver last page of results.
-        threads = paginator.page(paginator.num_pages)
+            thread_dislikes = 0
+        likestatus = "neutral"
+        if thread_likes - thread_dislikes >= 10:
+            likestatus = "likealot"
+        elif thread_likes - thread_dislikes > 0:
+            likestatus = "like"
+        #elif thread_likes - thread_dislikes < 0:
+        #    likestatus = "dislike"
+
+        threads.append(summaries[thread_id]._replace(
+                starting_email=starting_emails.get(thread_id),
+                likes=thread_likes, dislikes=thread_dislikes,
+                likestatus=likestatus, myvote=thread_myvote,
+                favorite=thread_id in favorites, tags=tags[thread_id]))
 
     flash_messages = []
     flash_msg = request.GET.get("msg")
@@ -152,8 +205,10 @@ def _thread_list(request, mlist, threads, template_name='thread_list.html', extr
         'current_page': page_num,
         'search_form': search_form,
         'threads': threads,
-        'participants': len(participants),
-        'months_list': get_months(store, mlist.name),
+        'page': page,
+        'participants': participants,
+        'thread_count': thread_count,
+        'months_list': get_months(mlist.name),
         'flash_messages': flash_messages,
     }
     context.update(extra_context)
@@ -173,35 +228,23 @@ def overview(request, mlist_fqdn=None):
 
     store = get_store(request)
     mlist = store.get_list(mlist_fqdn)
-    threads_result = store.get_threads(list_name=mlist.name, start=begin_date,
-        end=end_date)
-
-    threads = []
-    Thread = namedtuple('Thread', ["thread_id", "subject", "participants",
-                                   "length", "date_active"])
-    participants = set()
-    for thread_obj in threads_result:
-        thread = Thread(thread_obj.thread_id, thread_obj.subject,
-                        thread_obj.participants, len(thread_obj),
-                        thread_obj.date_active)
-        # Statistics on how many participants and threads this month
-        participants.update(thread.participants)
-        threads.append(thread)
+    threads = get_thread_summaries(store, mlist.name, start=begin_date,
+                                   end=end_date)
 
     # top threads are the one with the most answers
     top_threads = sorted(threads, key=lambda t: t.length, reverse=True)
 
     # active threads are the ones that have the most recent posting
-    active_threads = sorted(threads, key=lambda t: t.date_active, reverse=True)
+    active_threads = threads
 
-    # top authors are the ones that have the most kudos.  How do we determine
-    # that?  Most likes for their post?
+    # top authors are the ones that have the most kudos this month, see
+    # hyperkitty.lib.karma for the scoring
     if settings.USE_MOCKUPS:
         authors = generate_top_author()
         authors = sorted(authors, key=lambda author: author.kudos)
         authors.reverse()
     else:
-        authors = []
+        authors = get_top_authors(mlist.name)
 
     # List activity
     # Use get_messages and not get_threads to count the emails, because
@@ -229,7 +272,8 @@ def overview(request, mlist_fqdn=None):
     if settings.USE_MOCKUPS:
         threads_per_category = generate_thread_per_category()
     else:
-        threads_per_category = {}
+        threads_per_category = get_threads_per_category(mlist.name,
+                                                        threads)
 
     context = {
         'mlist' : mlist,
@@ -238,7 +282,8 @@ def overview(request, mlist_fqdn=None):
         'most_active_threads': active_threads[:5],
         'top_author': authors,
         'threads_per_category': threads_per_category,
-        'months_list': get_months(store, mlist.name),
+        'tag_cloud': get_tag_cloud(mlist.name),
+        'months_list': get_months(mlist.name),
         'evolution': evolution,
         'days': days,
         'archives_baseurl': archives_baseurl,
@@ -262,8 +307,9 @@ def search(request, mlist_fqdn):
     return redirect(url)
 
 
-def search_keyword(request, mlist_fqdn, target, keyword, page=1):
+def search_keyword(request, mlist_fqdn, target, keyword, page=None):
     store = get_store(request)
+    mlist = store.get_list(mlist_fqdn)
     ## Should we remove the code below?
     ## If urls.py does it job we should never need it
     if not keyword:
@@ -272,18 +318,26 @@ def search_keyword(request, mlist_fqdn, target, keyword, page=1):
         target = request.GET.get('target')
     if not target:
         target = 'Subject'
-    regex = '%%%s%%' % keyword
-    list_name = mlist_fqdn.split('@')[0]
     if target.lower() == 'subjectcontent':
-        threads = store.search_content_subject(mlist_fqdn, keyword)
-    elif target.lower() == 'subject':
-        threads = store.search_subject(mlist_fqdn, keyword)
+        emails = store.search_list_for_content_subject(mlist_fqdn, keyword)
     elif target.lower() == 'content':
-        threads = store.search_content(mlist_fqdn, keyword)
+        emails = store.search_list_for_content(mlist_fqdn, keyword)
     elif target.lower() == 'from':
-        threads = store.search_sender(mlist_fqdn, keyword)
+        emails = store.search_list_for_sender(mlist_fqdn, keyword)
+    else:
+        emails = store.search_list_for_subject(mlist_fqdn, keyword)
+
+    thread_ids = set(email.thread_id for email in emails)
+    thread_ids = sort_thread_ids(store, mlist_fqdn, thread_ids)
+    threads = ThreadSequence(store, mlist_fqdn, thread_ids)
+    participants = count_thread_participants(store, mlist_fqdn, thread_ids)
 
-    return _search_results_page(request, mlist_fqdn, threads, 'Search', page)
+    extra_context = {
+        "list_title": "Search results for \"%s\"" % keyword,
+        "no_results_text": "for this search",
+    }
+    return _thread_list(request, mlist, threads, extra_context=extra_context,
+                        participants=participants, page_num=page)
 
 
 def search_tag(request, mlist_fqdn, tag):
@@ -291,19 +345,17 @@ def search_tag(request, mlist_fqdn, tag):
     store = get_store(request)
     mlist = store.get_list(mlist_fqdn)
 
-    try:
-        tags = Tag.objects.filter(tag=tag)
-    except Tag.DoesNotExist:
-        tags = {}
-
-    threads = []
-    for t in tags:
-        threads.append(store.get_thread(mlist_fqdn, t.threadid))
+    thread_ids = Tag.objects.filter(list_address=mlist_fqdn, tag=tag
+            ).values_list("threadid", flat=True).distinct()
+    thread_ids = sort_thread_ids(store, mlist_fqdn, thread_ids)
+    threads = ThreadSequence(store, mlist_fqdn, thread_ids)
+    participants = count_thread_participants(store, mlist_fqdn, thread_ids)
 
     extra_context = {
         "tag": tag,
         "list_title": "Search results for tag \"%s\"" % tag,
         "no_results_text": "for this tag",
     }
-    return _thread_list(request, mlist, threads, extra_context=extra_context)
+    return _thread_list(request, mlist, threads, extra_context=extra_context,
+                        participants=participants)
 
@@ -34,8 +34,11 @@ from django.core.exceptions import SuspiciousOperation
 from django.template import RequestContext, loader
 from django.contrib.auth.decorators import login_required
 
-from hyperkitty.lib import get_store, get_months
+from hyperkitty.lib import get_store
+from hyperkitty.lib.months import get_months
 from hyperkitty.lib.voting import set_message_votes
+from hyperkitty.lib.karma import record_vote
+from hyperkitty.lib.queries import set_messages_attachments
 from hyperkitty.models import Rating
 from forms import SearchForm, ReplyForm, PostForm
 
@@ -52,13 +55,14 @@ def index(request, mlist_fqdn, message_id_hash):
         raise Http404
     message.sender_email = message.sender_email.strip()
     set_message_votes(message, request.user)
+    set_messages_attachments(store, mlist_fqdn, [message])
     mlist = store.get_list(mlist_fqdn)
 
     context = {
         'mlist' : mlist,
         'message': message,
         'message_id_hash' : message_id_hash,
-        'months_list': get_months(store, mlist.name),
+        'months_list': get_months(mlist.name),
         'reply_form': ReplyForm(),
     }
     return render(request, "message.html", context)
@@ -111,10 +115,12 @@ def vote(request, mlist_fqdn, message_id_hash):
     try:
         v = Rating.objects.get(user=request.user, messageid=message_id_hash,
                                list_address=mlist_fqdn)
+        old_value = v.vote
         if v.vote == value:
             return HttpResponse("You've already cast this vote",
                                 content_type="text/plain", status=403)
     except Rating.DoesNotExist:
+        old_value = 0
         if value != 0:
             v = Rating(list_address=mlist_fqdn, messageid=message_id_hash,
                        vote=value)
@@ -128,6 +134,7 @@ def vote(request, mlist_fqdn, message_id_hash):
     else:
         v.vote = value
         v.save()
+    record_vote(mlist_fqdn, message, old_value, value)
 
     # Extract all the votes for this message to refresh it
     set_message_votes(message, request.user)
@@ -195,7 +202,7 @@ def new_message(request, mlist_fqdn):
     context = {
         "mlist": mlist,
         "post_form": form,
-        'months_list': get_months(store, mlist.name),
+        'months_list': get_months(mlist.name),
     }
     return render(request, "message_new.html", context)
 
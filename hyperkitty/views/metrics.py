@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 1998-2012 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Aurelien Bompard <abompard@fedoraproject.org>
+#
+
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from hyperkitty.lib.metrics import expose
+
+
+def metrics(request):
+    """Serve the metrics in the Prometheus text format, to the addresses
+    listed in the ``METRICS_ALLOWED_IPS`` setting only."""
+    allowed = getattr(settings, "METRICS_ALLOWED_IPS", ())
+    if request.META.get("REMOTE_ADDR") not in allowed:
+        return HttpResponse("Forbidden", content_type="text/plain",
+                            status=403)
+    return HttpResponse(expose(),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -34,8 +34,16 @@ from django.core.exceptions import SuspiciousOperation
 
 from hyperkitty.models import Tag, Favorite
 from forms import SearchForm, AddTagForm, ReplyForm
-from hyperkitty.lib import get_months, get_store, stripped_subject
-from hyperkitty.lib.voting import set_message_votes
+from hyperkitty.lib import get_store, stripped_subject
+from hyperkitty.lib.months import get_months
+from hyperkitty.lib.voting import set_message_votes, set_messages_votes
+from hyperkitty.lib.threads import (get_thread_layout, get_subtree,
+        get_replies_page)
+from hyperkitty.lib.queries import set_messages_attachments
+from hyperkitty.lib.categories import update_categories
+from hyperkitty.lib.tags import get_tag_suggestions
+from hyperkitty.lib.threadindex import (get_thread_index, get_read_threads,
+        mark_read)
 
 
 def thread_index(request, mlist_fqdn, threadid, month=None, year=None):
@@ -43,29 +51,29 @@ def thread_index(request, mlist_fqdn, threadid, month=None, year=None):
     search_form = SearchForm(auto_id=False)
     store = get_store(request)
     thread = store.get_thread(mlist_fqdn, threadid)
-    if not thread:
+    if thread is None:
         raise Http404
-    prev_thread, next_thread = store.get_thread_neighbors(mlist_fqdn, threadid)
-
-    if "sort" in request.GET and request.GET["sort"] == "date":
-        sort_mode = "date"
-        emails = thread.emails
-    else:
-        sort_mode = "thread"
-        emails = thread.emails_by_reply
-
-    participants = {}
-    for email in emails:
-        # Extract all the votes for this message
-        set_message_votes(email, request.user)
-
-        # Statistics on how many participants and messages this month
-        participants[email.sender_name] = email.sender_email
-
-        if sort_mode == "thread":
-            email.level = email.thread_depth - 1 # replies start ragged left
-            if email.level > 5:
-                email.level = 5
+    mark_read(request, mlist_fqdn, threadid, thread.date_active)
+    thread_index = get_thread_index(store, mlist_fqdn, threadid,
+                                    thread.date_active)
+    prev_id, next_id = thread_index.neighbors(threadid)
+    next_unread_id = thread_index.next_unread(threadid,
+            get_read_threads(request, mlist_fqdn))
+    prev_thread, next_thread, next_unread = thread_index.get_entries(store,
+            [prev_id, next_id, next_unread_id])
+
+    sort_mode = _get_sort_mode(request)
+    first_mail = thread.starting_email
+    set_message_votes(first_mail, request.user)
+    set_messages_attachments(store, mlist_fqdn, [first_mail])
+    layout = [ entry for entry in get_thread_layout(store, mlist_fqdn,
+                                                    thread, sort_mode)
+               if entry.message_id_hash != first_mail.message_id_hash ]
+    replies, next_offset = get_replies_page(store, mlist_fqdn, layout)
+    set_messages_votes(replies, request.user)
+
+    # Statistics on how many participants and messages this month
+    participants = dict(thread.participants)
 
     from_url = reverse("thread", kwargs={"mlist_fqdn":mlist_fqdn,
                                          "threadid":threadid})
@@ -89,11 +97,11 @@ def thread_index(request, mlist_fqdn, threadid, month=None, year=None):
 
     # Extract relative dates
     today = datetime.date.today()
-    days_old = today - thread.starting_email.date.date()
+    days_old = today - first_mail.date.date()
     days_inactive = today - thread.last_email.date.date()
 
     mlist = store.get_list(mlist_fqdn)
-    subject = stripped_subject(mlist, thread.starting_email.subject)
+    subject = stripped_subject(mlist, first_mail.subject)
 
     context = {
         'mlist' : mlist,
@@ -104,10 +112,12 @@ def thread_index(request, mlist_fqdn, threadid, month=None, year=None):
         'addtag_form': tag_form,
         'month': thread.date_active,
         'participants': participants,
-        'first_mail': thread.starting_email,
-        'replies': list(emails)[1:],
+        'first_mail': first_mail,
+        'replies': replies,
+        'next_offset': next_offset,
         'neighbors': (prev_thread, next_thread),
-        'months_list': get_months(store, mlist.name),
+        'next_unread': next_unread,
+        'months_list': get_months(mlist.name),
         'days_inactive': days_inactive.days,
         'days_old': days_old.days,
         'sort_mode': sort_mode,
@@ -117,6 +127,58 @@ def thread_index(request, mlist_fqdn, threadid, month=None, year=None):
     return render(request, "thread.html", context)
 
 
+def _get_sort_mode(request):
+    if request.GET.get("sort") == "date":
+        return "date"
+    return "thread"
+
+
+def replies(request, mlist_fqdn, threadid):
+    """
+    Return a page of replies in a thread, or the replies below a message if
+    the "parent" parameter is given. Used to load the replies which are not
+    displayed in the thread view.
+    """
+    store = get_store(request)
+    sort_mode = _get_sort_mode(request)
+    try:
+        offset = int(request.GET.get("offset", 0))
+    except ValueError:
+        raise SuspiciousOperation
+    thread = store.get_thread(mlist_fqdn, threadid)
+    if thread is None:
+        raise Http404
+    layout = get_thread_layout(store, mlist_fqdn, thread, sort_mode)
+    if not layout:
+        raise Http404
+    parent = request.GET.get("parent")
+    if parent:
+        layout = get_subtree(layout, parent)
+        base_level = layout[0].level if layout else 0
+    else:
+        # The starting email is always displayed
+        starting_email = thread.starting_email
+        layout = [ entry for entry in layout if
+                   entry.message_id_hash != starting_email.message_id_hash ]
+        base_level = 0
+    replies, next_offset = get_replies_page(store, mlist_fqdn, layout,
+                                            offset, base_level=base_level)
+    set_messages_votes(replies, request.user)
+
+    FakeMList = namedtuple("MailingList", ["name"])
+    t = loader.get_template('threads/replies.html')
+    html = t.render(RequestContext(request, {
+            "replies": replies,
+            "threadid": threadid,
+            "sort_mode": sort_mode,
+            "parent": parent,
+            "next_offset": next_offset,
+            "mlist": FakeMList(name=mlist_fqdn)}))
+    response = {"html": html, "more": next_offset}
+    return HttpResponse(json.dumps(response),
+                        mimetype='application/javascript')
+
+
 def add_tag(request, mlist_fqdn, threadid):
     """ Add a tag to a given thread. """
     if not request.user.is_authenticated():
@@ -137,6 +199,9 @@ def add_tag(request, mlist_fqdn, threadid):
     except Tag.DoesNotExist:
         tag_obj = Tag(list_address=mlist_fqdn, threadid=threadid, tag=tag)
         tag_obj.save()
+        thread = get_store(request).get_thread(mlist_fqdn, threadid)
+        if thread is not None:
+            update_categories(mlist_fqdn, thread, [tag])
 
     # Now refresh the tag list
     tags = Tag.objects.filter(threadid=threadid, list_address=mlist_fqdn)
@@ -151,6 +216,14 @@ def add_tag(request, mlist_fqdn, threadid):
                         mimetype='application/javascript')
 
 
+def suggest_tags(request, mlist_fqdn):
+    """ Return the tags starting with the given text, for autocompletion. """
+    prefix = request.GET.get("q", "").strip()
+    response = {"tags": get_tag_suggestions(mlist_fqdn, prefix)}
+    return HttpResponse(json.dumps(response),
+                        mimetype='application/javascript')
+
+
 
 def favorite(request, mlist_fqdn, threadid):
     """ Add or remove from favorites"""